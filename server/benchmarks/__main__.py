@@ -0,0 +1,196 @@
+"""
+Benchmark the poem generation API.
+
+Run from the server directory, either against the app in-process:
+
+    python -m benchmarks --random-model --requests 64 --concurrency 8
+
+or against a running server:
+
+    python -m benchmarks --url http://localhost:8000 --server-pid 1234
+
+Results are printed and written as JSON so runs can be compared between commits.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+import httpx
+
+from benchmarks.runner import Workload, asgi_transport, http_transport, peak_rss_mb, run
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def parse_args() -> argparse.Namespace:
+    """Parse command line options."""
+    parser = argparse.ArgumentParser(description="Load test the poem generation API")
+    parser.add_argument("--url", help="base URL of a running server; runs in-process if omitted")
+    parser.add_argument("--server-pid", type=int, help="server process to report peak RSS for")
+    parser.add_argument("--requests", type=int, default=32)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument(
+        "--styles",
+        default="free_verse=1,haiku=1,sonnet=1",
+        help="style mix as comma-separated style=weight pairs",
+    )
+    parser.add_argument("--prompts", help="file with one prompt per line")
+    parser.add_argument("--max-length", type=int, default=100)
+    parser.add_argument("--temperature", type=float, default=0.9)
+    parser.add_argument("--top-k", type=int, default=50)
+    parser.add_argument("--top-p", type=float, default=0.95)
+    parser.add_argument("--repetition-penalty", type=float, default=1.2)
+    parser.add_argument("--seed", type=int, default=0, help="seed for the request mix")
+    parser.add_argument(
+        "--random-model",
+        action="store_true",
+        help="serve a small randomly initialized model instead of the checkpoint",
+    )
+    parser.add_argument("--n-layer", type=int, default=2)
+    parser.add_argument("--n-embd", type=int, default=128)
+    parser.add_argument("--n-head", type=int, default=4)
+    parser.add_argument("--output", help="JSON results path, defaults to a timestamped file")
+    return parser.parse_args()
+
+
+def use_random_model(args: argparse.Namespace, model_dir: str) -> None:
+    """Write a randomly initialized checkpoint and point the settings at it.
+
+    Must run before the app is imported, since settings are read on import.
+    """
+    import torch
+    from transformers import GPT2Config, GPT2LMHeadModel
+
+    torch.manual_seed(args.seed)
+    config = GPT2Config(
+        n_positions=400,
+        n_ctx=400,
+        n_embd=args.n_embd,
+        n_layer=args.n_layer,
+        n_head=args.n_head,
+        vocab_size=50257,
+    )
+    torch.save(GPT2LMHeadModel(config).state_dict(), os.path.join(model_dir, "random.pth"))
+
+    os.environ.update(
+        {
+            "MODEL_DIR": model_dir,
+            "MODEL_FILENAME": "random.pth",
+            "TOKENIZER_DIR": os.path.join(SERVER_DIR, "models"),
+            "N_EMBD": str(args.n_embd),
+            "N_LAYER": str(args.n_layer),
+            "N_HEAD": str(args.n_head),
+            "N_POSITIONS": "400",
+            "N_CTX": "400",
+        }
+    )
+
+
+def workload(args: argparse.Namespace) -> Workload:
+    """Build the workload described by the command line."""
+    styles = {}
+    for pair in args.styles.split(","):
+        style, _, weight = pair.partition("=")
+        styles[style.strip()] = float(weight or 1)
+
+    prompts = None
+    if args.prompts:
+        with open(args.prompts) as f:
+            prompts = [line.strip() for line in f if line.strip()]
+
+    return Workload(
+        requests=args.requests,
+        concurrency=args.concurrency,
+        styles=styles,
+        params={
+            "max_length": args.max_length,
+            "temperature": args.temperature,
+            "top_k": args.top_k,
+            "top_p": args.top_p,
+            "repetition_penalty": args.repetition_penalty,
+        },
+        seed=args.seed,
+        **({"prompts": prompts} if prompts else {}),
+    )
+
+
+async def run_in_process(work: Workload) -> Dict[str, Any]:
+    """Start the app with its lifespan and call it without a network hop."""
+    from main import app
+
+    async with app.router.lifespan_context(app):
+        return await run(asgi_transport(app), work)
+
+
+async def run_over_http(url: str, work: Workload) -> Dict[str, Any]:
+    """Drive a running server over HTTP."""
+    limits = httpx.Limits(max_connections=work.concurrency)
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=None) as client:
+        return await run(http_transport(client), work)
+
+
+def git_commit() -> Optional[str]:
+    """Commit the benchmarked tree is at, if known."""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=SERVER_DIR,
+            capture_output=True,
+            check=True,
+            text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main() -> None:
+    """Run the benchmark and write its results."""
+    args = parse_args()
+    work = workload(args)
+
+    with tempfile.TemporaryDirectory() as model_dir:
+        if args.url:
+            results = asyncio.run(run_over_http(args.url, work))
+        else:
+            # Every in-process request comes from the same client address
+            os.environ["RATE_LIMIT_BACKEND"] = "none"
+            if args.random_model:
+                use_random_model(args, model_dir)
+            results = asyncio.run(run_in_process(work))
+
+    if args.url is None:
+        results["peak_rss_mb"] = peak_rss_mb()
+    elif args.server_pid is not None:
+        results["peak_rss_mb"] = peak_rss_mb(args.server_pid)
+
+    report = {
+        "commit": git_commit(),
+        "timestamp": datetime.now().isoformat(),
+        "target": args.url or "in-process",
+        "random_model": args.random_model,
+        "workload": {
+            "requests": work.requests,
+            "concurrency": work.concurrency,
+            "styles": work.styles,
+            **work.params,
+        },
+        "results": results,
+    }
+
+    output = args.output or f"benchmark-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    print(json.dumps(report, indent=2))
+    print(f"Wrote {output}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
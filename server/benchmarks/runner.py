@@ -0,0 +1,236 @@
+"""
+Load generation and metrics for the poem generation API.
+"""
+
+import asyncio
+import json
+import random
+import resource
+import time
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional
+
+import httpx
+
+DEFAULT_PROMPTS = [
+    "the sea at dawn",
+    "autumn leaves",
+    "a city at night",
+    "the first snow",
+    "an old lighthouse",
+    "summer rain on a tin roof",
+    "the silence after a storm",
+    "stars over the desert",
+]
+
+# Opens a streaming POST and yields the raw response body chunks
+Transport = Callable[[str, Dict[str, Any]], AsyncIterator[bytes]]
+
+
+@dataclass
+class Workload:
+    """What to send and how hard to push."""
+
+    requests: int
+    concurrency: int
+    styles: Dict[str, float]
+    prompts: List[str] = field(default_factory=lambda: list(DEFAULT_PROMPTS))
+    params: Dict[str, Any] = field(default_factory=dict)
+    seed: int = 0
+
+    def bodies(self) -> List[Dict[str, Any]]:
+        """Build the request bodies, reproducibly for a given seed."""
+        rng = random.Random(self.seed)
+        styles = list(self.styles)
+        weights = [self.styles[style] for style in styles]
+
+        return [
+            {
+                "prompt": rng.choice(self.prompts),
+                "style": rng.choices(styles, weights)[0],
+                **self.params,
+            }
+            for _ in range(self.requests)
+        ]
+
+
+@dataclass
+class Sample:
+    """Timings of a single request, in seconds from when it was sent."""
+
+    style: str
+    latency: float
+    ttft: Optional[float]
+    tokens: int
+    error: Optional[str] = None
+
+
+def http_transport(client: httpx.AsyncClient) -> Transport:
+    """Send requests to a running server."""
+
+    async def post(path: str, body: Dict[str, Any]) -> AsyncIterator[bytes]:
+        async with client.stream("POST", path, json=body) as response:
+            if response.status_code != 200:
+                raise RuntimeError(f"HTTP {response.status_code}")
+            async for chunk in response.aiter_raw():
+                yield chunk
+
+    return post
+
+
+def asgi_transport(app: Any) -> Transport:
+    """Call an ASGI app directly, seeing body chunks as soon as they are sent.
+
+    httpx's ASGI transport buffers the whole response, which would hide the
+    time to first token.
+    """
+
+    async def post(path: str, body: Dict[str, Any]) -> AsyncIterator[bytes]:
+        payload = json.dumps(body).encode()
+        messages: asyncio.Queue = asyncio.Queue()
+        disconnected = asyncio.Event()
+
+        async def receive() -> Dict[str, Any]:
+            nonlocal payload
+            if payload is not None:
+                request, payload = payload, None
+                return {"type": "http.request", "body": request, "more_body": False}
+            await disconnected.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(message: Dict[str, Any]) -> None:
+            await messages.put(message)
+
+        scope = {
+            "type": "http",
+            "asgi": {"version": "3.0"},
+            "http_version": "1.1",
+            "method": "POST",
+            "scheme": "http",
+            "path": path,
+            "raw_path": path.encode(),
+            "query_string": b"",
+            "root_path": "",
+            "headers": [(b"content-type", b"application/json")],
+            "client": ("127.0.0.1", 0),
+            "server": ("benchmark", 80),
+        }
+
+        task = asyncio.create_task(app(scope, receive, send))
+        task.add_done_callback(lambda _: messages.put_nowait(None))
+        try:
+            while (message := await messages.get()) is not None:
+                if message["type"] == "http.response.start" and message["status"] != 200:
+                    raise RuntimeError(f"HTTP {message['status']}")
+                if message["type"] == "http.response.body":
+                    if message.get("body"):
+                        yield message["body"]
+                    if not message.get("more_body", False):
+                        break
+            await task
+        finally:
+            disconnected.set()
+            if not task.done():
+                task.cancel()
+
+    return post
+
+
+async def measure(post: Transport, body: Dict[str, Any]) -> Sample:
+    """Stream one poem and time its first token and completion."""
+    start = time.perf_counter()
+    ttft: Optional[float] = None
+    tokens = 0
+    buffer = b""
+
+    try:
+        async for chunk in post("/generate/stream", body):
+            buffer += chunk
+            while b"\n\n" in buffer:
+                event, buffer = buffer.split(b"\n\n", 1)
+                name, _, data = event.partition(b"\n")
+                name = name.removeprefix(b"event: ")
+                if name == b"token":
+                    if ttft is None:
+                        ttft = time.perf_counter() - start
+                elif name == b"poem":
+                    # Token events carry text deltas, not one token each
+                    metadata = json.loads(data.removeprefix(b"data: "))["metadata"]
+                    if not metadata["cached"]:
+                        tokens = metadata["generated_tokens"] or 0
+                elif name == b"error":
+                    raise RuntimeError(event.decode(errors="replace"))
+    except Exception as e:
+        return Sample(body["style"], time.perf_counter() - start, ttft, tokens, error=str(e))
+
+    return Sample(body["style"], time.perf_counter() - start, ttft, tokens)
+
+
+async def run(post: Transport, workload: Workload) -> Dict[str, Any]:
+    """Drive the workload with a fixed number of concurrent clients."""
+    bodies = workload.bodies()
+    samples: List[Sample] = []
+
+    async def client() -> None:
+        while bodies:
+            samples.append(await measure(post, bodies.pop()))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(workload.concurrency)))
+    duration = time.perf_counter() - start
+
+    return summarize(samples, duration)
+
+
+def summarize(samples: List[Sample], duration: float) -> Dict[str, Any]:
+    """Aggregate request samples into throughput and latency figures."""
+    ok = [sample for sample in samples if sample.error is None]
+    tokens = sum(sample.tokens for sample in ok)
+
+    styles = {
+        style: _latency_stats([sample for sample in ok if sample.style == style])
+        for style in sorted({sample.style for sample in ok})
+    }
+
+    return {
+        "requests": len(samples),
+        "errors": len(samples) - len(ok),
+        "duration_s": duration,
+        "requests_per_s": len(ok) / duration if duration else 0.0,
+        "tokens_per_s": tokens / duration if duration else 0.0,
+        **_latency_stats(ok),
+        "styles": styles,
+        "error_samples": sorted({sample.error for sample in samples if sample.error})[:5],
+    }
+
+
+def peak_rss_mb(pid: Optional[int] = None) -> float:
+    """Peak resident set size of this process, or of ``pid`` via /proc."""
+    if pid is None:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    with open(f"/proc/{pid}/status") as status:
+        for line in status:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) / 1024
+    raise RuntimeError(f"No peak RSS reported for process {pid}")
+
+
+def _latency_stats(samples: List[Sample]) -> Dict[str, Optional[float]]:
+    """Latency and time-to-first-token percentiles in milliseconds."""
+    latencies = sorted(sample.latency for sample in samples)
+    ttfts = sorted(sample.ttft for sample in samples if sample.ttft is not None)
+
+    stats: Dict[str, Optional[float]] = {}
+    for name, values in (("latency", latencies), ("ttft", ttfts)):
+        for percentile in (50, 95, 99):
+            stats[f"{name}_p{percentile}_ms"] = _percentile(values, percentile)
+    return stats
+
+
+def _percentile(values: List[float], percentile: float) -> Optional[float]:
+    """Nearest-rank percentile of sorted ``values`` in milliseconds."""
+    if not values:
+        return None
+    rank = max(0, min(len(values) - 1, round(percentile / 100 * len(values)) - 1))
+    return values[rank] * 1000
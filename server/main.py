@@ -8,21 +8,37 @@ from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
-from slowapi import _rate_limit_exceeded_handler
-from slowapi.errors import RateLimitExceeded
 
 from src.api.routes import router
 from src.config.settings import get_settings
-from src.middleware.rate_limit import limiter
+from src.middleware.rate_limit import (
+    RateLimitExceeded,
+    bulk_rate_limiter,
+    rate_limit_exceeded_handler,
+    rate_limiter,
+)
+from src.middleware.request_context import RequestContextMiddleware
+from src.services.cache import response_cache
+from src.services.jobs import job_manager
 from src.services.model_manager import model_manager
+from src.services.structured_logging import log_pipeline
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Manage application lifecycle - initialize and cleanup model."""
+    log_pipeline.start()
     await model_manager.initialize()
     yield
+    await job_manager.shutdown()
     await model_manager.shutdown()
+    if response_cache is not None:
+        response_cache.close()
+    if rate_limiter is not None:
+        rate_limiter.close()
+    if bulk_rate_limiter is not None:
+        bulk_rate_limiter.close()
+    log_pipeline.stop()
 
 
 def create_app() -> FastAPI:
@@ -36,8 +52,7 @@ def create_app() -> FastAPI:
         lifespan=lifespan,
     )
 
-    app.state.limiter = limiter
-    app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
+    app.add_exception_handler(RateLimitExceeded, rate_limit_exceeded_handler)
 
     app.add_middleware(
         CORSMiddleware,
@@ -47,6 +62,8 @@ def create_app() -> FastAPI:
         allow_headers=settings.cors_allow_headers,
     )
 
+    app.add_middleware(RequestContextMiddleware)
+
     app.include_router(router)
 
     return app
@@ -3,14 +3,41 @@ API route definitions for the poetry generation server.
 """
 
 import logging
+import os
+from contextlib import aclosing
+from typing import Any, AsyncIterator, Dict, Literal, Optional, Tuple
 
-import torch
-from fastapi import APIRouter, HTTPException, status
-from fastapi.responses import JSONResponse
+from fastapi import APIRouter, Depends, HTTPException, Request, status
+from fastapi.responses import Response, StreamingResponse
+from pydantic_core import to_json
 
-from src.models.schemas import GenerateRequest, HealthResponse
-from src.services.generator import poetry_generator
-from src.services.model_manager import model_manager
+from src.config.settings import ModelSpec, get_settings
+from src.middleware.auth import require_admin
+from src.middleware.rate_limit import (
+    RateLimiter,
+    bulk_rate_limiter,
+    client_key,
+    rate_limiter,
+)
+from src.models.schemas import (
+    BatchGenerateRequest,
+    BatchGenerateResponse,
+    CacheStatsResponse,
+    GenerateRequest,
+    GenerateResponse,
+    HealthResponse,
+    JobResponse,
+    LivenessResponse,
+    ModelInfo,
+    ModelsResponse,
+    ReadinessResponse,
+    ReloadResponse,
+)
+from src.services.cache import response_cache
+from src.services.generator import ClientDisconnectedError, poetry_generator
+from src.services.jobs import BatchJob, job_manager, run_batch
+from src.services.metrics import render as render_metrics, stage
+from src.services.model_manager import QueueFullError, model_manager
 
 logger = logging.getLogger(__name__)
 
@@ -22,28 +49,139 @@ router = APIRouter()
 async def health_check() -> HealthResponse:
     """Check API health and model status."""
     return HealthResponse(
-        status="healthy",
+        status="healthy" if model_manager.accepting_traffic else "unhealthy",
         model_loaded=model_manager.model is not None,
         tokenizer_loaded=model_manager.tokenizer is not None,
-        device=model_manager.model.device.type if model_manager.model else "unknown",
+        device=get_settings().device.type if model_manager.model else "unknown",
         request_count=model_manager.request_count,
-        cuda_available=torch.cuda.is_available(),
-        cuda_device_count=torch.cuda.device_count() if torch.cuda.is_available() else 0,
+        cuda_available=model_manager.cuda_device_count > 0,
+        cuda_device_count=model_manager.cuda_device_count,
     )
 
 
-@router.post("/generate")
-async def generate_poem(request: GenerateRequest) -> JSONResponse:
+@router.get("/livez", response_model=LivenessResponse)
+@router.head("/livez", response_model=LivenessResponse)
+async def liveness() -> LivenessResponse:
+    """Report that the event loop is serving requests."""
+    return LivenessResponse()
+
+
+@router.get("/readyz", response_model=ReadinessResponse)
+@router.head("/readyz", response_model=ReadinessResponse)
+async def readiness(response: Response) -> ReadinessResponse:
+    """Report whether to route traffic here, failing with 503 when not.
+
+    Answered from state kept by the model manager, without running
+    inference. A replica is ready once its model is loaded and while its
+    periodic self-test decode meets the latency SLO.
+    """
+    ready = model_manager.accepting_traffic
+    if not ready:
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+
+    return ReadinessResponse(
+        status="ready" if ready else "not_ready",
+        model_loaded=model_manager.is_ready,
+        self_test_passed=model_manager.self_test_passed,
+        self_test_seconds=model_manager.self_test_seconds,
+        queue_depth=model_manager.queue_depth,
+        in_flight=model_manager.in_flight,
+        last_inference_seconds=model_manager.last_inference_seconds,
+    )
+
+
+@router.get("/cache/stats", response_model=CacheStatsResponse)
+async def cache_stats() -> CacheStatsResponse:
+    """Report response cache hit, miss and eviction counters."""
+    if response_cache is None:
+        return CacheStatsResponse(enabled=False)
+    return CacheStatsResponse(enabled=True, **response_cache.stats)
+
+
+@router.get("/metrics")
+async def metrics() -> Response:
+    """Expose request stage latencies, throughput and queue metrics for Prometheus."""
+    content, media_type = render_metrics()
+    return Response(content=content, media_type=media_type)
+
+
+@router.get("/models", response_model=ModelsResponse)
+async def list_models() -> ModelsResponse:
+    """List registered models with their current version, memory use and decode latency."""
+    default = get_settings().default_model
+    return ModelsResponse(
+        models=[
+            ModelInfo(
+                name=version.name,
+                version=version.number,
+                filename=version.spec.filename,
+                default=version.name == default,
+                loaded_at=version.loaded_at,
+                memory_bytes=version.memory_bytes,
+                in_flight=version.in_flight,
+                last_inference_seconds=version.last_inference_seconds,
+                mean_inference_seconds=version.mean_inference_seconds,
+                reloading=model_manager.is_reloading(version.name),
+            )
+            for version in model_manager.versions
+        ]
+    )
+
+
+@router.post(
+    "/models/{name}/reload",
+    response_model=ReloadResponse,
+    status_code=status.HTTP_202_ACCEPTED,
+    dependencies=[Depends(require_admin)],
+)
+async def reload_model(name: str, spec: Optional[ModelSpec] = None) -> ReloadResponse:
+    """Load a new version of a model in the background and switch to it once warmed up.
+
+    Without a body the model's checkpoint file is read again. A spec
+    replaces the checkpoint or architecture, or registers a new model.
+    Requires the admin token.
+    """
+    if spec is None and not model_manager.has_model(name):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Model not found.")
+    if spec is not None:
+        _check_spec(name, spec)
+    if model_manager.is_reloading(name):
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT, detail="Model is already being reloaded."
+        )
+
+    model_manager.start_reload(name, spec)
+    return ReloadResponse(model=name)
+
+
+@router.post("/generate", response_model=GenerateResponse)
+async def generate_poem(request: GenerateRequest, http_request: Request) -> Response:
     """Generate a poem based on the provided prompt and parameters."""
     if not model_manager.is_ready:
         raise HTTPException(
             status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
             detail="Model not loaded. Please try again later.",
         )
+    _check_model(request)
+    await _charge(http_request, poetry_generator.request_cost(request))
 
     try:
-        result = await poetry_generator.generate(request)
-        return JSONResponse(content=result, status_code=status.HTTP_200_OK)
+        result = await poetry_generator.generate(
+            request, is_disconnected=http_request.is_disconnected
+        )
+        with stage("serialize", request.style):
+            return _json_response(result)
+
+    except ClientDisconnectedError:
+        # Nobody is listening; 499 is the conventional "client closed request" status
+        return Response(status_code=499)
+
+    except QueueFullError as e:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Server is busy. Please retry shortly.",
+            headers={"Retry-After": str(e.retry_after)},
+        ) from e
 
     except Exception as e:
         logger.exception("Error generating poem")
@@ -51,3 +189,218 @@ async def generate_poem(request: GenerateRequest) -> JSONResponse:
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="An error occurred during poem generation. Please try again.",
         ) from e
+
+
+@router.post("/generate/stream")
+async def generate_poem_stream(
+    request: GenerateRequest, http_request: Request
+) -> StreamingResponse:
+    """Generate a poem, streaming decoded text as Server-Sent Events."""
+    if not model_manager.is_ready:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Model not loaded. Please try again later.",
+        )
+    _check_model(request)
+    await _charge(http_request, poetry_generator.request_cost(request))
+
+    try:
+        model_manager.ensure_capacity()
+    except QueueFullError as e:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Server is busy. Please retry shortly.",
+            headers={"Retry-After": str(e.retry_after)},
+        ) from e
+
+    return StreamingResponse(
+        _sse_events(
+            poetry_generator.generate_stream(request, is_disconnected=http_request.is_disconnected)
+        ),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@router.post("/generate/batch", response_model=BatchGenerateResponse)
+async def generate_batch(
+    request: BatchGenerateRequest,
+    http_request: Request,
+    format: Literal["json", "ndjson"] = "json",
+) -> Response:
+    """Generate many poems at bulk priority, returning them in request order.
+
+    With ``format=ndjson`` each item is streamed as a JSON line as soon as it
+    and every item before it have finished.
+    """
+    await _check_batch(request, http_request)
+
+    if format == "ndjson":
+        return StreamingResponse(
+            _ndjson_lines(run_batch(request.items)), media_type="application/x-ndjson"
+        )
+
+    async with aclosing(run_batch(request.items)) as results:
+        items = [item async for item in results]
+    return _json_response({"items": items})
+
+
+@router.post("/jobs", response_model=JobResponse, status_code=status.HTTP_202_ACCEPTED)
+async def submit_job(request: BatchGenerateRequest, http_request: Request) -> Response:
+    """Start generating a batch in the background and return its job id."""
+    await _check_batch(request, http_request)
+
+    try:
+        job = job_manager.submit(request.items)
+    except QueueFullError as e:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Too many jobs are running. Please retry shortly.",
+            headers={"Retry-After": str(e.retry_after)},
+        ) from e
+
+    return _json_response(job.summary(), status_code=status.HTTP_202_ACCEPTED)
+
+
+@router.get("/jobs/{job_id}", response_model=JobResponse)
+async def get_job(job_id: str) -> Response:
+    """Report a job's progress with the items finished so far."""
+    job = _find_job(job_id)
+    items = [item for item in job.results if item is not None]
+    return _json_response({**job.summary(), "items": items})
+
+
+@router.get("/jobs/{job_id}/results")
+async def stream_job(job_id: str) -> StreamingResponse:
+    """Stream a job's items in order as NDJSON, waiting for unfinished ones."""
+    job = _find_job(job_id)
+    return StreamingResponse(
+        _ndjson_lines(job_manager.stream(job)), media_type="application/x-ndjson"
+    )
+
+
+@router.delete("/jobs/{job_id}", response_model=JobResponse)
+async def cancel_job(job_id: str) -> Response:
+    """Cancel a running job; items already finished stay available."""
+    job = job_manager.cancel(job_id)
+    if job is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Job not found.")
+    return _json_response(job.summary())
+
+
+async def _charge(
+    http_request: Request, cost: float, limiter: Optional[RateLimiter] = rate_limiter
+) -> None:
+    """Charge the client for a request; raises RateLimitExceeded if it cannot pay."""
+    if limiter is not None:
+        await limiter.hit(client_key(http_request), cost)
+
+
+async def _check_batch(request: BatchGenerateRequest, http_request: Request) -> None:
+    """Reject batches when the model is not loaded, too large or over the rate limit."""
+    if not model_manager.is_ready:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Model not loaded. Please try again later.",
+        )
+
+    max_items = get_settings().bulk_max_items
+    if len(request.items) > max_items:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"Batches are limited to {max_items} items.",
+        )
+    for item in request.items:
+        _check_model(item)
+
+    await _charge(
+        http_request,
+        sum(poetry_generator.request_cost(item) for item in request.items),
+        bulk_rate_limiter,
+    )
+
+
+def _check_spec(name: str, spec: ModelSpec) -> None:
+    """Reject specs naming files outside the model directory or adding too many models."""
+    settings = get_settings()
+    model_dir = os.path.realpath(settings.model_dir)
+    for filename in (spec.filename, spec.draft_filename):
+        if filename is None:
+            continue
+        # Symlinks are resolved too, so a link in the model directory cannot lead out of it
+        path = os.path.realpath(os.path.join(model_dir, filename))
+        if os.path.basename(filename) != filename or os.path.dirname(path) != model_dir:
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail=f"{filename!r} is not the name of a file in the model directory.",
+            )
+
+    model_names = model_manager.model_names
+    if name not in model_names and len(model_names) >= settings.max_models:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f"No more than {settings.max_models} models can be registered.",
+        )
+
+
+def _check_model(request: GenerateRequest) -> None:
+    """Reject requests for a model that is not registered."""
+    if not model_manager.has_model(request.model):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail=f"Model {request.model!r} not found."
+        )
+
+
+def _find_job(job_id: str) -> BatchJob:
+    """Look up a job or raise 404."""
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Job not found.")
+    return job
+
+
+def _json_response(content: Any, status_code: int = status.HTTP_200_OK) -> Response:
+    """Encode a response body, typed models included, with pydantic-core's JSON encoder.
+
+    Response models are serialized directly instead of being converted to
+    dicts for ``json`` first.
+    """
+    return Response(
+        content=to_json(content), status_code=status_code, media_type="application/json"
+    )
+
+
+async def _ndjson_lines(items: AsyncIterator[Dict[str, Any]]) -> AsyncIterator[bytes]:
+    """Encode items as newline-delimited JSON."""
+    try:
+        async for item in items:
+            yield to_json(item) + b"\n"
+    finally:
+        await items.aclose()
+
+
+async def _sse_events(events: AsyncIterator[Tuple[str, Any]]) -> AsyncIterator[str]:
+    """Encode generator events as Server-Sent Events."""
+    try:
+        async for event, data in events:
+            yield _format_sse(event, data)
+
+    except ClientDisconnectedError:
+        pass
+
+    except QueueFullError:
+        yield _format_sse("error", {"detail": "Server is busy. Please retry shortly."})
+
+    except Exception:
+        logger.exception("Error streaming poem")
+        yield _format_sse(
+            "error", {"detail": "An error occurred during poem generation. Please try again."}
+        )
+
+    finally:
+        await events.aclose()
+
+
+def _format_sse(event: str, data: Any) -> str:
+    """Format a single Server-Sent Event."""
+    return f"event: {event}\ndata: {to_json(data).decode()}\n\n"
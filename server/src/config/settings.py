@@ -3,14 +3,28 @@ Application configuration using Pydantic settings.
 """
 
 import os
-from functools import lru_cache
-from typing import List
+from functools import cached_property, lru_cache
+from typing import Dict, List, Literal, Optional
 
 import torch
-from pydantic import ConfigDict
+from pydantic import BaseModel, ConfigDict
 from pydantic_settings import BaseSettings
 
 
+class ModelSpec(BaseModel):
+    """A named GPT-2 checkpoint in the model directory and its architecture."""
+
+    filename: str
+    n_positions: int = 400
+    n_ctx: int = 400
+    n_embd: int = 384
+    n_layer: int = 6
+    n_head: int = 6
+    vocab_size: int = 50257
+    # Distilled speculative draft; the first layers of the model are used if unset
+    draft_filename: Optional[str] = None
+
+
 class Settings(BaseSettings):
     """Application settings loaded from environment variables."""
 
@@ -29,6 +43,18 @@ class Settings(BaseSettings):
     # Model
     model_dir: str = "./models/"
     model_filename: str = "poeticagpt.pth"
+    tokenizer_dir: Optional[str] = None
+
+    # Further named models, e.g. MODELS='{"large": {"filename": "large.pth", "n_layer": 12}}'.
+    # The checkpoint configured above is registered as "default".
+    models: Dict[str, ModelSpec] = {}
+    default_model: str = "default"
+    model_drain_timeout_seconds: float = 60.0
+    # Models a reload may add up to, counting the configured ones
+    max_models: int = 8
+
+    # Bearer token of admin endpoints such as model reload; they are disabled when unset
+    admin_token: Optional[str] = None
 
     # Model architecture
     n_positions: int = 400
@@ -38,19 +64,84 @@ class Settings(BaseSettings):
     n_head: int = 6
     vocab_size: int = 50257
 
+    # CPU inference optimization
+    cpu_optimizations: List[Literal["int8", "bf16", "compile"]] = []
+    cpu_max_perplexity_drift: float = 0.05
+    torch_num_threads: int = 0
+    torch_interop_threads: int = 0
+
     # Generation defaults
     default_max_length: int = 100
     default_temperature: float = 0.9
     default_top_k: int = 50
     default_top_p: float = 0.95
     default_repetition_penalty: float = 1.2
+    generation_min_length: int = 20
+    generation_no_repeat_ngram_size: int = 3
+    generation_bad_words: List[str] = ["http", "www", "com", ":", "/", "#"]
 
     # Concurrency
     max_concurrent_requests: int = 4
 
-    # Rate limiting
+    # Inference executor
+    inference_executor: Literal["thread", "process"] = "thread"
+    inference_workers: Optional[int] = None
+    inference_worker_threads: int = 0
+    inference_worker_affinity: bool = False
+    inference_queue_size: int = 16
+    inference_retry_after_seconds: int = 5
+
+    # Admission control; deadlines and degrading are off unless set
+    admission_timeout_seconds: Optional[float] = None
+    admission_degrade_wait_seconds: Optional[float] = None
+    admission_degraded_max_length: int = 80
+
+    # Health probes; /readyz fails while the periodic self-test decode misses its SLO
+    health_self_test_interval_seconds: Optional[float] = 15.0
+    health_self_test_slo_seconds: float = 2.0
+    health_self_test_tokens: int = 4
+
+    # Continuous batching
+    batch_max_size: int = 8
+    batch_reserved_slots: int = 1
+
+    # Bulk generation via /generate/batch and /jobs
+    bulk_max_items: int = 1000
+    bulk_concurrency: int = 8
+    bulk_max_jobs: int = 32
+    bulk_job_ttl_seconds: int = 3600
+
+    # Speculative decoding; 0 draft tokens disables it
+    speculative_tokens: int = 0
+    speculative_draft_layers: int = 2
+    speculative_draft_filename: Optional[str] = None
+
+    # Multi-candidate reranking
+    candidate_structure_weight: float = 1.0
+
+    # Response cache for seeded (deterministic) requests
+    cache_backend: Literal["none", "memory", "sqlite"] = "memory"
+    cache_max_entries: int = 1024
+    cache_ttl_seconds: int = 3600
+    cache_sqlite_path: str = "/tmp/poetica-cache/responses.db"
+    deterministic_seed: Optional[int] = None
+
+    # Rate limiting; requests are charged relative to a default_max_length poem
+    rate_limit_backend: Literal["none", "memory", "shared_memory", "redis"] = "memory"
     rate_limit_requests: int = 10
+    rate_limit_bulk_requests: int = 100
     rate_limit_window_seconds: int = 60
+    rate_limit_shm_name: str = "poetica-rate-limit"
+    rate_limit_shm_slots: int = 65536
+    rate_limit_redis_url: str = "redis://localhost:6379/0"
+
+    # Logging; JSON records are written by a background thread to stdout and log_dir
+    log_level: str = "INFO"
+    log_dir: Optional[str] = "/tmp/logs"
+    log_max_bytes: int = 10 * 1024 * 1024
+    log_backup_count: int = 5
+    log_queue_size: int = 10000
+    log_sample_rate: float = 1.0
 
     # CORS
     cors_origins: List[str] = ["http://localhost:3000", "https://poetica-ai.vercel.app"]
@@ -67,8 +158,28 @@ class Settings(BaseSettings):
         return os.path.join(self.model_dir, self.model_filename)
 
     @property
+    def model_specs(self) -> Dict[str, ModelSpec]:
+        """Every model to load at startup by name, including the default checkpoint."""
+        default = ModelSpec(
+            filename=self.model_filename,
+            n_positions=self.n_positions,
+            n_ctx=self.n_ctx,
+            n_embd=self.n_embd,
+            n_layer=self.n_layer,
+            n_head=self.n_head,
+            vocab_size=self.vocab_size,
+            draft_filename=self.speculative_draft_filename,
+        )
+        return {"default": default, **self.models}
+
+    @property
+    def tokenizer_path(self) -> str:
+        """Directory holding the tokenizer files, defaulting to the model directory."""
+        return self.tokenizer_dir or self.model_dir
+
+    @cached_property
     def device(self) -> torch.device:
-        """Compute device for inference."""
+        """Compute device for inference, resolved once."""
         return torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
 
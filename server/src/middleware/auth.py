@@ -0,0 +1,29 @@
+"""
+Bearer token authentication of admin endpoints.
+"""
+
+import secrets
+from typing import Optional
+
+from fastapi import Header, HTTPException, status
+
+from src.config.settings import get_settings
+
+
+async def require_admin(authorization: Optional[str] = Header(None)) -> None:
+    """Reject requests without the admin token, and every request if none is configured."""
+    token = get_settings().admin_token
+    if not token:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN, detail="Admin endpoints are disabled."
+        )
+
+    scheme, _, credentials = (authorization or "").partition(" ")
+    if scheme.lower() != "bearer" or not secrets.compare_digest(
+        credentials.encode(), token.encode()
+    ):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid admin token.",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
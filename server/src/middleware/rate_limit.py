@@ -1,22 +1,299 @@
 """
-Rate limiting middleware using slowapi.
+Token bucket rate limiting with pluggable bucket storage.
+
+Each client has a bucket holding up to ``rate_limit_requests`` tokens that
+refills over ``rate_limit_window_seconds``. Requests are charged by cost, so
+a default free verse poem costs one token and longer poems cost more. A
+request costing more than a full bucket is let through once the bucket is
+full and leaves it in debt, so every request is possible but none is
+discounted. Batches and jobs are charged to a separate bucket of
+``rate_limit_bulk_requests`` tokens, so bulk work does not use up a
+client's interactive requests.
 """
-from slowapi import Limiter
-from slowapi.util import get_remote_address
+
+import asyncio
+import fcntl
+import hashlib
+import logging
+import math
+import os
+import struct
+import threading
+import time
+from abc import ABC, abstractmethod
+from multiprocessing import resource_tracker, shared_memory
+from typing import Dict, Optional, Tuple
+
+import redis
+from fastapi import Request
+from fastapi.responses import JSONResponse
 
 from src.config.settings import get_settings
 
+logger = logging.getLogger(__name__)
 
-def create_limiter() -> Limiter:
-    """Create and configure rate limiter."""
-    settings = get_settings()
 
-    limiter = Limiter(
-        key_func=get_remote_address,
-        default_limits=[f"{settings.rate_limit_requests}/minute"],
+class RateLimitExceeded(Exception):
+    """Raised when a client has not enough tokens left for a request."""
+
+    def __init__(self, retry_after: float) -> None:
+        super().__init__("Rate limit exceeded")
+        self.retry_after = retry_after
+
+
+class RateLimitStore(ABC):
+    """Storage of token buckets, shared by every process using the same store."""
+
+    # Whether take does network I/O and should run off the event loop
+    blocking: bool = False
+
+    @abstractmethod
+    def take(self, key: str, cost: float, capacity: float, rate: float) -> float:
+        """Take ``cost`` tokens from a bucket refilling at ``rate`` tokens per second.
+
+        Returns 0 if the tokens were taken, otherwise the seconds until the
+        bucket will hold enough of them; nothing is taken then.
+        """
+
+    def close(self) -> None:
+        """Release any resources held by the store."""
+
+
+def _refill(
+    tokens: float, updated_at: float, now: float, cost: float, capacity: float, rate: float
+) -> Tuple[float, float]:
+    """Refill a bucket up to ``now`` and try to take ``cost`` from it.
+
+    A cost above ``capacity`` only needs a full bucket and leaves it
+    negative. Returns the tokens left and the seconds to wait, which is 0
+    if taken.
+    """
+    tokens = min(capacity, tokens + max(0.0, now - updated_at) * rate)
+    needed = min(cost, capacity)
+    if tokens >= needed:
+        return tokens - cost, 0.0
+    return tokens, (needed - tokens) / rate
+
+
+def _is_full(tokens: float, updated_at: float, now: float, capacity: float, rate: float) -> bool:
+    """Whether a bucket has refilled completely, making it equal to a new one."""
+    return tokens + (now - updated_at) * rate >= capacity
+
+
+class MemoryRateLimitStore(RateLimitStore):
+    """Buckets of this process only; every worker process enforces its own limit."""
+
+    def __init__(self, max_keys: int = 65536) -> None:
+        self._max_keys = max_keys
+        self._buckets: Dict[str, Tuple[float, float]] = {}
+        self._lock = threading.Lock()
+
+    def take(self, key: str, cost: float, capacity: float, rate: float) -> float:
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated_at = self._buckets.get(key, (capacity, now))
+            tokens, wait = _refill(tokens, updated_at, now, cost, capacity, rate)
+            self._buckets[key] = (tokens, now)
+
+            if len(self._buckets) > self._max_keys:
+                self._drop_full(now, capacity, rate)
+        return wait
+
+    def _drop_full(self, now: float, capacity: float, rate: float) -> None:
+        """Forget buckets that have refilled completely, as they equal new ones."""
+        self._buckets = {
+            key: (tokens, updated_at)
+            for key, (tokens, updated_at) in self._buckets.items()
+            if not _is_full(tokens, updated_at, now, capacity, rate)
+        }
+
+
+class SharedMemoryRateLimitStore(RateLimitStore):
+    """Buckets in a named shared memory segment shared by worker processes on one host.
+
+    The segment is a fixed-size open-addressing table of ``(key hash, tokens,
+    updated at)`` slots guarded by a file lock. A bucket that has refilled
+    completely may be reused by another key. If every probed slot is in
+    use, the least recently updated one is, which starts that client over
+    with a full bucket. The segment outlives the server so restarted
+    workers keep the buckets.
+    """
+
+    PROBES = 8
+
+    _SLOT = struct.Struct("<Qdd")
+
+    def __init__(self, name: str, slots: int) -> None:
+        size = slots * self._SLOT.size
+        try:
+            self._shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        except FileExistsError:
+            self._shm = shared_memory.SharedMemory(name=name)
+        # Every worker attaches by name, so none may unlink the segment when it exits
+        resource_tracker.unregister(self._shm._name, "shared_memory")
+
+        self._slots = min(slots, self._shm.size // self._SLOT.size)
+        self._lock_file = open(os.path.join("/tmp", f"{name}.lock"), "a")
+        self._thread_lock = threading.Lock()
+
+    def take(self, key: str, cost: float, capacity: float, rate: float) -> float:
+        digest = int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "little")
+        # Hash 0 marks an empty slot
+        digest = digest or 1
+        now = time.time()
+        buf = self._shm.buf
+
+        with self._thread_lock:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+            try:
+                offset, tokens, updated_at = self._find(digest, now, capacity, rate)
+                tokens, wait = _refill(tokens, updated_at, now, cost, capacity, rate)
+                self._SLOT.pack_into(buf, offset, digest, tokens, now)
+            finally:
+                fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+        return wait
+
+    def _find(
+        self, digest: int, now: float, capacity: float, rate: float
+    ) -> Tuple[float, float, float]:
+        """Offset and bucket of a key, claiming a slot for it if it has none."""
+        buf = self._shm.buf
+        free: Optional[int] = None
+        oldest: Optional[Tuple[float, int]] = None
+
+        for probe in range(self.PROBES):
+            offset = (digest + probe) % self._slots * self._SLOT.size
+            slot_digest, tokens, updated_at = self._SLOT.unpack_from(buf, offset)
+            if slot_digest == digest:
+                return offset, tokens, updated_at
+            if free is None and (
+                slot_digest == 0 or _is_full(tokens, updated_at, now, capacity, rate)
+            ):
+                free = offset
+            if oldest is None or updated_at < oldest[0]:
+                oldest = (updated_at, offset)
+
+        offset = free if free is not None else oldest[1]
+        return offset, math.inf, now
+
+    def close(self) -> None:
+        self._shm.close()
+        self._lock_file.close()
+
+
+class RedisRateLimitStore(RateLimitStore):
+    """Buckets in Redis, or any server speaking its protocol, shared by every replica.
+
+    Buckets are updated atomically by a Lua script using the server's clock.
+    When the server cannot be reached requests are let through, so an outage
+    of the limiter does not take the API down with it.
+    """
+
+    blocking = True
+
+    SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated_at')
+local tokens = tonumber(bucket[1]) or capacity
+local updated_at = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated_at) * rate)
+local needed = math.min(cost, capacity)
+local wait = 0
+if tokens >= needed then
+  tokens = tokens - cost
+else
+  wait = (needed - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated_at', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.max(1, math.ceil((capacity - tokens) / rate * 1000)))
+return tostring(wait)
+"""
+
+    def __init__(self, url: str, prefix: str = "poetica:rate:") -> None:
+        self._client = redis.Redis.from_url(url)
+        self._script = self._client.register_script(self.SCRIPT)
+        self._prefix = prefix
+
+    def take(self, key: str, cost: float, capacity: float, rate: float) -> float:
+        try:
+            return float(self._script(keys=[self._prefix + key], args=[capacity, rate, cost]))
+        except redis.RedisError:
+            logger.warning("Rate limit store unavailable, allowing request", exc_info=True)
+            return 0.0
+
+    def close(self) -> None:
+        self._client.close()
+
+
+class RateLimiter:
+    """Charges clients for requests against their token buckets."""
+
+    def __init__(self, store: RateLimitStore, requests: int, window_seconds: int) -> None:
+        self._store = store
+        self._capacity = float(requests)
+        self._rate = requests / window_seconds
+
+    async def hit(self, key: str, cost: float = 1.0) -> None:
+        """Charge ``key`` for a request, raising RateLimitExceeded if it cannot pay.
+
+        Requests costing more than the bucket size wait for a full bucket
+        and leave it in debt.
+        """
+        if self._store.blocking:
+            wait = await asyncio.to_thread(
+                self._store.take, key, cost, self._capacity, self._rate
+            )
+        else:
+            wait = self._store.take(key, cost, self._capacity, self._rate)
+
+        if wait > 0:
+            raise RateLimitExceeded(wait)
+
+    def close(self) -> None:
+        """Release the store."""
+        self._store.close()
+
+
+def client_key(request: Request) -> str:
+    """Identify the client a request is charged to by its address."""
+    return request.client.host if request.client else "unknown"
+
+
+async def rate_limit_exceeded_handler(request: Request, exc: RateLimitExceeded) -> JSONResponse:
+    """Respond 429 with the time until the request would be allowed."""
+    return JSONResponse(
+        status_code=429,
+        content={"detail": "Rate limit exceeded. Please retry later."},
+        headers={"Retry-After": str(math.ceil(exc.retry_after))},
     )
 
-    return limiter
+
+def create_rate_limiter(requests: int, name: Optional[str] = None) -> Optional[RateLimiter]:
+    """Create a rate limiter on the store selected in settings, or None if disabled.
+
+    A ``name`` keeps the limiter's buckets apart from those of the unnamed one.
+    """
+    settings = get_settings()
+
+    if settings.rate_limit_backend == "redis":
+        logger.info("Using Redis rate limit store at %s", settings.rate_limit_redis_url)
+        prefix = f"poetica:rate:{name}:" if name else "poetica:rate:"
+        store: RateLimitStore = RedisRateLimitStore(settings.rate_limit_redis_url, prefix)
+    elif settings.rate_limit_backend == "shared_memory":
+        shm_name = settings.rate_limit_shm_name + (f"-{name}" if name else "")
+        store = SharedMemoryRateLimitStore(shm_name, settings.rate_limit_shm_slots)
+    elif settings.rate_limit_backend == "memory":
+        store = MemoryRateLimitStore()
+    else:
+        return None
+
+    return RateLimiter(store, requests, settings.rate_limit_window_seconds)
 
 
-limiter = create_limiter()
+rate_limiter = create_rate_limiter(get_settings().rate_limit_requests)
+# Batches and jobs draw on their own buckets, so they leave interactive requests alone
+bulk_rate_limiter = create_rate_limiter(get_settings().rate_limit_bulk_requests, "bulk")
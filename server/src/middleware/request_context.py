@@ -0,0 +1,43 @@
+"""
+Request ids for correlating log records.
+"""
+
+import uuid
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from src.services.structured_logging import request_context
+
+MAX_REQUEST_ID_LENGTH = 128
+
+
+class RequestContextMiddleware:
+    """Tags each HTTP request with an id, taken from ``X-Request-ID`` or generated.
+
+    The id is added to every record logged while handling the request and
+    returned in the ``X-Request-ID`` response header. Written as plain ASGI
+    middleware so streamed responses pass through untouched.
+    """
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request_id = Headers(scope=scope).get("x-request-id", "")[:MAX_REQUEST_ID_LENGTH]
+        request_id = request_id or uuid.uuid4().hex
+
+        async def send_with_id(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                MutableHeaders(scope=message).append("X-Request-ID", request_id)
+            await send(message)
+
+        token = request_context.set({"request_id": request_id})
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            request_context.reset(token)
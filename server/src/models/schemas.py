@@ -5,7 +5,7 @@ Pydantic models for API request/response validation.
 from datetime import datetime
 from typing import List, Literal, Optional
 
-from pydantic import BaseModel, ConfigDict, Field, field_validator
+from pydantic import BaseModel, ConfigDict, Field, field_validator, model_validator
 
 
 class GenerateRequest(BaseModel):
@@ -18,6 +18,11 @@ class GenerateRequest(BaseModel):
     top_p: float = Field(default=0.95, ge=0.1, le=1.0)
     repetition_penalty: float = Field(default=1.2, ge=1.0, le=2.0)
     style: Literal["free_verse", "haiku", "sonnet"] = Field(default="free_verse")
+    seed: Optional[int] = Field(default=None, ge=0, le=2**32 - 1)
+    num_candidates: int = Field(default=1, ge=1, le=8)
+    return_candidates: int = Field(default=1, ge=1, le=8)
+    timeout_seconds: Optional[float] = Field(default=None, gt=0, le=300)
+    model: Optional[str] = Field(default=None, min_length=1, max_length=64)
 
     @field_validator("prompt")
     @classmethod
@@ -25,6 +30,19 @@ class GenerateRequest(BaseModel):
         """Normalize whitespace in prompt."""
         return " ".join(v.split())
 
+    @model_validator(mode="after")
+    def check_candidates(self) -> "GenerateRequest":
+        """Ensure no more candidates are returned than generated."""
+        if self.return_candidates > self.num_candidates:
+            raise ValueError("return_candidates must not exceed num_candidates")
+        return self
+
+
+class BatchGenerateRequest(BaseModel):
+    """Request body for bulk generation endpoints."""
+
+    items: List[GenerateRequest] = Field(..., min_length=1)
+
 
 class PoemData(BaseModel):
     """Generated poem structure."""
@@ -34,6 +52,13 @@ class PoemData(BaseModel):
     style: str
 
 
+class CandidatePoem(BaseModel):
+    """A ranked candidate poem."""
+
+    poem: PoemData
+    score: float
+
+
 class GenerationParameters(BaseModel):
     """Parameters used for generation."""
 
@@ -51,7 +76,11 @@ class GenerationMetadata(BaseModel):
 
     device: str
     model_type: str = "GPT2"
+    model: Optional[str] = None
     timestamp: datetime
+    generated_tokens: Optional[int] = None
+    cached: bool = False
+    degraded: bool = False
 
 
 class GenerateResponse(BaseModel):
@@ -61,6 +90,42 @@ class GenerateResponse(BaseModel):
     original_prompt: str
     parameters: GenerationParameters
     metadata: GenerationMetadata
+    candidates: Optional[List[CandidatePoem]] = None
+
+
+class BatchItem(BaseModel):
+    """Result of one bulk generation item; exactly one of result and error is set."""
+
+    index: int
+    result: Optional[GenerateResponse] = None
+    error: Optional[str] = None
+
+
+class BatchGenerateResponse(BaseModel):
+    """Response body for the batch generation endpoint."""
+
+    items: List[BatchItem]
+
+
+class JobResponse(BaseModel):
+    """Status of a bulk generation job, with the items finished so far."""
+
+    job_id: str
+    status: Literal["running", "completed", "cancelled"]
+    total: int
+    completed: int
+    created_at: datetime
+    items: Optional[List[BatchItem]] = None
+
+
+class CacheStatsResponse(BaseModel):
+    """Response body for cache statistics endpoint."""
+
+    enabled: bool
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    size: int = 0
 
 
 class HealthResponse(BaseModel):
@@ -75,3 +140,53 @@ class HealthResponse(BaseModel):
     request_count: int
     cuda_available: bool
     cuda_device_count: int
+
+
+class LivenessResponse(BaseModel):
+    """Response body for the liveness probe."""
+
+    status: str = "alive"
+
+
+class ReadinessResponse(BaseModel):
+    """Response body for the readiness probe."""
+
+    model_config = ConfigDict(protected_namespaces=())
+
+    status: Literal["ready", "not_ready"]
+    model_loaded: bool
+    self_test_passed: Optional[bool] = None
+    self_test_seconds: Optional[float] = None
+    queue_depth: int
+    in_flight: int
+    last_inference_seconds: Optional[float] = None
+
+
+class ModelInfo(BaseModel):
+    """The current version of a registered model and its resource use."""
+
+    name: str
+    version: int
+    filename: str
+    default: bool
+    loaded_at: datetime
+    memory_bytes: int
+    in_flight: int
+    last_inference_seconds: Optional[float] = None
+    mean_inference_seconds: Optional[float] = None
+    reloading: bool = False
+
+
+class ModelsResponse(BaseModel):
+    """Response body for the model registry endpoint."""
+
+    models: List[ModelInfo]
+
+
+class ReloadResponse(BaseModel):
+    """Response body for a started model reload."""
+
+    model_config = ConfigDict(protected_namespaces=())
+
+    model: str
+    status: Literal["reloading"] = "reloading"
@@ -0,0 +1,201 @@
+"""
+Response caching for deterministic poem generation.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from dataclasses import asdict, dataclass
+from typing import Any, Dict, Optional, Tuple
+
+from src.config.settings import get_settings
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class CacheStats:
+    """Counters describing cache effectiveness."""
+
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    size: int = 0
+
+
+class ResponseCache(ABC):
+    """Bounded LRU cache of JSON-encoded generation results with a per-entry time to live."""
+
+    # Whether get/set do I/O and should run off the event loop
+    blocking: bool = False
+
+    def __init__(self, max_entries: int, ttl_seconds: int) -> None:
+        self._max_entries = max_entries
+        self._ttl = ttl_seconds
+        self._stats = CacheStats()
+        self._lock = threading.Lock()
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        """Get a snapshot of the cache counters."""
+        with self._lock:
+            self._stats.size = self._size()
+            return asdict(self._stats)
+
+    @staticmethod
+    def make_key(payload: Dict[str, Any]) -> str:
+        """Build a stable cache key from a normalized request payload."""
+        encoded = json.dumps(payload, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        """Return a cached result, or None on a miss."""
+        with self._lock:
+            value = self._get(key, time.time())
+            if value is None:
+                self._stats.misses += 1
+            else:
+                self._stats.hits += 1
+            return value
+
+    def set(self, key: str, value: str) -> None:
+        """Store a result, evicting the least recently used entries if full."""
+        with self._lock:
+            self._stats.evictions += self._set(key, value, time.time() + self._ttl)
+
+    @abstractmethod
+    def _get(self, key: str, now: float) -> Optional[str]:
+        """Look up an unexpired entry and mark it as recently used."""
+
+    @abstractmethod
+    def _set(self, key: str, value: str, expires_at: float) -> int:
+        """Store an entry and return the number of entries evicted."""
+
+    @abstractmethod
+    def _size(self) -> int:
+        """Number of stored entries."""
+
+    def close(self) -> None:
+        """Release any resources held by the cache."""
+
+
+class MemoryResponseCache(ResponseCache):
+    """In-process cache backed by an ordered dict."""
+
+    def __init__(self, max_entries: int, ttl_seconds: int) -> None:
+        super().__init__(max_entries, ttl_seconds)
+        self._entries: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+
+    def _get(self, key: str, now: float) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        expires_at, value = entry
+        if expires_at <= now:
+            del self._entries[key]
+            self._stats.evictions += 1
+            return None
+
+        self._entries.move_to_end(key)
+        return value
+
+    def _set(self, key: str, value: str, expires_at: float) -> int:
+        self._entries[key] = (expires_at, value)
+        self._entries.move_to_end(key)
+
+        evicted = 0
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+            evicted += 1
+        return evicted
+
+    def _size(self) -> int:
+        return len(self._entries)
+
+
+class SqliteResponseCache(ResponseCache):
+    """Disk-backed cache that survives restarts and can be shared by workers on one host."""
+
+    blocking = True
+
+    def __init__(self, path: str, max_entries: int, ttl_seconds: int) -> None:
+        super().__init__(max_entries, ttl_seconds)
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+            "expires_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)"
+        )
+
+    def _get(self, key: str, now: float) -> Optional[str]:
+        row = self._conn.execute(
+            "SELECT value, expires_at FROM responses WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+
+        value, expires_at = row
+        if expires_at <= now:
+            self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self._stats.evictions += 1
+            return None
+
+        self._conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+        return value
+
+    def _set(self, key: str, value: str, expires_at: float) -> int:
+        self._conn.execute(
+            "INSERT OR REPLACE INTO responses (key, value, expires_at, accessed_at) "
+            "VALUES (?, ?, ?, ?)",
+            (key, value, expires_at, time.time()),
+        )
+
+        overflow = self._size() - self._max_entries
+        if overflow <= 0:
+            return 0
+
+        self._conn.execute(
+            "DELETE FROM responses WHERE key IN "
+            "(SELECT key FROM responses ORDER BY accessed_at LIMIT ?)",
+            (overflow,),
+        )
+        return overflow
+
+    def _size(self) -> int:
+        return self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def close(self) -> None:
+        self._conn.close()
+
+
+def create_response_cache() -> Optional[ResponseCache]:
+    """Create the response cache selected in settings, or None if disabled."""
+    settings = get_settings()
+
+    if settings.cache_backend == "sqlite":
+        logger.info("Using sqlite response cache at %s", settings.cache_sqlite_path)
+        return SqliteResponseCache(
+            settings.cache_sqlite_path, settings.cache_max_entries, settings.cache_ttl_seconds
+        )
+
+    if settings.cache_backend == "memory":
+        return MemoryResponseCache(settings.cache_max_entries, settings.cache_ttl_seconds)
+
+    return None
+
+
+response_cache = create_response_cache()
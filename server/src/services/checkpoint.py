@@ -0,0 +1,74 @@
+"""
+Memory-mapped checkpoint loading and conversion to safetensors.
+
+Run ``python -m src.services.checkpoint models/poeticagpt.pth`` to convert the
+pickled checkpoint to ``models/poeticagpt.safetensors``.
+"""
+
+import argparse
+import logging
+import os
+from typing import Dict, Optional
+
+import torch
+from safetensors.torch import load_file, save_file
+
+logger = logging.getLogger(__name__)
+
+StateDict = Dict[str, torch.Tensor]
+
+
+def load_state_dict(path: str, device: torch.device) -> StateDict:
+    """Load a checkpoint without reading it into private memory up front.
+
+    Safetensors files and CPU ``torch.load`` checkpoints are memory-mapped, so
+    tensors on CPU are backed by the page cache and shared between every
+    process that loads the same file.
+    """
+    if path.endswith(".safetensors"):
+        return load_file(path, device=str(device))
+
+    return torch.load(path, map_location=device, mmap=True, weights_only=True)
+
+
+def convert_to_safetensors(src: str, dst: Optional[str] = None) -> str:
+    """Convert a pickled state dict to safetensors and return the new path.
+
+    Safetensors cannot store tensors that share memory, so tied weights are
+    saved once and tied again when the model is loaded.
+    """
+    if dst is None:
+        dst = os.path.splitext(src)[0] + ".safetensors"
+
+    state_dict = torch.load(src, map_location="cpu", weights_only=True)
+
+    tensors: StateDict = {}
+    seen = set()
+    for name, tensor in state_dict.items():
+        pointer = (tensor.untyped_storage().data_ptr(), tensor.storage_offset(), tensor.shape)
+        if pointer in seen:
+            logger.info("Dropping %s, it shares memory with an earlier tensor", name)
+            continue
+        seen.add(pointer)
+        tensors[name] = tensor.contiguous()
+
+    save_file(tensors, dst, metadata={"format": "pt"})
+    return dst
+
+
+def main() -> None:
+    """Command line entry point for one-shot checkpoint conversion."""
+    parser = argparse.ArgumentParser(description="Convert a .pth checkpoint to safetensors")
+    parser.add_argument("src", help="path of the pickled checkpoint")
+    parser.add_argument(
+        "dst", nargs="?", help="output path, defaults to SRC with a .safetensors suffix"
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    dst = convert_to_safetensors(args.src, args.dst)
+    logger.info("Wrote %s", dst)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+"""
+Structure-aware decoding: incremental poem form tracking and token masks.
+"""
+
+import copy
+from dataclasses import dataclass
+from typing import Dict, List, Literal, Optional, Sequence, Tuple
+
+import torch
+from transformers import PreTrainedTokenizerBase
+
+from src.services.formatter import PoemFormatter
+from src.services.syllables import syllable_counter
+
+# Form states, each selecting a row of FormConstraints' token masks
+FREE, IN_LINE, LINE_DONE, FORM_DONE = range(4)
+
+# First of the mask rows for lines with 1, 2, ... syllables left, after the states' rows
+BUDGET_ROW = 4
+
+
+@dataclass(frozen=True)
+class PoemForm:
+    """Lines of a fixed form, each with a target count of syllables or words."""
+
+    unit: Literal["syllables", "words"]
+    targets: Tuple[int, ...]
+
+
+POEM_FORMS: Dict[str, PoemForm] = {
+    "haiku": PoemForm("syllables", tuple(PoemFormatter.HAIKU_SYLLABLES)),
+    "sonnet": PoemForm("words", (PoemFormatter.SONNET_WORDS,) * PoemFormatter.SONNET_LINES),
+}
+
+
+class FormTracker:
+    """Counts the syllables or words of each line of a sequence as tokens arrive.
+
+    Syllables are counted per word, as ``PoemFormatter`` counts them, from
+    the finished words of the line plus the word being generated. A line
+    is done once it reaches its target, and the form once its last line is.
+    A word continued past the syllables left can still take a line over its
+    target; only words whose first token already does are masked.
+    """
+
+    def __init__(self, form: PoemForm, constraints: "FormConstraints") -> None:
+        self._form = form
+        self._constraints = constraints
+        self._line = 0
+        self._count = 0
+        self._word = ""
+        self._line_start = True
+        self._left = form.targets[0]
+        self.state = IN_LINE
+
+    @property
+    def row(self) -> int:
+        """Row of the token masks to apply to the next token."""
+        if self.state == IN_LINE and self._form.unit == "syllables":
+            return self._constraints.budget_row(self._left)
+        return self.state
+
+    def fork(self) -> "FormTracker":
+        """Copy the tracker, e.g. to follow speculative draft tokens."""
+        return copy.copy(self)
+
+    def append(self, token: int) -> None:
+        """Advance the tracker past a generated token."""
+        if self.state == FORM_DONE:
+            return
+
+        shapes = self._constraints
+        if shapes.newline[token]:
+            if self.state == LINE_DONE:
+                self._line += 1
+                self._count = 0
+                self._left = self._form.targets[self._line]
+                self.state = IN_LINE
+            self._word = ""
+            self._line_start = True
+            return
+
+        if not shapes.has_text[token]:
+            return
+
+        new_word = self._line_start or shapes.starts_word[token]
+        self._line_start = False
+        if self._form.unit == "words":
+            self._count += new_word
+            count = self._count
+        else:
+            if new_word:
+                self._count += syllable_counter.count_word(self._word)
+                self._word = ""
+            self._word += shapes.texts[token]
+            count = self._count + syllable_counter.count_word(self._word)
+            self._left = self._form.targets[self._line] - count
+
+        if self.state == IN_LINE and count >= self._form.targets[self._line]:
+            last = self._line == len(self._form.targets) - 1
+            self.state = FORM_DONE if last else LINE_DONE
+
+
+class FormConstraints:
+    """Token text features and per-state token masks, compiled once per tokenizer.
+
+    While a line is short of its target, line breaks and the end-of-text
+    token are masked. Once it is done, only tokens continuing the current
+    word or breaking the line are allowed, so lines end on word boundaries.
+    After the last line, only continuing the word or ending the text is,
+    so decoding stops as soon as the form is complete. In syllable forms,
+    tokens starting a word with more syllables than the line has left are
+    masked as well.
+    """
+
+    def __init__(
+        self,
+        tokenizer: PreTrainedTokenizerBase,
+        vocab_size: int,
+        eos_token_id: int,
+        device: torch.device,
+    ) -> None:
+        known = min(vocab_size, len(tokenizer))
+        texts = tokenizer.batch_decode([[token] for token in range(known)])
+        texts += [""] * (vocab_size - len(texts))
+
+        self.texts: List[str] = [text.strip() for text in texts]
+        self.newline: List[bool] = ["\n" in text for text in texts]
+        self.has_text: List[bool] = [bool(text.strip()) for text in texts]
+        self.starts_word: List[bool] = [text[:1].isspace() for text in texts]
+        # Syllables of the word each word-starting token begins
+        syllables = torch.tensor(
+            syllable_counter.count_words(
+                text if starts else "" for text, starts in zip(self.texts, self.starts_word)
+            ),
+            device=device,
+        )
+
+        newline = torch.tensor(self.newline, device=device)
+        word_start = torch.tensor(self.starts_word, device=device) & ~newline
+        eos = torch.zeros(vocab_size, dtype=torch.bool, device=device)
+        eos[eos_token_id] = True
+
+        self._max_budget = max(
+            max(form.targets) for form in POEM_FORMS.values() if form.unit == "syllables"
+        )
+        self._masks = torch.stack(
+            [
+                torch.zeros_like(eos),
+                newline | eos,
+                word_start | eos,
+                word_start | newline,
+            ]
+            + [
+                newline | eos | (word_start & (syllables > left))
+                for left in range(1, self._max_budget + 1)
+            ]
+        )
+
+    def budget_row(self, left: int) -> int:
+        """Mask row of a line with ``left`` syllables to go."""
+        if 1 <= left <= self._max_budget:
+            return BUDGET_ROW + left - 1
+        return IN_LINE
+
+    def tracker(self, form: Optional[str]) -> Optional[FormTracker]:
+        """Start tracking a new sequence written in ``form``, if it is a fixed form."""
+        if form not in POEM_FORMS:
+            return None
+        return FormTracker(POEM_FORMS[form], self)
+
+    def mask(self, trackers: Sequence[Optional[FormTracker]]) -> Optional[torch.Tensor]:
+        """``(batch, vocab)`` mask of tokens each row may not produce next.
+
+        Returns None when no row is constrained.
+        """
+        if all(tracker is None for tracker in trackers):
+            return None
+
+        rows = [FREE if tracker is None else tracker.row for tracker in trackers]
+        return self._masks[torch.tensor(rows, device=self._masks.device)]
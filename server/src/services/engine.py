@@ -0,0 +1,491 @@
+"""
+Continuous batching decode engine for GPT-2 poetry generation.
+"""
+
+import itertools
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future, InvalidStateError
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional, Tuple
+
+import torch
+from transformers import GPT2LMHeadModel
+
+from src.services.constraints import FormTracker
+from src.services.generation_config import GenerationConfig
+from src.services.metrics import BATCH_SIZE
+from src.services.sampling import NgramIndex
+
+logger = logging.getLogger(__name__)
+
+KeyValues = Tuple[Tuple[torch.Tensor, torch.Tensor], ...]
+
+# Lower values are admitted first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+
+# Queued ahead of every request so stopping does not wait for the backlog
+_STOP = (-1, 0, None)
+
+
+@dataclass
+class DecodeRequest:
+    """A single sequence to decode with its sampling parameters."""
+
+    input_ids: List[int]
+    max_length: int
+    temperature: float
+    top_k: int
+    top_p: float
+    repetition_penalty: float
+    seed: Optional[int] = None
+    priority: int = PRIORITY_INTERACTIVE
+    # Poem style whose form is enforced while decoding, e.g. "haiku"
+    form: Optional[str] = None
+
+
+@dataclass
+class DecodeResult:
+    """Prompt and generated tokens of a finished request with engine timings in seconds."""
+
+    tokens: List[int]
+    queued_seconds: float
+    prefill_seconds: float
+    decode_seconds: float
+    log_probability: float
+
+
+@dataclass
+class _Sequence:
+    """Decode state of a request occupying a KV cache slot."""
+
+    request: DecodeRequest
+    future: Future
+    tokens: List[int]
+    on_token: Optional[Callable[[int], None]] = None
+    generator: Optional[torch.Generator] = None
+    ngrams: Optional[NgramIndex] = None
+    form: Optional[FormTracker] = None
+    # Sum of generated tokens' log-probabilities under the unprocessed model distribution
+    log_probability: float = 0.0
+    submitted_at: float = field(default_factory=time.perf_counter)
+    admitted_at: float = 0.0
+    prefilled_at: float = 0.0
+
+    def resolve(self, error: Optional[BaseException] = None) -> None:
+        """Complete the future unless the caller already cancelled it."""
+        try:
+            if error is None:
+                self.future.set_result(
+                    DecodeResult(
+                        tokens=self.tokens,
+                        queued_seconds=self.admitted_at - self.submitted_at,
+                        prefill_seconds=self.prefilled_at - self.admitted_at,
+                        decode_seconds=time.perf_counter() - self.prefilled_at,
+                        log_probability=self.log_probability,
+                    )
+                )
+            else:
+                self.future.set_exception(error)
+        except InvalidStateError:
+            pass
+
+
+class DecodeEngine:
+    """Iteration-level batching decode loop over preallocated KV cache slots.
+
+    Requests are admitted into free slots between token steps and leave as
+    soon as they finish, so short poems never wait for long ones. Each slot
+    holds keys and values for up to ``max_positions`` tokens. Active
+    sequences always occupy slots ``0..n-1`` so the cache can be passed to
+    the model as a view without gathering.
+
+    Cancelling a returned future at any point frees its slot before the next
+    token step, so abandoned requests stop consuming compute.
+
+    Keys and values of registered prompt prefixes are computed once and
+    copied into the slot of every request that starts with them, so only the
+    remaining prompt tokens go through prefill.
+
+    Bad words, n-gram bans and the minimum length come from the compiled
+    ``generation_config`` and apply to every request alike. Requests with a
+    fixed ``form`` have line breaks placed by syllable or word counts and
+    stop as soon as their last line is complete.
+
+    Pending requests are admitted in priority order. Bulk requests never
+    take the last ``reserved_slots`` slots, which are kept free for
+    interactive requests.
+    """
+
+    def __init__(
+        self,
+        model: GPT2LMHeadModel,
+        generation_config: GenerationConfig,
+        max_batch_size: int,
+        max_positions: int,
+        reserved_slots: int = 0,
+    ) -> None:
+        config = model.config
+        device = generation_config.device
+
+        self._model = model
+        self._eos_token_id = generation_config.eos_token_id
+        self._processors = generation_config.processors
+        self._forms = generation_config.forms
+        self._max_batch_size = max_batch_size
+        self._max_positions = max_positions
+        self._bulk_slots = max(1, max_batch_size - reserved_slots)
+        self._device = device
+
+        self._keys, self._values = self._allocate_cache(model)
+        self._seen = torch.zeros(
+            (max_batch_size, config.vocab_size), dtype=torch.bool, device=device
+        )
+        self._lengths = torch.zeros(max_batch_size, dtype=torch.long, device=device)
+        # Repetition penalty, temperature, top-k and top-p of the request in each slot
+        self._params = torch.ones((max_batch_size, 4), device=device)
+        self._positions = torch.arange(max_positions + 1, device=device)
+
+        self._prefixes: Dict[Tuple[int, ...], KeyValues] = {}
+        self._active: List[_Sequence] = []
+        self._pending: "queue.PriorityQueue[Tuple[int, int, Optional[_Sequence]]]" = (
+            queue.PriorityQueue()
+        )
+        self._order = itertools.count(1)
+        self._thread: Optional[threading.Thread] = None
+
+    def _allocate_cache(
+        self, model: GPT2LMHeadModel
+    ) -> Tuple[List[torch.Tensor], List[torch.Tensor]]:
+        """Allocate per-layer key and value slots for every sequence ``model`` decodes."""
+        config = model.config
+        head_dim = config.n_embd // config.n_head
+        shape = (self._max_batch_size, config.n_head, self._max_positions, head_dim)
+        dtype = next(model.parameters()).dtype
+
+        keys = [torch.zeros(shape, dtype=dtype, device=self._device) for _ in range(config.n_layer)]
+        values = [torch.zeros_like(layer_keys) for layer_keys in keys]
+        return keys, values
+
+    @property
+    def active_count(self) -> int:
+        """Number of sequences currently being decoded."""
+        return len(self._active)
+
+    def register_prefix(self, tokens: List[int]) -> None:
+        """Precompute and cache keys and values for a shared prompt prefix."""
+        if not tokens or len(tokens) >= self._max_positions:
+            return
+
+        with torch.inference_mode():
+            input_ids = torch.tensor([tokens], dtype=torch.long, device=self._device)
+            outputs = self._model(input_ids=input_ids, use_cache=True)
+
+        past_key_values = tuple((key[0], value[0]) for key, value in outputs.past_key_values)
+        # Replace rather than mutate so the engine thread never sees a partial update
+        self._prefixes = {**self._prefixes, tuple(tokens): past_key_values}
+
+    def start(self) -> None:
+        """Start the decode loop thread."""
+        self._thread = threading.Thread(target=self._run, name="decode-engine", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop the decode loop and fail requests that have not finished."""
+        if self._thread is None:
+            return
+
+        self._pending.put(_STOP)
+        self._thread.join()
+        self._thread = None
+
+    def submit(
+        self, request: DecodeRequest, on_token: Optional[Callable[[int], None]] = None
+    ) -> "Future[DecodeResult]":
+        """Queue a request and return a future for its prompt and generated tokens.
+
+        ``on_token`` is called from the engine thread with every generated token.
+        """
+        # The future is never marked running so that it stays cancellable mid-decode
+        future: Future = Future()
+        sequence = _Sequence(
+            request=request, future=future, tokens=list(request.input_ids), on_token=on_token
+        )
+        self._pending.put((request.priority, next(self._order), sequence))
+        return future
+
+    def _run(self) -> None:
+        """Admit, step and retire sequences until stopped."""
+        with torch.inference_mode():
+            while True:
+                if not self._admit(block=not self._active):
+                    break
+                self._drop_cancelled()
+                if self._active:
+                    try:
+                        self._step()
+                    except Exception as e:
+                        logger.exception("Decode step failed")
+                        self._fail_active(e)
+
+        self._fail_active(RuntimeError("Decode engine stopped"))
+        while not self._pending.empty():
+            _, _, sequence = self._pending.get_nowait()
+            if sequence is not None:
+                sequence.resolve(RuntimeError("Decode engine stopped"))
+
+    def _fail_active(self, error: Exception) -> None:
+        """Fail every sequence currently holding a slot."""
+        for sequence in self._active:
+            sequence.resolve(error)
+        self._active.clear()
+
+    def _drop_cancelled(self) -> None:
+        """Free the slots of sequences whose callers have gone away."""
+        for slot in reversed(range(len(self._active))):
+            if self._active[slot].future.cancelled():
+                self._retire(slot)
+
+    def _admit(self, block: bool) -> bool:
+        """Prefill pending requests into free slots. Returns False once stopped."""
+        while len(self._active) < self._max_batch_size:
+            try:
+                entry = self._pending.get(block=block)
+            except queue.Empty:
+                return True
+
+            priority, _, sequence = entry
+            if sequence is None:
+                return False
+            block = False
+
+            if priority >= PRIORITY_BULK and len(self._active) >= self._bulk_slots:
+                self._pending.put(entry)
+                return True
+
+            if sequence.future.cancelled():
+                continue
+
+            try:
+                self._prefill(sequence)
+            except Exception as e:
+                logger.exception("Prefill failed")
+                # Sampling the first token may fail after the sequence took the last slot
+                if self._active and self._active[-1] is sequence:
+                    self._active.pop()
+                sequence.resolve(e)
+
+        return True
+
+    def _prefill(self, sequence: _Sequence) -> None:
+        """Run the prompt through the model and sample the first token."""
+        sequence.admitted_at = time.perf_counter()
+        prompt = sequence.tokens[-(self._max_positions - 1):]
+        slot = len(self._active)
+        length = len(prompt)
+        cached = self._copy_prefix(prompt, slot)
+
+        input_ids = torch.tensor([prompt[cached:]], dtype=torch.long, device=self._device)
+        past_key_values = None
+        if cached:
+            past_key_values = tuple(
+                (keys[slot:slot + 1, :, :cached], values[slot:slot + 1, :, :cached])
+                for keys, values in zip(self._keys, self._values)
+            )
+
+        # A single unpadded row attends to everything, so no attention mask is needed
+        outputs = self._model(
+            input_ids=input_ids,
+            past_key_values=past_key_values,
+            position_ids=self._positions[cached:length].unsqueeze(0),
+            use_cache=True,
+        )
+
+        for layer, (key, value) in enumerate(outputs.past_key_values):
+            self._keys[layer][slot, :, cached:length] = key[0, :, cached:]
+            self._values[layer][slot, :, cached:length] = value[0, :, cached:]
+
+        self._seen[slot].zero_()
+        self._seen[slot, torch.tensor(prompt, device=self._device)] = True
+        request = sequence.request
+        self._params[slot] = torch.tensor(
+            [request.repetition_penalty, request.temperature, request.top_k, request.top_p],
+            device=self._device,
+        )
+        sequence.ngrams = self._processors.ngram_index(sequence.tokens)
+        sequence.form = self._forms.tracker(request.form)
+
+        if sequence.request.seed is not None:
+            sequence.generator = torch.Generator(device=self._device)
+            sequence.generator.manual_seed(sequence.request.seed)
+        self._lengths[slot] = length
+        self._active.append(sequence)
+
+        next_tokens = self._sample(outputs.logits[:, -1, :], [sequence])
+        sequence.prefilled_at = time.perf_counter()
+        self._advance(next_tokens)
+
+    def _copy_prefix(self, prompt: List[int], slot: int) -> int:
+        """Copy the longest cached prefix of ``prompt`` into ``slot``.
+
+        Returns the number of cached tokens. At least one prompt token is
+        always left for prefill so the model produces next-token logits.
+        """
+        best: Optional[Tuple[int, ...]] = None
+        for prefix in self._prefixes:
+            if len(prefix) < len(prompt) and tuple(prompt[:len(prefix)]) == prefix:
+                if best is None or len(prefix) > len(best):
+                    best = prefix
+
+        if best is None:
+            return 0
+
+        for layer, (key, value) in enumerate(self._prefixes[best]):
+            self._keys[layer][slot, :, :len(best)] = key
+            self._values[layer][slot, :, :len(best)] = value
+        return len(best)
+
+    def _step(self) -> None:
+        """Decode one token for every active sequence."""
+        batch_size = len(self._active)
+        BATCH_SIZE.observe(batch_size)
+        lengths = self._lengths[:batch_size]
+
+        input_ids = torch.tensor(
+            [[sequence.tokens[-1]] for sequence in self._active],
+            dtype=torch.long,
+            device=self._device,
+        )
+        logits = self._forward(self._model, self._keys, self._values, lengths, input_ids)
+        lengths += 1
+
+        next_tokens = self._sample(logits[:, -1, :], self._active)
+        self._advance(next_tokens)
+
+    def _forward(
+        self,
+        model: GPT2LMHeadModel,
+        keys: List[torch.Tensor],
+        values: List[torch.Tensor],
+        lengths: torch.Tensor,
+        input_ids: torch.Tensor,
+    ) -> torch.Tensor:
+        """Run ``input_ids`` after each row's cached tokens and return their logits.
+
+        Row ``r`` attends to its first ``lengths[r]`` cached positions, and
+        the keys and values of its new tokens are written to the positions
+        that follow. ``lengths`` is not advanced.
+        """
+        batch_size, count = input_ids.shape
+        width = int(lengths.max())
+
+        past_key_values: KeyValues = tuple(
+            (layer_keys[:batch_size, :, :width], layer_values[:batch_size, :, :width])
+            for layer_keys, layer_values in zip(keys, values)
+        )
+
+        # Each row attends to its own cached positions plus the new tokens from ``width`` on
+        positions = self._positions[:width + count].unsqueeze(0)
+        attention_mask = (positions < lengths.unsqueeze(1)) | (positions >= width)
+        columns = lengths.unsqueeze(1) + self._positions[:count].unsqueeze(0)
+
+        outputs = model(
+            input_ids=input_ids,
+            past_key_values=past_key_values,
+            attention_mask=attention_mask.long(),
+            position_ids=columns,
+            use_cache=True,
+        )
+
+        rows = self._positions[:batch_size].unsqueeze(1)
+        for layer, (key, value) in enumerate(outputs.past_key_values):
+            keys[layer][rows, :, columns] = key[:, :, width:].transpose(1, 2)
+            values[layer][rows, :, columns] = value[:, :, width:].transpose(1, 2)
+
+        return outputs.logits
+
+    def _sample(self, logits: torch.Tensor, sequences: List[_Sequence]) -> List[int]:
+        """Apply each row's logits processors and sample its next token."""
+        rows = len(sequences)
+        offset = len(self._active) - rows
+
+        scores = self._processors(
+            logits.float(),
+            [s.tokens for s in sequences],
+            [s.ngrams for s in sequences],
+            self._seen[offset:offset + rows],
+            self._params[offset:offset + rows],
+            self._forms.mask([s.form for s in sequences]),
+        )
+
+        next_tokens = self._draw(scores.softmax(dim=-1), sequences)
+
+        log_probs = logits.float().log_softmax(dim=-1).gather(1, next_tokens.unsqueeze(1))
+        for sequence, log_prob in zip(sequences, log_probs.squeeze(1).tolist()):
+            sequence.log_probability += log_prob
+
+        return next_tokens.tolist()
+
+    def _draw(self, probs: torch.Tensor, sequences: List[_Sequence]) -> torch.Tensor:
+        """Sample one token per row of ``probs``."""
+        next_tokens = torch.multinomial(probs, num_samples=1).squeeze(1)
+
+        # Seeded rows draw from their own generator so results are reproducible
+        for row, sequence in enumerate(sequences):
+            if sequence.generator is not None:
+                next_tokens[row] = torch.multinomial(
+                    probs[row], num_samples=1, generator=sequence.generator
+                )
+
+        return next_tokens
+
+    def _advance(self, next_tokens: List[int]) -> None:
+        """Append sampled tokens to the last sequences and retire finished ones."""
+        offset = len(self._active) - len(next_tokens)
+
+        for row in reversed(range(len(next_tokens))):
+            slot = offset + row
+            if self._append(slot, next_tokens[row]):
+                self._retire(slot)
+
+    def _append(self, slot: int, token: int) -> bool:
+        """Append a token to the sequence in ``slot`` and return whether it is finished."""
+        sequence = self._active[slot]
+
+        sequence.tokens.append(token)
+        sequence.ngrams.append(token)
+        if sequence.form is not None:
+            sequence.form.append(token)
+        self._seen[slot, token] = True
+        if sequence.on_token is not None:
+            try:
+                sequence.on_token(token)
+            except Exception:
+                logger.exception("Token callback failed")
+
+        return (
+            token == self._eos_token_id
+            or len(sequence.tokens) >= sequence.request.max_length
+            or int(self._lengths[slot]) >= self._max_positions
+        )
+
+    def _retire(self, slot: int) -> None:
+        """Resolve a finished sequence and move the last active one into its slot."""
+        sequence = self._active[slot]
+        last = len(self._active) - 1
+
+        if slot != last:
+            length = int(self._lengths[last])
+            for keys, values in zip(self._keys, self._values):
+                keys[slot, :, :length] = keys[last, :, :length]
+                values[slot, :, :length] = values[last, :, :length]
+            self._seen[slot] = self._seen[last]
+            self._lengths[slot] = self._lengths[last]
+            self._params[slot] = self._params[last]
+            self._active[slot] = self._active[last]
+
+        self._active.pop()
+        sequence.resolve()
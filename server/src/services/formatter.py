@@ -2,97 +2,223 @@
 Poem formatting utilities for different poetry styles.
 """
 import re
-from typing import List
+from typing import List, Tuple
 
+from src.services.syllables import syllable_counter
 
-class PoemFormatter:
-    """Handles poem formatting and title generation."""
-
-    @staticmethod
-    def format_free_verse(text: str) -> List[str]:
-        """Format text as free verse poem lines."""
-        lines = re.split(r"[.!?]+|\n+", text)
-        lines = [line.strip() for line in lines if line.strip()]
-        formatted_lines = []
+# A line break, or a run of non-whitespace with the spaces before it
+_PIECES = re.compile(r"\n|[^\S\n]*\S+")
+_SENTENCE_END = re.compile(r"[.!?]+")
+_PARTIAL_WORD = re.compile(r"[^\S\n]*\S*\Z")
 
-        for line in lines:
-            if len(line) > 40:
-                parts = line.split(",")
-                formatted_lines.extend(part.strip() for part in parts if part.strip())
-            else:
-                formatted_lines.append(line)
+TITLE_WORDS = 6
 
-        return formatted_lines
+STOP_WORDS = frozenset({"the", "a", "an", "and", "or", "but", "in", "on", "at", "to"})
 
-    @staticmethod
-    def format_haiku(text: str) -> List[str]:
-        """Format text as haiku (5-7-5 syllable structure)."""
-        words = text.split()
-        lines: List[str] = []
-        current_line: List[str] = []
-        syllable_count = 0
 
-        syllable_targets = [5, 7, 5]
+class PoemFormatter:
+    """Handles poem formatting and title generation."""
 
-        for word in words:
-            if len(lines) >= 3:
-                break
+    HAIKU_SYLLABLES = [5, 7, 5]
 
-            syllables = len(re.findall(r"[aeiou]+", word.lower()))
-            target = syllable_targets[len(lines)] if len(lines) < 3 else 5
+    SONNET_LINES = 14
 
-            if syllable_count + syllables <= target:
-                current_line.append(word)
-                syllable_count += syllables
-            else:
-                if current_line:
-                    lines.append(" ".join(current_line))
-                current_line = [word]
-                syllable_count = syllables
+    SONNET_WORDS = 10
 
-        if current_line and len(lines) < 3:
-            lines.append(" ".join(current_line))
+    # Free verse lines longer than this are split at commas
+    FREE_VERSE_LINE_CHARS = 40
 
-        return lines[:3]
+    @staticmethod
+    def count_syllables(word: str) -> int:
+        """Count the syllables of a word from its pronunciation."""
+        return syllable_counter.count_word(word)
 
     @staticmethod
-    def format_sonnet(text: str) -> List[str]:
-        """Format text as sonnet (14 lines, ~10 words per line)."""
-        words = text.split()
-        lines: List[str] = []
-        current_line: List[str] = []
-        target_line_length = 10
+    def format_free_verse(text: str) -> List[str]:
+        """Format text as free verse poem lines."""
+        return PoemFormatter.format_poem(text, "free_verse")
 
-        for word in words:
-            if len(lines) >= 14:
-                break
+    @staticmethod
+    def format_haiku(text: str) -> List[str]:
+        """Format text as haiku (5-7-5 syllable structure).
 
-            current_line.append(word)
-            if len(current_line) >= target_line_length:
-                lines.append(" ".join(current_line))
-                current_line = []
+        Text already broken into three lines, as structure-aware decoding
+        produces, is kept as is.
+        """
+        return PoemFormatter.format_poem(text, "haiku")
 
-        if current_line and len(lines) < 14:
-            lines.append(" ".join(current_line))
+    @staticmethod
+    def format_sonnet(text: str) -> List[str]:
+        """Format text as sonnet (14 lines, ~10 words per line).
 
-        return lines[:14]
+        Text already broken into 14 lines is kept as is.
+        """
+        return PoemFormatter.format_poem(text, "sonnet")
 
     @staticmethod
     def generate_title(poem_text: str) -> str:
         """Generate a title from the first key words of the poem."""
-        words = poem_text.split()[:6]
-        stop_words = {"the", "a", "an", "and", "or", "but", "in", "on", "at", "to"}
-        key_words = [word for word in words if word.lower() not in stop_words]
+        stream = PoemStream("free_verse")
+        stream.feed(poem_text)
+        return stream.finish()[0]
 
-        if key_words:
-            return " ".join(key_words[:3]).capitalize()
-        return "Untitled"
+    @classmethod
+    def structure_score(cls, lines: List[str], style: str) -> float:
+        """Score from 0 to 1 how well formatted lines fit the style's form.
+
+        Haiku are scored on their 5-7-5 syllable counts and sonnets on
+        reaching 14 lines. Free verse has no form and always scores 1.
+        """
+        if style == "haiku":
+            misses = [
+                abs(syllable_counter.count_text(line) - target) / target
+                for line, target in zip(lines + [""] * 3, cls.HAIKU_SYLLABLES)
+            ]
+            return max(0.0, 1 - sum(misses) / len(misses))
+        elif style == "sonnet":
+            return min(len(lines), cls.SONNET_LINES) / cls.SONNET_LINES
+        return 1.0
 
     @classmethod
     def format_poem(cls, text: str, style: str) -> List[str]:
         """Format poem based on style."""
-        if style == "haiku":
-            return cls.format_haiku(text)
-        elif style == "sonnet":
-            return cls.format_sonnet(text)
-        return cls.format_free_verse(text)
+        stream = PoemStream(style)
+        stream.feed(text)
+        return stream.finish()[1]
+
+
+class PoemStream:
+    """Formats a poem and picks its title in one pass over text fed in pieces.
+
+    Text can be fed as it is generated; only a trailing partial word is
+    held back between calls. Free verse ends a line at sentence punctuation
+    and line breaks, splitting long lines at commas. Haiku are packed into
+    5-7-5 syllable lines and sonnets into 14 lines of 10 words, unless the
+    text already has exactly that many lines, as structure-aware decoding
+    produces. The title is the first three key words among the first six.
+    """
+
+    def __init__(self, style: str) -> None:
+        self._style = style
+        self._pending = ""
+        self._title_words: List[str] = []
+        self._words_seen = 0
+
+        # Lines as broken in the text itself
+        self._broken: List[str] = []
+        self._broken_line: List[str] = []
+
+        # Lines as packed by the style
+        self._lines: List[str] = []
+        self._line: List[str] = []
+        self._syllables = 0
+
+    def feed(self, text: str) -> None:
+        """Consume the next piece of text."""
+        text = self._pending + text
+        # A word running to the end of the text may continue in the next piece
+        end = _PARTIAL_WORD.search(text).start()
+
+        for match in _PIECES.finditer(text, 0, end):
+            self._piece(match.group())
+        self._pending = text[end:]
+
+    def finish(self) -> Tuple[str, List[str]]:
+        """Consume any held back text and return the title and lines."""
+        for match in _PIECES.finditer(self._pending):
+            self._piece(match.group())
+        self._pending = ""
+        self._break()
+
+        title = " ".join(self._title_words[:3]).capitalize() or "Untitled"
+
+        if self._style == "haiku":
+            if len(self._broken) == len(PoemFormatter.HAIKU_SYLLABLES):
+                return title, self._broken
+            lines = self._lines
+            if self._line and len(lines) < len(PoemFormatter.HAIKU_SYLLABLES):
+                lines = lines + [" ".join(self._line)]
+            return title, lines[:len(PoemFormatter.HAIKU_SYLLABLES)]
+
+        if self._style == "sonnet":
+            if len(self._broken) == PoemFormatter.SONNET_LINES:
+                return title, self._broken
+            lines = self._lines
+            if self._line and len(lines) < PoemFormatter.SONNET_LINES:
+                lines = lines + [" ".join(self._line)]
+            return title, lines[:PoemFormatter.SONNET_LINES]
+
+        return title, self._lines
+
+    def _piece(self, piece: str) -> None:
+        """Handle a line break or a word with the spaces before it."""
+        if piece == "\n":
+            self._break()
+            return
+
+        word = piece.lstrip()
+        if self._words_seen < TITLE_WORDS:
+            self._words_seen += 1
+            if word.lower() not in STOP_WORDS:
+                self._title_words.append(word)
+
+        if self._style == "haiku":
+            self._haiku_word(word)
+        elif self._style == "sonnet":
+            self._sonnet_word(word)
+        else:
+            # Free verse keeps the spacing inside its lines
+            self._free_verse_word(piece)
+
+    def _break(self) -> None:
+        """End the current line of the text."""
+        if self._broken_line:
+            self._broken.append(" ".join(self._broken_line))
+            self._broken_line = []
+        if self._style not in ("haiku", "sonnet"):
+            self._end_free_verse_line()
+
+    def _haiku_word(self, word: str) -> None:
+        """Add a word to the haiku line its syllables fit in."""
+        self._broken_line.append(word)
+        targets = PoemFormatter.HAIKU_SYLLABLES
+        if len(self._lines) >= len(targets):
+            return
+
+        syllables = syllable_counter.count_word(word)
+        if self._syllables + syllables <= targets[len(self._lines)]:
+            self._line.append(word)
+            self._syllables += syllables
+        else:
+            if self._line:
+                self._lines.append(" ".join(self._line))
+            self._line = [word]
+            self._syllables = syllables
+
+    def _sonnet_word(self, word: str) -> None:
+        """Add a word to the current sonnet line, ending it once it is full."""
+        self._broken_line.append(word)
+        if len(self._lines) >= PoemFormatter.SONNET_LINES:
+            return
+
+        self._line.append(word)
+        if len(self._line) >= PoemFormatter.SONNET_WORDS:
+            self._lines.append(" ".join(self._line))
+            self._line = []
+
+    def _free_verse_word(self, word: str) -> None:
+        """Add a word to the current line, ending the line at sentence punctuation."""
+        for index, part in enumerate(_SENTENCE_END.split(word)):
+            if index:
+                self._end_free_verse_line()
+            if part:
+                self._line.append(part)
+
+    def _end_free_verse_line(self) -> None:
+        """Emit the current line, split at commas if it is too long."""
+        line = "".join(self._line).strip()
+        self._line = []
+        if len(line) > PoemFormatter.FREE_VERSE_LINE_CHARS:
+            self._lines.extend(part.strip() for part in line.split(",") if part.strip())
+        elif line:
+            self._lines.append(line)
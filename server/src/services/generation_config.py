@@ -0,0 +1,63 @@
+"""
+Generation constants compiled once per process for the decode engine.
+"""
+
+from dataclasses import dataclass
+from typing import List, Sequence, Tuple
+
+import torch
+from transformers import PreTrainedTokenizerBase
+
+from src.services.constraints import FormConstraints
+from src.services.sampling import LogitsProcessorChain
+
+
+@dataclass(frozen=True)
+class GenerationConfig:
+    """Resolved device, special tokens, logits processors and form constraints."""
+
+    device: torch.device
+    eos_token_id: int
+    processors: LogitsProcessorChain
+    forms: FormConstraints
+
+
+def bad_word_variants(
+    tokenizer: PreTrainedTokenizerBase, words: Sequence[str]
+) -> List[Tuple[int, ...]]:
+    """Token sequences of each word as it can appear in generated text.
+
+    GPT-2 encodes a word differently at the start of a line, after a space
+    and when capitalized, so every combination is banned separately.
+    """
+    variants = set()
+    for word in words:
+        for form in {word, word.capitalize(), word.upper()}:
+            for text in (form, " " + form):
+                variants.add(tuple(tokenizer.encode(text)))
+    return sorted(variants)
+
+
+def compile_generation_config(
+    tokenizer: PreTrainedTokenizerBase,
+    vocab_size: int,
+    device: torch.device,
+    bad_words: Sequence[str],
+    min_length: int,
+    no_repeat_ngram_size: int,
+) -> GenerationConfig:
+    """Tokenize bad words and build the logits processors and form masks for a loaded model."""
+    processors = LogitsProcessorChain(
+        vocab_size=vocab_size,
+        eos_token_id=tokenizer.eos_token_id,
+        min_length=min_length,
+        no_repeat_ngram_size=no_repeat_ngram_size,
+        bad_words_ids=bad_word_variants(tokenizer, bad_words),
+        device=device,
+    )
+    forms = FormConstraints(
+        tokenizer, vocab_size=vocab_size, eos_token_id=tokenizer.eos_token_id, device=device
+    )
+    return GenerationConfig(
+        device=device, eos_token_id=tokenizer.eos_token_id, processors=processors, forms=forms
+    )
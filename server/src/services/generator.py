@@ -1,113 +1,490 @@
 """
 Poetry generation orchestration service.
 """
+import asyncio
+import logging
+import time
 from datetime import datetime
-from typing import Any, Dict
-
-import torch
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple, Union
 
 from src.config.settings import get_settings
-from src.models.schemas import GenerateRequest
-from src.services.formatter import PoemFormatter
+from src.models.schemas import (
+    CandidatePoem,
+    GenerateRequest,
+    GenerateResponse,
+    GenerationMetadata,
+    GenerationParameters,
+    PoemData,
+)
+from src.services.cache import response_cache
+from src.services.engine import PRIORITY_BULK, PRIORITY_INTERACTIVE, DecodeRequest, DecodeResult
+from src.services.formatter import PoemFormatter, PoemStream
+from src.services.metrics import (
+    DECODE_TOKENS_PER_SECOND,
+    DEGRADED_REQUESTS,
+    LOAD_SHED,
+    REQUEST_SECONDS,
+    STAGE_SECONDS,
+    TOKENS_GENERATED,
+    stage,
+)
 from src.services.model_manager import model_manager
+from src.services.structured_logging import bind
+
+logger = logging.getLogger(__name__)
+
+# Checks whether the client that sent a request has gone away
+DisconnectCheck = Callable[[], Awaitable[bool]]
+
+
+class ClientDisconnectedError(Exception):
+    """Raised when a client went away before inference for its request started."""
+
+
+class _IncrementalDecoder:
+    """Turns generated tokens into text deltas, decoding a short window per token.
+
+    Each delta is decoded together with the tokens of the previous one, so
+    pieces that merge with the text before them come out as in the full
+    text. A delta ending in a partial multi-byte character is held back
+    until the character is complete.
+    """
+
+    def __init__(self, tokenizer: Any) -> None:
+        self._tokenizer = tokenizer
+        self._tokens: List[int] = []
+        self._prefix_offset = 0
+        self._read_offset = 0
+
+    def push(self, token: int) -> str:
+        """Add a token and return the text it completes, possibly empty."""
+        self._tokens.append(token)
+        return self._delta(hold_partial=True)
+
+    def flush(self) -> str:
+        """Return any text still held back."""
+        return self._delta(hold_partial=False)
+
+    def _delta(self, hold_partial: bool) -> str:
+        prefix = self._decode(self._tokens[self._prefix_offset:self._read_offset])
+        text = self._decode(self._tokens[self._prefix_offset:])
+        if len(text) <= len(prefix) or (hold_partial and text.endswith("\ufffd")):
+            return ""
+
+        self._prefix_offset = self._read_offset
+        self._read_offset = len(self._tokens)
+        return text[len(prefix):]
+
+    def _decode(self, tokens: List[int]) -> str:
+        return self._tokenizer.decode(tokens, skip_special_tokens=True)
 
 
 class PoetryGenerator:
     """Orchestrates poem generation using the model manager and formatter."""
 
+    # Haiku and sonnets stop once their form is complete, so max_length is only a ceiling
     STYLE_PARAMS = {
-        "haiku": {"max_length": 50, "repetition_penalty": 1.3},
-        "sonnet": {"max_length": 200, "repetition_penalty": 1.2},
+        "haiku": {"max_length": 80, "repetition_penalty": 1.3},
+        "sonnet": {"max_length": 320, "repetition_penalty": 1.2},
     }
 
-    BAD_WORDS = ["http", "www", "com", ":", "/", "#"]
-
     def __init__(self) -> None:
         self._formatter = PoemFormatter()
 
-    async def generate(self, request: GenerateRequest) -> Dict[str, Any]:
-        """Generate a poem based on the request parameters."""
-        await model_manager.acquire()
+    async def generate(
+        self,
+        request: GenerateRequest,
+        bulk: bool = False,
+        is_disconnected: Optional[DisconnectCheck] = None,
+    ) -> GenerateResponse:
+        """Generate a poem based on the request parameters.
 
+        Bulk requests are decoded at a lower priority than interactive ones
+        and are exempt from admission control. Interactive requests may be
+        shed for their deadline, dropped if ``is_disconnected`` reports the
+        client gone once they get a slot, or have their length capped when
+        the queue is under pressure.
+        """
+        bind(style=request.style, model=request.model or get_settings().default_model)
+        start = time.perf_counter()
+        cache_key = self._cache_key(request)
+        if cache_key is not None:
+            cached = await self._cache_get(cache_key)
+            if cached is not None:
+                return cached
+
+        deadline = None if bulk else self._deadline(request)
+        max_length_cap = None if bulk else self._degraded_max_length(request)
+        with stage("queue_wait", request.style):
+            await model_manager.acquire(bulk, deadline)
+
+        admitted = time.perf_counter()
         try:
-            inputs = self._prepare_inputs(request.prompt)
-            outputs = self._run_inference(inputs, request)
-            return self._process_outputs(outputs, request)
+            await self._check_connected(is_disconnected)
+            with stage("tokenize", request.style):
+                inputs = self._prepare_inputs(request.prompt)
+            candidates = await self._run_candidates(inputs, request, bulk, max_length_cap)
+            for decoded in candidates:
+                self._record_decode(decoded, len(inputs), request.style)
+            with stage("format", request.style):
+                result = self._rank_candidates(candidates, len(inputs), request, max_length_cap)
+            if not bulk:
+                model_manager.record_service(time.perf_counter() - admitted)
 
         finally:
-            model_manager.release()
+            model_manager.release(bulk)
 
-    def _prepare_inputs(self, prompt: str) -> torch.Tensor:
-        """Tokenize and prepare prompt for inference."""
-        settings = get_settings()
-        poetry_prompt = f"Write a poem about: {prompt}\n\nPoem:"
-        tokens = model_manager.tokenizer.encode(poetry_prompt, return_tensors="pt")
-        return tokens.to(settings.device)
+        # Degraded poems are not what the request would normally produce
+        if cache_key is not None and max_length_cap is None:
+            await self._cache_set(cache_key, result)
 
-    def _run_inference(self, inputs: torch.Tensor, request: GenerateRequest) -> torch.Tensor:
-        """Execute model inference with appropriate parameters."""
-        settings = get_settings()
-        tokenizer = model_manager.tokenizer
+        REQUEST_SECONDS.labels(style=request.style).observe(time.perf_counter() - start)
+        return result
 
-        style_config = self.STYLE_PARAMS.get(request.style, {})
-        max_length = style_config.get("max_length", request.max_length)
-        repetition_penalty = style_config.get("repetition_penalty", request.repetition_penalty)
-
-        attention_mask = torch.ones(inputs.shape, dtype=torch.long, device=settings.device)
-
-        bad_words_ids = [[tokenizer.encode(word)[0]] for word in self.BAD_WORDS]
-
-        with torch.no_grad():
-            return model_manager.model.generate(
-                inputs,
-                attention_mask=attention_mask,
-                max_length=max_length,
-                num_return_sequences=1,
-                temperature=request.temperature,
-                top_k=request.top_k,
-                top_p=request.top_p,
-                repetition_penalty=repetition_penalty,
-                do_sample=True,
-                pad_token_id=tokenizer.eos_token_id,
-                use_cache=True,
-                no_repeat_ngram_size=3,
-                early_stopping=True,
-                bad_words_ids=bad_words_ids,
-                min_length=20,
+    async def generate_stream(
+        self, request: GenerateRequest, is_disconnected: Optional[DisconnectCheck] = None
+    ) -> AsyncIterator[Tuple[str, Union[Dict[str, Any], GenerateResponse]]]:
+        """Generate a poem, yielding ``(event, data)`` pairs as tokens are decoded.
+
+        Emits ``token`` events with the text as tokens complete it, then a
+        single ``poem`` event with the formatted result. Closing the
+        iterator early cancels the decode. Cached results, and requests for
+        several candidates, are sent as a single ``poem`` event. Admission
+        control applies as for ``generate``.
+        """
+        if request.num_candidates > 1:
+            yield "poem", await self.generate(request, is_disconnected=is_disconnected)
+            return
+
+        bind(style=request.style, model=request.model or get_settings().default_model)
+        start = time.perf_counter()
+        cache_key = self._cache_key(request)
+        if cache_key is not None:
+            cached = await self._cache_get(cache_key)
+            if cached is not None:
+                yield "poem", cached
+                return
+
+        max_length_cap = self._degraded_max_length(request)
+        with stage("queue_wait", request.style):
+            await model_manager.acquire(deadline=self._deadline(request))
+
+        admitted = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        tokens: asyncio.Queue = asyncio.Queue()
+        inference: Optional[asyncio.Task] = None
+
+        try:
+            await self._check_connected(is_disconnected)
+            with stage("tokenize", request.style):
+                inputs = self._prepare_inputs(request.prompt)
+            inference = asyncio.create_task(
+                self._run_inference(
+                    inputs,
+                    request,
+                    on_token=lambda token: loop.call_soon_threadsafe(tokens.put_nowait, token),
+                    max_length_cap=max_length_cap,
+                )
             )
+            # Queued after every token callback, so it marks the end of the stream
+            inference.add_done_callback(lambda _: tokens.put_nowait(None))
 
-    def _process_outputs(self, outputs: torch.Tensor, request: GenerateRequest) -> Dict[str, Any]:
-        """Decode and format the generated poem."""
+            # The poem is formatted from the same text deltas the client receives
+            poem_stream = PoemStream(request.style)
+            decoder = _IncrementalDecoder(model_manager.tokenizer)
+            while (token := await tokens.get()) is not None:
+                delta = decoder.push(token)
+                if delta:
+                    poem_stream.feed(delta)
+                    yield "token", {"text": delta}
+
+            decoded = await inference
+            model_manager.record_service(time.perf_counter() - admitted)
+            self._record_decode(decoded, len(inputs), request.style)
+            with stage("format", request.style):
+                poem_stream.feed(decoder.flush())
+                result = self._build_result(
+                    self._finish_poem(poem_stream, request),
+                    request,
+                    len(decoded.tokens) - len(inputs),
+                    max_length_cap,
+                )
+            if cache_key is not None and max_length_cap is None:
+                await self._cache_set(cache_key, result)
+            REQUEST_SECONDS.labels(style=request.style).observe(time.perf_counter() - start)
+            yield "poem", result
+
+        finally:
+            if inference is not None and not inference.done():
+                inference.cancel()
+            model_manager.release()
+
+    def _record_decode(self, decoded: DecodeResult, prompt_length: int, style: str) -> None:
+        """Record engine timings and token throughput of a finished decode."""
+        generated = len(decoded.tokens) - prompt_length
+
+        STAGE_SECONDS.labels(stage="batch_wait", style=style).observe(decoded.queued_seconds)
+        STAGE_SECONDS.labels(stage="prefill", style=style).observe(decoded.prefill_seconds)
+        STAGE_SECONDS.labels(stage="decode", style=style).observe(decoded.decode_seconds)
+        TOKENS_GENERATED.labels(style=style).inc(generated)
+        if decoded.decode_seconds > 0:
+            DECODE_TOKENS_PER_SECOND.labels(style=style).observe(
+                (generated - 1) / decoded.decode_seconds
+            )
+
+        logger.info(
+            "Decoded %d tokens",
+            generated,
+            extra={
+                "sampled": True,
+                "prompt_tokens": prompt_length,
+                "generated_tokens": generated,
+                "stages": {
+                    "batch_wait": decoded.queued_seconds,
+                    "prefill": decoded.prefill_seconds,
+                    "decode": decoded.decode_seconds,
+                },
+            },
+        )
+
+    async def _check_connected(self, is_disconnected: Optional[DisconnectCheck]) -> None:
+        """Raise ClientDisconnectedError if the client has already gone away."""
+        if is_disconnected is not None and await is_disconnected():
+            LOAD_SHED.labels(reason="disconnected").inc()
+            raise ClientDisconnectedError()
+
+    def _deadline(self, request: GenerateRequest) -> Optional[float]:
+        """Monotonic time the request must finish by, if it has a timeout."""
+        timeout = request.timeout_seconds or get_settings().admission_timeout_seconds
+        if timeout is None:
+            return None
+        return time.monotonic() + timeout
+
+    def _degraded_max_length(self, request: GenerateRequest) -> Optional[int]:
+        """The max_length cap to decode with under queue pressure, or None for no cap."""
         settings = get_settings()
-        tokenizer = model_manager.tokenizer
+        if not model_manager.under_pressure:
+            return None
 
-        raw_text = tokenizer.decode(outputs[0], skip_special_tokens=True)
+        if self._generation_params(request)["max_length"] <= settings.admission_degraded_max_length:
+            return None
 
-        prompt_pattern = f"Write a poem about: {request.prompt}\n\nPoem:"
-        poem_text = raw_text.replace(prompt_pattern, "").strip()
+        DEGRADED_REQUESTS.labels(style=request.style).inc()
+        return settings.admission_degraded_max_length
 
-        formatted_lines = self._formatter.format_poem(poem_text, request.style)
+    def request_cost(self, request: GenerateRequest) -> float:
+        """Rate limit cost of a request, relative to one poem of the default length."""
+        max_length = self._generation_params(request)["max_length"]
+        return max_length / get_settings().default_max_length * request.num_candidates
 
-        return {
-            "poem": {
-                "title": self._formatter.generate_title(poem_text),
-                "lines": formatted_lines,
+    def _seed(self, request: GenerateRequest) -> Optional[int]:
+        """Resolve the sampling seed; seeded requests are deterministic."""
+        if request.seed is not None:
+            return request.seed
+        return get_settings().deterministic_seed
+
+    def _cache_key(self, request: GenerateRequest) -> Optional[str]:
+        """Build the response cache key, or None if the request is not cacheable."""
+        seed = self._seed(request)
+        if response_cache is None or seed is None:
+            return None
+
+        return response_cache.make_key(
+            {
+                "model": model_manager.version(request.model).checkpoint_id,
+                "prompt": request.prompt,
                 "style": request.style,
-            },
-            "original_prompt": request.prompt,
-            "parameters": {
-                "max_length": request.max_length,
-                "temperature": request.temperature,
-                "top_k": request.top_k,
-                "top_p": request.top_p,
-                "repetition_penalty": request.repetition_penalty,
-            },
-            "metadata": {
-                "device": settings.device.type,
-                "model_type": "GPT2",
-                "timestamp": datetime.now().isoformat(),
-            },
+                "seed": seed,
+                "num_candidates": request.num_candidates,
+                "return_candidates": request.return_candidates,
+                **self._generation_params(request),
+            }
+        )
+
+    async def _cache_get(self, key: str) -> Optional[GenerateResponse]:
+        """Look up a cached result and mark it as served from cache."""
+        if response_cache.blocking:
+            encoded = await asyncio.to_thread(response_cache.get, key)
+        else:
+            encoded = response_cache.get(key)
+
+        if encoded is None:
+            return None
+        result = GenerateResponse.model_validate_json(encoded)
+        result.metadata.cached = True
+        return result
+
+    async def _cache_set(self, key: str, result: GenerateResponse) -> None:
+        """Store a freshly generated result."""
+        encoded = result.model_dump_json()
+        if response_cache.blocking:
+            await asyncio.to_thread(response_cache.set, key, encoded)
+        else:
+            response_cache.set(key, encoded)
+
+    def _prepare_inputs(self, prompt: str) -> List[int]:
+        """Tokenize and prepare prompt for inference."""
+        poetry_prompt = model_manager.format_prompt(prompt)
+        return model_manager.tokenizer.encode(poetry_prompt)
+
+    def _generation_params(
+        self, request: GenerateRequest, max_length_cap: Optional[int] = None
+    ) -> Dict[str, Any]:
+        """Resolve the effective generation parameters.
+
+        Applies style overrides, the default length and the max_length cap
+        of degraded requests.
+        """
+        style_config = self.STYLE_PARAMS.get(request.style, {})
+        max_length = (
+            style_config.get("max_length", request.max_length) or get_settings().default_max_length
+        )
+        if max_length_cap is not None:
+            max_length = min(max_length, max_length_cap)
+
+        return {
+            "max_length": max_length,
+            "temperature": request.temperature,
+            "top_k": request.top_k,
+            "top_p": request.top_p,
+            "repetition_penalty": style_config.get(
+                "repetition_penalty", request.repetition_penalty
+            ),
         }
 
+    async def _run_inference(
+        self,
+        inputs: List[int],
+        request: GenerateRequest,
+        on_token: Optional[Callable[[int], None]] = None,
+        seed: Optional[int] = None,
+        bulk: bool = False,
+        max_length_cap: Optional[int] = None,
+    ) -> DecodeResult:
+        """Execute model inference with appropriate parameters."""
+        params = self._generation_params(request, max_length_cap)
+        if seed is None:
+            seed = self._seed(request)
+
+        return await model_manager.decode(
+            DecodeRequest(
+                input_ids=inputs,
+                max_length=params["max_length"],
+                temperature=params["temperature"],
+                top_k=params["top_k"],
+                top_p=params["top_p"],
+                repetition_penalty=params["repetition_penalty"],
+                seed=seed,
+                priority=PRIORITY_BULK if bulk else PRIORITY_INTERACTIVE,
+                form=request.style,
+            ),
+            on_token=on_token,
+            model=request.model,
+        )
+
+    async def _run_candidates(
+        self,
+        inputs: List[int],
+        request: GenerateRequest,
+        bulk: bool = False,
+        max_length_cap: Optional[int] = None,
+    ) -> List[DecodeResult]:
+        """Decode ``num_candidates`` samples of the prompt together.
+
+        The engine batches the candidates like concurrent requests. Seeded
+        requests give candidate ``i`` the seed ``seed + i``, so the whole
+        set is reproducible.
+        """
+        seed = self._seed(request)
+        decodes = [
+            asyncio.ensure_future(
+                self._run_inference(
+                    inputs,
+                    request,
+                    seed=None if seed is None else (seed + i) % 2**32,
+                    bulk=bulk,
+                    max_length_cap=max_length_cap,
+                )
+            )
+            for i in range(request.num_candidates)
+        ]
+        try:
+            return list(await asyncio.gather(*decodes))
+        finally:
+            for decode in decodes:
+                decode.cancel()
+
+    def _rank_candidates(
+        self,
+        candidates: List[DecodeResult],
+        prompt_length: int,
+        request: GenerateRequest,
+        max_length_cap: Optional[int] = None,
+    ) -> GenerateResponse:
+        """Format every candidate and build the result around the best ranked one.
+
+        Candidates are ranked by mean token log-probability plus, weighted by
+        ``candidate_structure_weight``, how well they fit the style's form.
+        """
+        weight = get_settings().candidate_structure_weight
+
+        ranked = []
+        for decoded in candidates:
+            poem = self._format_poem(decoded.tokens, prompt_length, request)
+            fluency = decoded.log_probability / max(1, len(decoded.tokens) - prompt_length)
+            fit = self._formatter.structure_score(poem.lines, request.style)
+            ranked.append((fluency + weight * fit, poem))
+        ranked.sort(key=lambda candidate: candidate[0], reverse=True)
+
+        generated = sum(len(decoded.tokens) - prompt_length for decoded in candidates)
+        result = self._build_result(ranked[0][1], request, generated, max_length_cap)
+        if request.return_candidates > 1:
+            result.candidates = [
+                CandidatePoem(poem=poem, score=score)
+                for score, poem in ranked[:request.return_candidates]
+            ]
+        return result
+
+    def _format_poem(
+        self, outputs: List[int], prompt_length: int, request: GenerateRequest
+    ) -> PoemData:
+        """Decode the tokens generated after the prompt and format them as a titled poem."""
+        poem_stream = PoemStream(request.style)
+        poem_stream.feed(
+            model_manager.tokenizer.decode(outputs[prompt_length:], skip_special_tokens=True)
+        )
+        return self._finish_poem(poem_stream, request)
+
+    def _finish_poem(self, poem_stream: PoemStream, request: GenerateRequest) -> PoemData:
+        """Build the titled poem from a stream that has been fed all of its text."""
+        title, lines = poem_stream.finish()
+        return PoemData(title=title, lines=lines, style=request.style)
+
+    def _build_result(
+        self,
+        poem: PoemData,
+        request: GenerateRequest,
+        generated_tokens: int,
+        max_length_cap: Optional[int] = None,
+    ) -> GenerateResponse:
+        """Wrap a formatted poem with the parameters it was generated with and metadata.
+
+        ``generated_tokens`` counts the tokens decoded for every candidate.
+        """
+        settings = get_settings()
+
+        return GenerateResponse(
+            poem=poem,
+            original_prompt=request.prompt,
+            parameters=GenerationParameters(**self._generation_params(request, max_length_cap)),
+            metadata=GenerationMetadata(
+                device=settings.device.type,
+                model=request.model or settings.default_model,
+                timestamp=datetime.now(),
+                generated_tokens=generated_tokens,
+                degraded=max_length_cap is not None,
+            ),
+        )
+
 
 poetry_generator = PoetryGenerator()
@@ -0,0 +1,172 @@
+"""
+Bulk poem generation for batches and asynchronous jobs.
+"""
+
+import asyncio
+import logging
+import time
+import uuid
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+from src.config.settings import get_settings
+from src.models.schemas import GenerateRequest
+from src.services.generator import poetry_generator
+from src.services.model_manager import QueueFullError
+
+logger = logging.getLogger(__name__)
+
+
+async def generate_item(index: int, request: GenerateRequest) -> Dict[str, Any]:
+    """Generate one batch item at bulk priority, reporting failure in the item."""
+    try:
+        return {"index": index, "result": await poetry_generator.generate(request, bulk=True)}
+    except asyncio.CancelledError:
+        raise
+    except Exception:
+        logger.exception("Error generating batch item %d", index)
+        return {"index": index, "error": "An error occurred during poem generation."}
+
+
+async def run_batch(requests: List[GenerateRequest]) -> AsyncIterator[Dict[str, Any]]:
+    """Generate every request and yield the items in request order.
+
+    All items are started at once; the bulk semaphore of the model manager
+    bounds how many are decoded concurrently. Closing the iterator early
+    cancels the items that have not finished.
+    """
+    tasks = [asyncio.ensure_future(generate_item(i, r)) for i, r in enumerate(requests)]
+    try:
+        for task in tasks:
+            yield await task
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+@dataclass
+class BatchJob:
+    """An asynchronous batch and the items finished so far."""
+
+    id: str
+    requests: List[GenerateRequest]
+    created_at: datetime = field(default_factory=datetime.now)
+    status: str = "running"
+    results: List[Optional[Dict[str, Any]]] = field(default_factory=list)
+    completed: int = 0
+    finished_at: Optional[float] = None
+    task: Optional[asyncio.Task] = None
+    changed: asyncio.Condition = field(default_factory=asyncio.Condition)
+
+    def __post_init__(self) -> None:
+        self.results = [None] * len(self.requests)
+
+    @property
+    def finished(self) -> bool:
+        """Whether the job has completed or was cancelled."""
+        return self.status != "running"
+
+    def summary(self) -> Dict[str, Any]:
+        """Job status without results."""
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "total": len(self.requests),
+            "completed": self.completed,
+            "created_at": self.created_at.isoformat(),
+        }
+
+
+class BatchJobManager:
+    """Runs batch jobs in the background and keeps their results for polling.
+
+    Jobs live in memory, so they are lost on restart and visible only to
+    the server process that accepted them. Finished jobs are dropped after
+    ``bulk_job_ttl_seconds``.
+    """
+
+    def __init__(self) -> None:
+        self._jobs: Dict[str, BatchJob] = {}
+
+    def submit(self, requests: List[GenerateRequest]) -> BatchJob:
+        """Start a job, raising QueueFullError when too many jobs are running."""
+        settings = get_settings()
+        self._evict_expired()
+
+        running = sum(1 for job in self._jobs.values() if not job.finished)
+        if running >= settings.bulk_max_jobs:
+            raise QueueFullError(settings.inference_retry_after_seconds)
+
+        job = BatchJob(id=uuid.uuid4().hex, requests=requests)
+        job.task = asyncio.create_task(self._run(job))
+        self._jobs[job.id] = job
+        return job
+
+    def get(self, job_id: str) -> Optional[BatchJob]:
+        """Look up a job that has not expired."""
+        self._evict_expired()
+        return self._jobs.get(job_id)
+
+    def cancel(self, job_id: str) -> Optional[BatchJob]:
+        """Cancel a running job, keeping the items it already finished."""
+        job = self.get(job_id)
+        if job is not None and job.task is not None:
+            job.task.cancel()
+        return job
+
+    async def stream(self, job: BatchJob) -> AsyncIterator[Dict[str, Any]]:
+        """Yield the job's items in order as they finish.
+
+        Items left unfinished by a cancelled job are skipped.
+        """
+        for index in range(len(job.requests)):
+            async with job.changed:
+                await job.changed.wait_for(
+                    lambda: job.results[index] is not None or job.finished
+                )
+            if job.results[index] is not None:
+                yield job.results[index]
+
+    async def shutdown(self) -> None:
+        """Cancel every running job."""
+        tasks = [job.task for job in self._jobs.values() if job.task is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._jobs.clear()
+
+    async def _run(self, job: BatchJob) -> None:
+        """Generate the job's items, recording each as soon as it finishes."""
+        tasks = [asyncio.ensure_future(generate_item(i, r)) for i, r in enumerate(job.requests)]
+        try:
+            for finished in asyncio.as_completed(tasks):
+                item = await finished
+                async with job.changed:
+                    job.results[item["index"]] = item
+                    job.completed += 1
+                    job.changed.notify_all()
+            status = "completed"
+        except asyncio.CancelledError:
+            status = "cancelled"
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        async with job.changed:
+            job.status = status
+            job.finished_at = time.monotonic()
+            job.changed.notify_all()
+
+    def _evict_expired(self) -> None:
+        """Drop finished jobs older than the configured time to live."""
+        cutoff = time.monotonic() - get_settings().bulk_job_ttl_seconds
+        for job_id in [
+            job.id
+            for job in self._jobs.values()
+            if job.finished_at is not None and job.finished_at < cutoff
+        ]:
+            del self._jobs[job_id]
+
+
+job_manager = BatchJobManager()
@@ -0,0 +1,141 @@
+"""
+Prometheus metrics for generation stages, decoding and the inference queue.
+
+Set ``PROMETHEUS_MULTIPROC_DIR`` to an empty directory in process mode so
+metrics recorded by inference worker processes are exported as well.
+"""
+
+import os
+import time
+from contextlib import contextmanager
+from typing import Iterator, Tuple
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+LATENCY_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0
+)
+
+STAGE_SECONDS = Histogram(
+    "poetica_stage_seconds",
+    "Time spent in each stage of generating a poem",
+    ["stage", "style"],
+    buckets=LATENCY_BUCKETS,
+)
+
+REQUEST_SECONDS = Histogram(
+    "poetica_request_seconds",
+    "End-to-end time to generate a poem, excluding cache hits",
+    ["style"],
+    buckets=LATENCY_BUCKETS,
+)
+
+TOKENS_GENERATED = Counter(
+    "poetica_tokens_generated",
+    "Tokens generated by the model",
+    ["style"],
+)
+
+DECODE_TOKENS_PER_SECOND = Histogram(
+    "poetica_decode_tokens_per_second",
+    "Per-request decode throughput after prefill",
+    ["style"],
+    buckets=(5, 10, 25, 50, 100, 250, 500, 1000, 2500),
+)
+
+BATCH_SIZE = Histogram(
+    "poetica_batch_size",
+    "Sequences decoded together in one engine step",
+    buckets=(1, 2, 4, 8, 16, 32, 64),
+)
+
+SPECULATIVE_DRAFT_TOKENS = Counter(
+    "poetica_speculative_draft_tokens",
+    "Tokens proposed by the speculative draft model",
+)
+
+SPECULATIVE_ACCEPTED_TOKENS = Counter(
+    "poetica_speculative_accepted_tokens",
+    "Draft tokens accepted by the main model; divide by draft tokens for the acceptance rate",
+)
+
+LOAD_SHED = Counter(
+    "poetica_load_shed",
+    "Requests rejected or dropped by admission control",
+    ["reason"],
+)
+
+DEGRADED_REQUESTS = Counter(
+    "poetica_degraded_requests",
+    "Requests whose max_length was capped because the queue was under pressure",
+    ["style"],
+)
+
+REQUESTS_IN_FLIGHT = Gauge(
+    "poetica_requests_in_flight",
+    "Requests holding an inference slot",
+    multiprocess_mode="livesum",
+)
+
+QUEUE_DEPTH = Gauge(
+    "poetica_queue_depth",
+    "Requests waiting for an inference slot",
+    multiprocess_mode="livesum",
+)
+
+MODEL_MEMORY_BYTES = Gauge(
+    "poetica_model_memory_bytes",
+    "Parameter and buffer memory of the current version of each model",
+    ["model"],
+    multiprocess_mode="livemax",
+)
+
+MODEL_DECODE_SECONDS = Histogram(
+    "poetica_model_decode_seconds",
+    "Time to decode a request, by model",
+    ["model"],
+    buckets=LATENCY_BUCKETS,
+)
+
+MODEL_RELOADS = Counter(
+    "poetica_model_reloads",
+    "Hot reloads of a model by outcome",
+    ["model", "outcome"],
+)
+
+LOG_RECORDS_DROPPED = Counter(
+    "poetica_log_records_dropped",
+    "Log records dropped because the log writer queue was full",
+)
+
+
+@contextmanager
+def stage(name: str, style: str) -> Iterator[None]:
+    """Record the duration of a block as a generation stage; failures are not recorded."""
+    start = time.perf_counter()
+    yield
+    STAGE_SECONDS.labels(stage=name, style=style).observe(time.perf_counter() - start)
+
+
+def render() -> Tuple[bytes, str]:
+    """Render all metrics in the Prometheus text format with its content type.
+
+    Process resident memory and CPU time are included by the default
+    registry; they are not available when aggregating across processes.
+    """
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -3,149 +3,894 @@ Model lifecycle management for GPT-2 poetry generation.
 """
 
 import asyncio
+import copy
+import functools
+import gc
+import itertools
 import logging
+import math
 import os
-import sys
+import time
+from concurrent.futures import Executor, Future
 from datetime import datetime
-from typing import Optional
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple, TypeVar
 
 import torch
-from transformers import GPT2Config, GPT2LMHeadModel, GPT2Tokenizer
-
-from src.config.settings import get_settings
+import torch.multiprocessing
+from transformers import GPT2Config, GPT2LMHeadModel, GPT2TokenizerFast
+
+from src.config.settings import ModelSpec, get_settings
+from src.services.checkpoint import StateDict, load_state_dict
+from src.services.engine import DecodeEngine, DecodeRequest, DecodeResult
+from src.services.generation_config import GenerationConfig, compile_generation_config
+from src.services.metrics import (
+    LOAD_SHED,
+    MODEL_DECODE_SECONDS,
+    MODEL_MEMORY_BYTES,
+    MODEL_RELOADS,
+    QUEUE_DEPTH,
+    REQUESTS_IN_FLIGHT,
+)
+from src.services.optimization import configure_threads, optimize_for_cpu
+from src.services.speculative import SpeculativeDecodeEngine
+from src.services.structured_logging import log_pipeline
+from src.services.syllables import syllable_counter
+from src.services.worker_pool import WorkerPool
 
 logger = logging.getLogger(__name__)
 
+T = TypeVar("T")
+
+
+class QueueFullError(RuntimeError):
+    """Raised when the inference queue cannot accept more requests."""
+
+    def __init__(self, retry_after: int) -> None:
+        super().__init__("Inference queue is full")
+        self.retry_after = retry_after
+
+
+class DeadlineExceededError(QueueFullError):
+    """Raised when a request cannot finish before its deadline."""
+
+
+class ModelNotFoundError(LookupError):
+    """Raised when a request names a model that is not registered."""
+
+    def __init__(self, name: str) -> None:
+        super().__init__(f"Model not found: {name}")
+        self.name = name
+
+
+def _init_process_worker(
+    name: str, spec: ModelSpec, state_dict: StateDict, worker_ids: Any, log_queue: Any
+) -> None:
+    """Attach to the shared weights and start a decode engine inside a worker process."""
+    log_pipeline.start_worker(log_queue)
+    settings = get_settings()
+
+    with worker_ids.get_lock():
+        index = worker_ids.value
+        worker_ids.value += 1
+
+    threads = settings.inference_worker_threads or max(
+        1, len(_available_cpus()) // _worker_count(settings)
+    )
+    if settings.inference_worker_affinity:
+        cpus = _worker_cpus(index, threads)
+        os.sched_setaffinity(0, cpus)
+        logger.info("Pinned inference worker %d to CPUs %s", index, cpus)
+    configure_threads(threads, settings.torch_interop_threads)
+
+    model_manager.load_tokenizer()
+    version = model_manager.load_version(name, spec, state_dict)
+    model_manager.start_engine(version)
+    model_manager.add_version(version)
+
+
+def _decode_in_worker(name: str, request: DecodeRequest) -> "Future[DecodeResult]":
+    """Queue a request on the engine of the current worker process.
+
+    Returns the engine's future, so the worker takes further requests, which
+    the engine batches with this one, while it is decoded.
+    """
+    return model_manager.version(name).engine.submit(request)
+
+
+def _worker_count(settings) -> int:
+    """Number of inference worker processes per model in process mode."""
+    return settings.inference_workers or settings.max_concurrent_requests
+
+
+def _available_cpus() -> List[int]:
+    """CPUs this process may run on."""
+    return sorted(os.sched_getaffinity(0))
+
+
+def _worker_cpus(index: int, threads: int) -> List[int]:
+    """Pick a contiguous block of CPUs for a worker, wrapping around when oversubscribed."""
+    cpus = _available_cpus()
+    start = index * threads
+    return [cpus[(start + offset) % len(cpus)] for offset in range(threads)]
+
+
+def _memory_bytes(*models: Optional[GPT2LMHeadModel]) -> int:
+    """Bytes of the parameters and buffers of models, counting shared tensors once."""
+    sizes: Dict[int, int] = {}
+    for model in models:
+        if model is None:
+            continue
+        for tensor in itertools.chain(model.parameters(), model.buffers()):
+            sizes[tensor.data_ptr()] = tensor.numel() * tensor.element_size()
+    return sum(sizes.values())
+
+
+class ModelVersion:
+    """One loaded checkpoint of a named model with the engine or workers decoding on it.
+
+    A decode holds on to the version it started on, so a version replaced
+    by a reload keeps serving the requests it has until they are drained.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        number: int,
+        spec: ModelSpec,
+        checkpoint_id: str,
+        model: GPT2LMHeadModel,
+        draft_model: Optional[GPT2LMHeadModel],
+        generation_config: GenerationConfig,
+    ) -> None:
+        self.name = name
+        self.number = number
+        self.spec = spec
+        self.checkpoint_id = checkpoint_id
+        self.model: Optional[GPT2LMHeadModel] = model
+        self.draft_model: Optional[GPT2LMHeadModel] = draft_model
+        self.generation_config = generation_config
+        self.engine: Optional[DecodeEngine] = None
+        self.executor: Optional[Executor] = None
+        self.loaded_at = datetime.now()
+        self.memory_bytes = _memory_bytes(model, draft_model)
+        self.in_flight = 0
+        self.idle = asyncio.Event()
+        self.idle.set()
+        self.last_inference_seconds: Optional[float] = None
+        # Moving average of decode times on this version
+        self.mean_inference_seconds: Optional[float] = None
+
+    def begin(self) -> None:
+        """Count a decode starting on this version."""
+        self.in_flight += 1
+        self.idle.clear()
+
+    def end(self, seconds: Optional[float] = None) -> None:
+        """Count a decode leaving this version, with its duration if it finished."""
+        self.in_flight -= 1
+        if self.in_flight == 0:
+            self.idle.set()
+
+        if seconds is None:
+            return
+        self.last_inference_seconds = seconds
+        if self.mean_inference_seconds is None:
+            self.mean_inference_seconds = seconds
+        else:
+            self.mean_inference_seconds += 0.2 * (seconds - self.mean_inference_seconds)
+        MODEL_DECODE_SECONDS.labels(model=self.name).observe(seconds)
+
+    def stop(self) -> None:
+        """Stop decoding on this version and drop its weights."""
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+        if self.engine is not None:
+            self.engine.stop()
+            self.engine = None
+
+        self.model = None
+        self.draft_model = None
+        gc.collect()
+
 
 class ModelManager:
-    """Manages GPT-2 model loading, optimization, and inference."""
+    """Manages the registry of GPT-2 models, their loading, optimization, and inference.
+
+    Every model is loaded at startup from ``Settings.model_specs`` and can
+    be reloaded at runtime without downtime. All models share the tokenizer
+    and the admission control of interactive and bulk requests.
+    """
+
+    PROMPT_TEMPLATES = {
+        "poem": "Write a poem about: {prompt}\n\nPoem:",
+    }
 
     def __init__(self) -> None:
-        self._model: Optional[GPT2LMHeadModel] = None
-        self._tokenizer: Optional[GPT2Tokenizer] = None
+        self._models: Dict[str, ModelVersion] = {}
+        self._version_numbers: Dict[str, int] = {}
+        self._reloads: Dict[str, asyncio.Task] = {}
+        self._tokenizer: Optional[GPT2TokenizerFast] = None
         self._semaphore: Optional[asyncio.Semaphore] = None
+        self._bulk_semaphore: Optional[asyncio.Semaphore] = None
+        self._templates: Dict[str, str] = dict(self.PROMPT_TEMPLATES)
+        self._waiting: int = 0
+        self._in_flight: int = 0
+        self._last_inference_seconds: Optional[float] = None
+        self._cuda_device_count: int = 0
+        # None until the first self-test has run
+        self._self_test_passed: Optional[bool] = None
+        self._self_test_seconds: Optional[float] = None
+        self._self_test_task: Optional[asyncio.Task] = None
+        # Moving average of how long interactive requests hold a slot
+        self._service_seconds: Optional[float] = None
         self._request_count: int = 0
         self._last_cleanup: datetime = datetime.now()
 
     @property
     def model(self) -> Optional[GPT2LMHeadModel]:
-        """Get the loaded model."""
-        return self._model
+        """Get the current version of the default model."""
+        version = self._models.get(get_settings().default_model)
+        return version.model if version is not None else None
 
     @property
-    def tokenizer(self) -> Optional[GPT2Tokenizer]:
+    def tokenizer(self) -> Optional[GPT2TokenizerFast]:
         """Get the loaded tokenizer."""
         return self._tokenizer
 
+    @property
+    def generation_config(self) -> Optional[GenerationConfig]:
+        """Get the generation constants compiled for the default model."""
+        version = self._models.get(get_settings().default_model)
+        return version.generation_config if version is not None else None
+
+    @property
+    def versions(self) -> List[ModelVersion]:
+        """Get the current version of every registered model."""
+        return list(self._models.values())
+
     @property
     def request_count(self) -> int:
         """Get total request count."""
         return self._request_count
 
+    @property
+    def queue_depth(self) -> int:
+        """Get number of requests waiting for an inference slot."""
+        return self._waiting
+
+    @property
+    def in_flight(self) -> int:
+        """Get number of requests holding an inference slot."""
+        return self._in_flight
+
+    @property
+    def last_inference_seconds(self) -> Optional[float]:
+        """Get how long the most recent decode took."""
+        return self._last_inference_seconds
+
+    @property
+    def cuda_device_count(self) -> int:
+        """Get number of CUDA devices, as found at initialization."""
+        return self._cuda_device_count
+
+    @property
+    def self_test_passed(self) -> Optional[bool]:
+        """Whether the last self-test decode met its SLO, or None if none has run."""
+        return self._self_test_passed
+
+    @property
+    def self_test_seconds(self) -> Optional[float]:
+        """Get how long the last self-test decode took."""
+        return self._self_test_seconds
+
+    @property
+    def under_pressure(self) -> bool:
+        """Whether the estimated queue wait calls for degraded generation."""
+        threshold = get_settings().admission_degrade_wait_seconds
+        return threshold is not None and self.estimated_wait() >= threshold
+
     @property
     def is_ready(self) -> bool:
-        """Check if model and tokenizer are loaded."""
-        return self._model is not None and self._tokenizer is not None
+        """Check if the default model and tokenizer are loaded."""
+        return self.model is not None and self._tokenizer is not None
+
+    @property
+    def accepting_traffic(self) -> bool:
+        """Check if the model is loaded and the last self-test did not fail."""
+        return self.is_ready and self._self_test_passed is not False
+
+    @property
+    def model_names(self) -> Set[str]:
+        """Names of the registered models and of those being added by a reload."""
+        return set(self._models) | set(self._reloads)
+
+    def has_model(self, name: Optional[str]) -> bool:
+        """Check if ``name`` is a registered model; None means the default model."""
+        return (name or get_settings().default_model) in self._models
+
+    def version(self, name: Optional[str] = None) -> ModelVersion:
+        """Get the current version of a model, raising ModelNotFoundError if unknown."""
+        name = name or get_settings().default_model
+        try:
+            return self._models[name]
+        except KeyError:
+            raise ModelNotFoundError(name) from None
+
+    def is_reloading(self, name: str) -> bool:
+        """Check if a new version of a model is being loaded."""
+        task = self._reloads.get(name)
+        return task is not None and not task.done()
 
     async def initialize(self) -> bool:
-        """Initialize model and tokenizer."""
+        """Initialize the tokenizer and every configured model.
+
+        In process mode this returns once every worker process has loaded
+        its model, so the first self-test measures decoding, not startup.
+        """
         settings = get_settings()
 
-        self._setup_logging()
         self._semaphore = asyncio.Semaphore(settings.max_concurrent_requests)
+        self._bulk_semaphore = asyncio.Semaphore(settings.bulk_concurrency)
+        self._cuda_device_count = torch.cuda.device_count() if torch.cuda.is_available() else 0
 
         logger.info("Initializing model on device: %s", settings.device)
 
-        self._tokenizer = self._load_tokenizer()
-        self._model = self._load_model(settings)
-
-        if settings.device.type == "cuda":
-            self._optimize_for_cuda()
-
-        self._warmup()
+        if settings.inference_executor == "thread":
+            configure_threads(settings.torch_num_threads, settings.torch_interop_threads)
+        self.load_tokenizer()
+        for name, spec in settings.model_specs.items():
+            self.add_version(self._build_version(name, spec))
+        if not self.has_model(settings.default_model):
+            raise ModelNotFoundError(settings.default_model)
+        await asyncio.gather(*(self._wait_ready(version) for version in self.versions))
 
         logger.info("Model and tokenizer loaded successfully")
+
+        await self.self_test()
+        if settings.health_self_test_interval_seconds is not None:
+            self._self_test_task = asyncio.create_task(
+                self._run_self_tests(settings.health_self_test_interval_seconds)
+            )
         return True
 
-    def _setup_logging(self) -> None:
-        """Configure logging for the application."""
-        logging.basicConfig(
-            level=logging.INFO,
-            format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-            handlers=[logging.StreamHandler(sys.stdout)],
+    async def self_test(self) -> bool:
+        """Decode a few tokens with every model and check they meet the latency SLO.
+
+        The decodes queue behind real traffic without taking a request slot,
+        so a saturated or stalled pool fails the test and ``/readyz``
+        reports the replica not ready until a later test passes.
+        """
+        results = [await self._test_version(version) for version in self.versions]
+        passed = all(ok for ok, _ in results)
+
+        self._self_test_seconds = max(seconds for _, seconds in results)
+        if passed and self._self_test_passed is False:
+            logger.info("Self-test decode recovered, accepting traffic again")
+        self._self_test_passed = passed
+        return passed
+
+    async def _test_version(self, version: ModelVersion) -> Tuple[bool, float]:
+        """Run the self-test decode on one version; returns whether it passed and its time."""
+        settings = get_settings()
+        inputs = self._tokenizer.encode(self.format_prompt("self test"))
+        request = DecodeRequest(
+            input_ids=inputs,
+            max_length=len(inputs) + settings.health_self_test_tokens,
+            temperature=1.0,
+            top_k=1,
+            top_p=1.0,
+            repetition_penalty=1.0,
+            seed=0,
         )
 
-        # Use /tmp/logs for writable directory in Docker container
-        log_dir = "/tmp/logs"
+        start = time.perf_counter()
         try:
-            os.makedirs(log_dir, exist_ok=True)
-            file_handler = logging.FileHandler(
-                os.path.join(
-                    log_dir,
-                    f"poetry_generation_{datetime.now().strftime('%Y%m%d')}.log",
-                )
+            await asyncio.wait_for(
+                self._decode_on(version, request), settings.health_self_test_slo_seconds
             )
-            file_handler.setFormatter(
-                logging.Formatter(
-                    "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
-                )
+            passed = True
+        except asyncio.TimeoutError:
+            logger.warning(
+                "Self-test decode on %s exceeded its %.1fs SLO",
+                version.name,
+                settings.health_self_test_slo_seconds,
             )
-            logger.addHandler(file_handler)
-        except Exception as e:
+            passed = False
+        except Exception:
+            logger.exception("Self-test decode on %s failed", version.name)
+            passed = False
+
+        return passed, time.perf_counter() - start
+
+    async def _run_self_tests(self, interval: float) -> None:
+        """Repeat the self-test every ``interval`` seconds until shutdown."""
+        while True:
+            await asyncio.sleep(interval)
+            await self.self_test()
+
+    def start_reload(self, name: str, spec: Optional[ModelSpec] = None) -> asyncio.Task:
+        """Reload a model in the background; see ``reload``."""
+        task = asyncio.create_task(self.reload(name, spec))
+        self._reloads[name] = task
+        task.add_done_callback(functools.partial(self._reload_done, name))
+        return task
+
+    def _reload_done(self, name: str, task: asyncio.Task) -> None:
+        """Forget a finished background reload; failures were logged by ``reload``."""
+        if self._reloads.get(name) is task:
+            del self._reloads[name]
+        if not task.cancelled():
+            task.exception()
+
+    async def reload(self, name: str, spec: Optional[ModelSpec] = None) -> ModelVersion:
+        """Load a new version of a model and switch traffic to it without downtime.
+
+        The new version is loaded and warmed up off the event loop, and in
+        process mode its worker processes are waited for; then it must pass
+        the self-test before new requests are sent to it. The previous
+        version finishes its in-flight requests, for up to
+        ``model_drain_timeout_seconds``, and is then stopped and its memory
+        freed. Without ``spec`` the model's checkpoint is read again, e.g.
+        after it was replaced by a retrained one; a spec for a name that is
+        not registered adds a model.
+        """
+        if spec is None:
+            spec = self.version(name).spec
+
+        try:
+            version = await asyncio.to_thread(self._build_version, name, spec)
+            try:
+                await self._wait_ready(version)
+            except Exception:
+                await asyncio.to_thread(version.stop)
+                raise
+            passed, seconds = await self._test_version(version)
+            if not passed:
+                await asyncio.to_thread(version.stop)
+                raise RuntimeError(f"New version of {name} failed its self-test")
+        except Exception:
+            MODEL_RELOADS.labels(model=name, outcome="failed").inc()
+            logger.exception("Reloading model %s failed, keeping the current version", name)
+            raise
+
+        previous = self._models.get(name)
+        self.add_version(version)
+        MODEL_RELOADS.labels(model=name, outcome="succeeded").inc()
+        logger.info(
+            "Switched model %s to version %d (self-test %.2fs)", name, version.number, seconds
+        )
+
+        if previous is not None:
+            await self._retire(previous)
+        return version
+
+    async def _wait_ready(self, version: ModelVersion) -> None:
+        """Wait until the worker processes of a version have loaded the model, if it has any.
+
+        Workers start in the background, so in process mode a version's
+        decodes would otherwise count the startup against the self-test SLO.
+        """
+        if isinstance(version.executor, WorkerPool):
+            await asyncio.wrap_future(version.executor.ready)
+
+    async def _retire(self, version: ModelVersion) -> None:
+        """Wait for a replaced version to drain, then stop it and free its memory."""
+        settings = get_settings()
+        try:
+            await asyncio.wait_for(version.idle.wait(), settings.model_drain_timeout_seconds)
+        except asyncio.TimeoutError:
             logger.warning(
-                f"Could not create log file: {e}. Continuing with console logging only."
+                "Stopping version %d of %s with %d decodes still in flight",
+                version.number,
+                version.name,
+                version.in_flight,
             )
 
-    def _load_tokenizer(self) -> GPT2Tokenizer:
-        """Load and configure GPT-2 tokenizer."""
-        tokenizer = GPT2Tokenizer.from_pretrained("gpt2")
+        await asyncio.to_thread(version.stop)
+        if settings.device.type == "cuda":
+            torch.cuda.empty_cache()
+        logger.info("Retired version %d of model %s", version.number, version.name)
+
+    def add_version(self, version: ModelVersion) -> None:
+        """Send new requests for the version's model to it."""
+        self._models[version.name] = version
+        MODEL_MEMORY_BYTES.labels(model=version.name).set(version.memory_bytes)
+
+    def _build_version(self, name: str, spec: ModelSpec) -> ModelVersion:
+        """Load a new version of a model and start decoding on it, without registering it.
+
+        In process mode the checkpoint is loaded into shared memory and the
+        version gets its own pool of worker processes.
+        """
+        settings = get_settings()
+        self._version_numbers[name] = self._version_numbers.get(name, 0) + 1
+
+        if settings.inference_executor == "process":
+            state_dict = self._load_shared_weights(settings, spec)
+            version = self.load_version(name, spec, state_dict)
+            version.executor = self._create_process_pool(settings, name, spec, state_dict)
+        else:
+            version = self.load_version(name, spec)
+            self.start_engine(version)
+
+        logger.info(
+            "Loaded version %d of model %s from %s (%.1f MiB)",
+            version.number,
+            name,
+            spec.filename,
+            version.memory_bytes / 2**20,
+        )
+        return version
+
+    def load_tokenizer(self) -> None:
+        """Load the tokenizer and syllable dictionary shared by every model."""
+        self._tokenizer = self._load_tokenizer(get_settings())
+        syllable_counter.load()
+
+    def load_version(
+        self, name: str, spec: ModelSpec, state_dict: Optional[StateDict] = None
+    ) -> ModelVersion:
+        """Load, optimize and warm up a model.
+
+        Weights are read from the checkpoint unless ``state_dict`` is given.
+        """
+        settings = get_settings()
+        path = os.path.join(settings.model_dir, spec.filename)
+
+        model = self._load_model(settings, spec, state_dict)
+        draft_model = None
+        if settings.speculative_tokens > 0:
+            draft_model = self._load_draft_model(settings, spec, model)
+        generation_config = compile_generation_config(
+            self._tokenizer,
+            vocab_size=spec.vocab_size,
+            device=settings.device,
+            bad_words=settings.generation_bad_words,
+            min_length=settings.generation_min_length,
+            no_repeat_ngram_size=settings.generation_no_repeat_ngram_size,
+        )
+
+        if settings.device.type == "cuda":
+            self._optimize_for_cuda()
+        else:
+            model = self._optimize_for_cpu(settings, model)
+
+        self._warmup(model)
+
+        # The modification time tells a retrained checkpoint from the one it replaced
+        modified = int(os.path.getmtime(path)) if os.path.exists(path) else 0
+        return ModelVersion(
+            name=name,
+            number=self._version_numbers.get(name, 1),
+            spec=spec,
+            checkpoint_id=f"{name}:{spec.filename}:{modified}",
+            model=model,
+            draft_model=draft_model,
+            generation_config=generation_config,
+        )
+
+    def start_engine(self, version: ModelVersion) -> None:
+        """Start the continuous batching decode engine of a version on its own thread."""
+        settings = get_settings()
+
+        if version.draft_model is not None:
+            version.engine = SpeculativeDecodeEngine(
+                version.model,
+                version.draft_model,
+                version.generation_config,
+                max_batch_size=settings.batch_max_size,
+                max_positions=version.spec.n_positions,
+                speculative_tokens=settings.speculative_tokens,
+                reserved_slots=settings.batch_reserved_slots,
+            )
+        else:
+            version.engine = DecodeEngine(
+                version.model,
+                version.generation_config,
+                max_batch_size=settings.batch_max_size,
+                max_positions=version.spec.n_positions,
+                reserved_slots=settings.batch_reserved_slots,
+            )
+
+        for template in self._templates.values():
+            version.engine.register_prefix(self._template_prefix(template))
+
+        version.engine.start()
+
+    def register_template(self, name: str, template: str) -> None:
+        """Register a prompt template and cache its constant prefix.
+
+        The template must contain a ``{prompt}`` placeholder. In process mode
+        templates should be registered before initialization so every worker
+        process sees them.
+        """
+        self._templates[name] = template
+        for version in self.versions:
+            if version.engine is not None:
+                version.engine.register_prefix(self._template_prefix(template))
+
+    def format_prompt(self, prompt: str, template: str = "poem") -> str:
+        """Render a prompt with a registered template."""
+        return self._templates[template].format(prompt=prompt)
+
+    def _template_prefix(self, template: str) -> List[int]:
+        """Tokenize the constant text in front of a template's placeholder.
+
+        Trailing whitespace is dropped because GPT-2 merges it into the first
+        token of the prompt.
+        """
+        prefix = template.split("{prompt}", 1)[0].rstrip()
+        return self._tokenizer.encode(prefix)
+
+    def _load_shared_weights(self, settings, spec: ModelSpec) -> StateDict:
+        """Load a checkpoint once and move its tensors into shared memory."""
+        path = os.path.join(settings.model_dir, spec.filename)
+        state_dict = load_state_dict(path, settings.device)
+        return {name: tensor.share_memory_() for name, tensor in state_dict.items()}
+
+    def _create_process_pool(
+        self, settings, name: str, spec: ModelSpec, state_dict: StateDict
+    ) -> Executor:
+        """Create a pool of worker processes that run inference off the event loop.
+
+        Every worker process runs its own decode engine, so requests are only
+        batched with others handled by the same process. Workers take new
+        requests while decoding earlier ones, and each request goes to the
+        worker with the fewest in flight. Workers receive the shared weights
+        through torch multiprocessing, which passes handles to the shared
+        memory instead of copying tensors. CPU optimizations that rewrite
+        weights (int8, bf16) still give each worker a private copy.
+        """
+        workers = _worker_count(settings)
+        context = torch.multiprocessing.get_context("spawn")
+
+        logger.info("Starting %d inference worker processes for model %s", workers, name)
+        return WorkerPool(
+            max_workers=workers,
+            mp_context=context,
+            initializer=_init_process_worker,
+            initargs=(
+                name,
+                spec,
+                state_dict,
+                context.Value("i", 0),
+                log_pipeline.worker_queue(context),
+            ),
+        )
+
+    def _load_tokenizer(self, settings) -> GPT2TokenizerFast:
+        """Load and configure the fast GPT-2 tokenizer from local files."""
+        tokenizer = GPT2TokenizerFast.from_pretrained(
+            settings.tokenizer_path, local_files_only=True
+        )
         tokenizer.pad_token = tokenizer.eos_token
         return tokenizer
 
-    def _load_model(self, settings) -> GPT2LMHeadModel:
-        """Load and configure GPT-2 model."""
-        if not os.path.exists(settings.model_path):
-            raise FileNotFoundError(f"Model file not found at {settings.model_path}")
+    def _load_model(
+        self, settings, spec: ModelSpec, state_dict: Optional[StateDict] = None
+    ) -> GPT2LMHeadModel:
+        """Load and configure a GPT-2 model with the architecture of its spec.
+
+        Weights are assigned directly from the memory-mapped checkpoint, or
+        from ``state_dict``, instead of being copied into the freshly
+        initialized parameters.
+        """
+        path = os.path.join(settings.model_dir, spec.filename)
+        if state_dict is None and not os.path.exists(path):
+            raise FileNotFoundError(f"Model file not found at {path}")
 
         config = GPT2Config(
-            n_positions=settings.n_positions,
-            n_ctx=settings.n_ctx,
-            n_embd=settings.n_embd,
-            n_layer=settings.n_layer,
-            n_head=settings.n_head,
-            vocab_size=settings.vocab_size,
+            n_positions=spec.n_positions,
+            n_ctx=spec.n_ctx,
+            n_embd=spec.n_embd,
+            n_layer=spec.n_layer,
+            n_head=spec.n_head,
+            vocab_size=spec.vocab_size,
             bos_token_id=50256,
             eos_token_id=50256,
             use_cache=True,
         )
 
         model = GPT2LMHeadModel(config)
-        state_dict = torch.load(settings.model_path, map_location=settings.device)
-        model.load_state_dict(state_dict, strict=False)
+        if state_dict is None:
+            state_dict = load_state_dict(path, settings.device)
+        model.load_state_dict(state_dict, strict=False, assign=True)
+        # Assigning replaces parameters, so the output projection must be tied again
+        model.tie_weights()
         model.to(settings.device)
         model.eval()
 
         return model
 
+    def _load_draft_model(
+        self, settings, spec: ModelSpec, model: GPT2LMHeadModel
+    ) -> GPT2LMHeadModel:
+        """Load the small draft model used for speculative decoding.
+
+        Uses the distilled draft checkpoint if the spec has one. Otherwise
+        the draft is the main model truncated to its first layers, sharing
+        the embeddings and layer weights with it.
+        """
+        config = copy.deepcopy(model.config)
+        config.n_layer = settings.speculative_draft_layers
+
+        if spec.draft_filename:
+            state_dict = load_state_dict(
+                os.path.join(settings.model_dir, spec.draft_filename),
+                settings.device,
+            )
+        else:
+            # Layers past the draft's depth are ignored as unexpected keys
+            state_dict = model.state_dict()
+
+        draft_model = GPT2LMHeadModel(config)
+        draft_model.load_state_dict(state_dict, strict=False, assign=True)
+        draft_model.tie_weights()
+        draft_model.to(settings.device)
+        draft_model.eval()
+
+        logger.info("Loaded %d-layer speculative draft model", config.n_layer)
+        return draft_model
+
     def _optimize_for_cuda(self) -> None:
         """Apply CUDA-specific optimizations."""
         torch.backends.cudnn.benchmark = True
 
-    def _warmup(self) -> None:
+    def _optimize_for_cpu(self, settings, model: GPT2LMHeadModel) -> GPT2LMHeadModel:
+        """Apply the configured CPU optimizations that pass the quality guard."""
+        return optimize_for_cpu(
+            model,
+            self._tokenizer,
+            modes=settings.cpu_optimizations,
+            max_perplexity_drift=settings.cpu_max_perplexity_drift,
+            device=settings.device,
+        )
+
+    def _warmup(self, model: GPT2LMHeadModel) -> None:
         """Run warmup inference to initialize CUDA kernels."""
         settings = get_settings()
         dummy_input = torch.zeros((1, 1), dtype=torch.long, device=settings.device)
         with torch.no_grad():
-            self._model(dummy_input)
+            model(dummy_input)
+
+    async def acquire(self, bulk: bool = False, deadline: Optional[float] = None) -> None:
+        """Acquire semaphore for concurrent request limiting.
+
+        Raises QueueFullError instead of waiting when the backlog of requests
+        already waiting for a slot has reached the configured queue size.
+        Bulk requests have their own semaphore and wait without a limit,
+        since their backlog is held by the batch or job that sent them.
+
+        ``deadline`` is the ``time.monotonic()`` time by which the request
+        must finish. DeadlineExceededError is raised up front when the
+        estimated wait plus service time already passes it, and while
+        waiting once the request could no longer finish in time.
+        """
+        if bulk:
+            await self._bulk_semaphore.acquire()
+            self._request_count += 1
+            self._in_flight += 1
+            REQUESTS_IN_FLIGHT.inc()
+            return
+
+        self.ensure_capacity()
+
+        timeout = None
+        if deadline is not None:
+            timeout = deadline - time.monotonic() - (self._service_seconds or 0.0)
+            if timeout < self.estimated_wait():
+                self._shed_deadline("deadline")
+
+        self._waiting += 1
+        QUEUE_DEPTH.inc()
+        try:
+            if timeout is None or not self._semaphore.locked():
+                await self._semaphore.acquire()
+            else:
+                await asyncio.wait_for(self._semaphore.acquire(), timeout)
+        except asyncio.TimeoutError:
+            self._shed_deadline("deadline_expired")
+        finally:
+            self._waiting -= 1
+            QUEUE_DEPTH.dec()
 
-    async def acquire(self) -> None:
-        """Acquire semaphore for concurrent request limiting."""
-        await self._semaphore.acquire()
         self._request_count += 1
+        self._in_flight += 1
+        REQUESTS_IN_FLIGHT.inc()
+
+    def ensure_capacity(self) -> None:
+        """Raise QueueFullError if a new request would exceed the queue size."""
+        settings = get_settings()
 
-    def release(self) -> None:
+        if self._semaphore.locked() and self._waiting >= settings.inference_queue_size:
+            LOAD_SHED.labels(reason="queue_full").inc()
+            raise QueueFullError(settings.inference_retry_after_seconds)
+
+    def estimated_wait(self) -> float:
+        """Estimate the seconds a new interactive request would wait for a slot.
+
+        Based on the moving average of recent service times, assuming busy
+        slots are halfway through their request on average.
+        """
+        if self._service_seconds is None or not self._semaphore.locked():
+            return 0.0
+        slots = get_settings().max_concurrent_requests
+        return (self._waiting / slots + 0.5) * self._service_seconds
+
+    def record_service(self, seconds: float) -> None:
+        """Update the service time average with a finished interactive request."""
+        if self._service_seconds is None:
+            self._service_seconds = seconds
+        else:
+            self._service_seconds += 0.2 * (seconds - self._service_seconds)
+
+    def _shed_deadline(self, reason: str) -> None:
+        """Count a request shed for its deadline and raise DeadlineExceededError."""
+        LOAD_SHED.labels(reason=reason).inc()
+        retry_after = max(
+            get_settings().inference_retry_after_seconds, math.ceil(self.estimated_wait())
+        )
+        raise DeadlineExceededError(retry_after)
+
+    async def run_in_executor(self, executor: Executor, func: Callable[..., T], *args: Any) -> T:
+        """Run a blocking inference callable on a model's inference worker pool.
+
+        In process mode the callable and its arguments must be picklable,
+        and a callable returning a future is answered with its result.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, functools.partial(func, *args))
+
+    async def decode(
+        self,
+        request: DecodeRequest,
+        on_token: Optional[Callable[[int], None]] = None,
+        model: Optional[str] = None,
+    ) -> DecodeResult:
+        """Decode a request with a model and return its prompt and generated tokens.
+
+        ``model`` names a registered model, the default one if None.
+        ``on_token`` receives each generated token as it is decoded; it may be
+        called from the engine thread. Worker processes cannot stream, so in
+        process mode the tokens are replayed once the decode has finished.
+        Cancelling the awaiting task cancels the decode.
+        """
+        return await self._decode_on(self.version(model), request, on_token)
+
+    async def _decode_on(
+        self,
+        version: ModelVersion,
+        request: DecodeRequest,
+        on_token: Optional[Callable[[int], None]] = None,
+    ) -> DecodeResult:
+        """Decode a request on a specific version of a model."""
+        start = time.perf_counter()
+        seconds = None
+        version.begin()
+        try:
+            if version.executor is not None:
+                result = await self.run_in_executor(
+                    version.executor, _decode_in_worker, version.name, request
+                )
+                if on_token is not None:
+                    for token in result.tokens[len(request.input_ids):]:
+                        on_token(token)
+            else:
+                result = await asyncio.wrap_future(version.engine.submit(request, on_token))
+            seconds = time.perf_counter() - start
+        finally:
+            version.end(seconds)
+
+        self._last_inference_seconds = seconds
+        return result
+
+    def release(self, bulk: bool = False) -> None:
         """Release semaphore after request completion."""
-        self._semaphore.release()
+        (self._bulk_semaphore if bulk else self._semaphore).release()
+        self._in_flight -= 1
+        REQUESTS_IN_FLIGHT.dec()
         self._check_cleanup()
 
     def _check_cleanup(self) -> None:
@@ -159,9 +904,19 @@ class ModelManager:
         """Cleanup resources on shutdown."""
         settings = get_settings()
 
-        if self._model is not None:
-            del self._model
-            self._model = None
+        if self._self_test_task is not None:
+            self._self_test_task.cancel()
+            self._self_test_task = None
+        self._self_test_passed = None
+
+        reloads = list(self._reloads.values())
+        for task in reloads:
+            task.cancel()
+        await asyncio.gather(*reloads, return_exceptions=True)
+
+        for version in self._models.values():
+            version.stop()
+        self._models.clear()
 
         if self._tokenizer is not None:
             del self._tokenizer
@@ -0,0 +1,152 @@
+"""
+CPU inference optimizations with a perplexity-based quality guard.
+"""
+
+import copy
+import logging
+import math
+from typing import Callable, Dict, List
+
+import torch
+from torch import nn
+from transformers import GPT2LMHeadModel, PreTrainedTokenizerBase
+from transformers.pytorch_utils import Conv1D
+
+logger = logging.getLogger(__name__)
+
+# Fixed evaluation set for the quality guard, in the same format the model is prompted with
+QUALITY_GUARD_TEXTS = [
+    "Write a poem about: the sea\n\nPoem: The waves roll in beneath a silver sky,\n"
+    "and gulls cry softly as the tide goes by.",
+    "Write a poem about: autumn leaves\n\nPoem: Red and gold they drift and fall,\n"
+    "whispering secrets to the garden wall.",
+    "Write a poem about: the city at night\n\nPoem: Neon rivers run through streets of stone,\n"
+    "a thousand windows, each one burning alone.",
+    "Write a poem about: morning\n\nPoem: Light spills over the quiet hill,\n"
+    "the world is waking, soft and still.",
+]
+
+
+def configure_threads(num_threads: int, interop_threads: int) -> None:
+    """Set intra-op and inter-op thread counts; zero keeps the PyTorch default."""
+    if num_threads > 0:
+        torch.set_num_threads(num_threads)
+
+    if interop_threads > 0:
+        try:
+            torch.set_interop_threads(interop_threads)
+        except RuntimeError:
+            # Only allowed before any inter-op parallel work has started
+            logger.warning("Inter-op threads already initialized, keeping current setting")
+
+    logger.info(
+        "Using %d intra-op and %d inter-op threads",
+        torch.get_num_threads(),
+        torch.get_num_interop_threads(),
+    )
+
+
+def perplexity(model: nn.Module, tokenizer: PreTrainedTokenizerBase, device: torch.device) -> float:
+    """Compute the perplexity of ``model`` on the fixed quality guard texts."""
+    total_loss = 0.0
+    total_tokens = 0
+
+    with torch.inference_mode():
+        for text in QUALITY_GUARD_TEXTS:
+            input_ids = torch.tensor([tokenizer.encode(text)], dtype=torch.long, device=device)
+            logits = model(input_ids=input_ids).logits.float()
+            loss = nn.functional.cross_entropy(
+                logits[0, :-1], input_ids[0, 1:], reduction="sum"
+            )
+            total_loss += loss.item()
+            total_tokens += input_ids.shape[1] - 1
+
+    return math.exp(total_loss / total_tokens)
+
+
+def quantize_int8(model: GPT2LMHeadModel) -> nn.Module:
+    """Apply dynamic int8 quantization to all linear projections.
+
+    GPT-2 implements its projections as ``Conv1D`` modules, which dynamic
+    quantization does not recognize, so they are converted to ``nn.Linear``
+    first.
+    """
+    for module in list(model.modules()):
+        for name, child in module.named_children():
+            if isinstance(child, Conv1D):
+                setattr(module, name, _conv1d_to_linear(child))
+
+    return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+
+def to_bf16(model: GPT2LMHeadModel) -> nn.Module:
+    """Cast weights to bfloat16 if the CPU has native bf16 support."""
+    if not torch.ops.mkldnn._is_mkldnn_bf16_supported():
+        raise RuntimeError("CPU does not support bfloat16")
+    return model.to(torch.bfloat16)
+
+
+def compile_model(model: GPT2LMHeadModel) -> nn.Module:
+    """Compile the model with dynamic shapes for the varying batch and cache sizes."""
+    return torch.compile(model, dynamic=True)
+
+
+CPU_OPTIMIZATIONS: Dict[str, Callable[[GPT2LMHeadModel], nn.Module]] = {
+    "int8": quantize_int8,
+    "bf16": to_bf16,
+    "compile": compile_model,
+}
+
+
+def optimize_for_cpu(
+    model: GPT2LMHeadModel,
+    tokenizer: PreTrainedTokenizerBase,
+    modes: List[str],
+    max_perplexity_drift: float,
+    device: torch.device,
+) -> nn.Module:
+    """Apply the requested CPU optimizations in order, keeping only safe ones.
+
+    Each mode is applied to a copy of the current model and its perplexity on
+    the quality guard texts is compared with the fp32 baseline. A mode whose
+    perplexity rises by more than ``max_perplexity_drift`` (relative), or that
+    fails to run, is skipped.
+    """
+    if not modes:
+        return model
+
+    baseline = perplexity(model, tokenizer, device)
+    logger.info("Quality guard baseline perplexity: %.3f", baseline)
+
+    for mode in modes:
+        try:
+            candidate = CPU_OPTIMIZATIONS[mode](copy.deepcopy(model))
+            score = perplexity(candidate, tokenizer, device)
+        except Exception as e:
+            logger.warning("CPU optimization %s unavailable: %s", mode, e)
+            continue
+
+        drift = score / baseline - 1
+        if drift > max_perplexity_drift:
+            logger.warning(
+                "Refusing CPU optimization %s: perplexity %.3f drifts %.1f%% from baseline",
+                mode,
+                score,
+                drift * 100,
+            )
+            continue
+
+        logger.info("Enabled CPU optimization %s (perplexity %.3f)", mode, score)
+        model = candidate
+
+    return model
+
+
+def _conv1d_to_linear(conv: Conv1D) -> nn.Linear:
+    """Convert a GPT-2 ``Conv1D`` (weight stored as in x out) to ``nn.Linear``."""
+    in_features, out_features = conv.weight.shape
+    linear = nn.Linear(in_features, out_features, device=conv.weight.device)
+    with torch.no_grad():
+        linear.weight.copy_(conv.weight.t())
+        linear.bias.copy_(conv.bias)
+    return linear
@@ -0,0 +1,187 @@
+"""
+Per-row sampling utilities for batched poem generation.
+"""
+from collections import deque
+from typing import Deque, Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+import torch
+
+
+def apply_repetition_penalty(
+    scores: torch.Tensor, seen: torch.Tensor, penalty: torch.Tensor
+) -> torch.Tensor:
+    """Penalize tokens already present in each row.
+
+    ``seen`` is a boolean ``(batch, vocab)`` mask of tokens in each sequence
+    and ``penalty`` a ``(batch, 1)`` tensor of per-row penalties.
+    """
+    penalized = torch.where(scores < 0, scores * penalty, scores / penalty)
+    return torch.where(seen, penalized, scores)
+
+
+def apply_top_k_top_p(
+    scores: torch.Tensor, top_k: torch.Tensor, top_p: torch.Tensor
+) -> torch.Tensor:
+    """Filter each row to its own top-k and nucleus (top-p) candidates.
+
+    ``top_k`` and ``top_p`` are ``(batch, 1)`` tensors.
+    """
+    sorted_scores, sorted_indices = torch.sort(scores, dim=-1, descending=True)
+    ranks = torch.arange(scores.shape[-1], device=scores.device).unsqueeze(0)
+    sorted_scores = sorted_scores.masked_fill(ranks >= top_k, -float("inf"))
+
+    probs = sorted_scores.softmax(dim=-1)
+    # Probability mass of strictly higher-ranked tokens; the top token is always kept
+    mass_before = probs.cumsum(dim=-1) - probs
+    sorted_scores = sorted_scores.masked_fill(mass_before >= top_p, -float("inf"))
+
+    return torch.full_like(scores, -float("inf")).scatter(1, sorted_indices, sorted_scores)
+
+
+class NgramIndex:
+    """Incrementally maintained table of the n-grams in one token sequence.
+
+    Maps every ``(n - 1)``-token prefix seen so far to the tokens that
+    followed it, so the tokens that would repeat an n-gram are found with
+    one lookup per step instead of rescanning the whole sequence.
+    """
+
+    def __init__(self, ngram_size: int, tokens: Iterable[int] = ()) -> None:
+        self._size = ngram_size
+        self._table: Dict[Tuple[int, ...], Set[int]] = {}
+        # Read-only table of the index this one was forked from
+        self._base: Dict[Tuple[int, ...], Set[int]] = {}
+        self._window: Deque[int] = deque(maxlen=max(ngram_size, 1))
+        for token in tokens:
+            self.append(token)
+
+    def fork(self) -> "NgramIndex":
+        """Cheap copy to append tentative tokens to without changing this index.
+
+        The fork reads this index's table, so it must be discarded before
+        more tokens are appended here. Forks cannot be forked again.
+        """
+        fork = NgramIndex(self._size)
+        fork._base = self._table
+        fork._window = deque(self._window, maxlen=self._window.maxlen)
+        return fork
+
+    def append(self, token: int) -> None:
+        """Record the n-gram ending in ``token``."""
+        if self._size <= 0:
+            return
+
+        self._window.append(token)
+        if len(self._window) == self._size:
+            window = tuple(self._window)
+            self._table.setdefault(window[:-1], set()).add(token)
+
+    def banned(self) -> Iterable[int]:
+        """Tokens that would complete an n-gram already in the sequence."""
+        if self._size <= 0 or len(self._window) < self._size - 1:
+            return ()
+
+        prefix = tuple(self._window)[len(self._window) - self._size + 1:]
+        if prefix in self._base:
+            return self._base[prefix] | self._table.get(prefix, set())
+        return self._table.get(prefix, ())
+
+
+class LogitsProcessorChain:
+    """Fused logits processing and filtering for a batch with per-row parameters.
+
+    Applies the repetition penalty, bad word and n-gram bans, the minimum
+    length, temperature and top-k/top-p filtering as batched tensor ops.
+    Single-token bad words are a constant vocabulary mask; all other bans of
+    the batch are gathered from per-row lookup tables and applied with a
+    single indexed write. The result is identical to applying the
+    processors one after another.
+    """
+
+    def __init__(
+        self,
+        vocab_size: int,
+        eos_token_id: int,
+        min_length: int,
+        no_repeat_ngram_size: int,
+        bad_words_ids: Sequence[Sequence[int]],
+        device: torch.device,
+    ) -> None:
+        self._eos_token_id = eos_token_id
+        self._min_length = min_length
+        self._no_repeat_ngram_size = no_repeat_ngram_size
+
+        self._bad_token_mask = torch.zeros(vocab_size, dtype=torch.bool, device=device)
+        self._bad_token_mask[[word[0] for word in bad_words_ids if len(word) == 1]] = True
+
+        # Last token of each multi-token bad word, keyed by the tokens before it
+        self._bad_word_prefixes: Dict[Tuple[int, ...], List[int]] = {}
+        for word in bad_words_ids:
+            if len(word) > 1:
+                self._bad_word_prefixes.setdefault(tuple(word[:-1]), []).append(word[-1])
+        self._bad_prefix_lengths = sorted({len(prefix) for prefix in self._bad_word_prefixes})
+
+    def ngram_index(self, tokens: Iterable[int]) -> NgramIndex:
+        """Create the n-gram table for a new sequence starting with ``tokens``."""
+        return NgramIndex(self._no_repeat_ngram_size, tokens)
+
+    def banned_tokens(self, history: Sequence[int], ngrams: NgramIndex) -> List[int]:
+        """Tokens a row may not produce next, besides single-token bad words."""
+        banned = list(ngrams.banned())
+        for length in self._bad_prefix_lengths:
+            if len(history) >= length:
+                banned += self._bad_word_prefixes.get(tuple(history[len(history) - length:]), ())
+        if len(history) < self._min_length:
+            banned.append(self._eos_token_id)
+        return banned
+
+    def banned_indices(
+        self, histories: Sequence[Sequence[int]], ngrams: Sequence[NgramIndex]
+    ) -> Tuple[List[int], List[int]]:
+        """Row and token indices of every history-dependent ban in the batch."""
+        rows: List[int] = []
+        columns: List[int] = []
+        for row, (history, index) in enumerate(zip(histories, ngrams)):
+            banned = self.banned_tokens(history, index)
+            rows.extend([row] * len(banned))
+            columns.extend(banned)
+        return rows, columns
+
+    def __call__(
+        self,
+        scores: torch.Tensor,
+        histories: Sequence[Sequence[int]],
+        ngrams: Sequence[NgramIndex],
+        seen: torch.Tensor,
+        params: torch.Tensor,
+        forms: Optional[torch.Tensor] = None,
+    ) -> torch.Tensor:
+        """Turn ``(batch, vocab)`` logits into filtered scores ready for softmax.
+
+        ``params`` holds each row's repetition penalty, temperature, top-k and
+        top-p as a ``(batch, 4)`` tensor. ``forms`` optionally masks the
+        tokens each row's poem form does not allow next.
+        """
+        return self.process(scores, seen, params, self.banned_indices(histories, ngrams), forms)
+
+    def process(
+        self,
+        scores: torch.Tensor,
+        seen: torch.Tensor,
+        params: torch.Tensor,
+        banned: Tuple[List[int], List[int]],
+        forms: Optional[torch.Tensor] = None,
+    ) -> torch.Tensor:
+        """Like calling the chain, with bans already gathered by ``banned_indices``."""
+        penalty, temperature, top_k, top_p = params.split(1, dim=1)
+        scores = apply_repetition_penalty(scores, seen, penalty)
+        scores = scores.masked_fill(self._bad_token_mask, -float("inf"))
+        if forms is not None:
+            scores = scores.masked_fill(forms, -float("inf"))
+
+        rows, columns = banned
+        if columns:
+            indices = torch.tensor([rows, columns], device=scores.device)
+            scores[indices[0], indices[1]] = -float("inf")
+
+        return apply_top_k_top_p(scores / temperature, top_k, top_p)
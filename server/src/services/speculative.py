@@ -0,0 +1,219 @@
+"""
+Speculative decoding with a small draft model on top of the batching engine.
+"""
+
+from typing import List, Optional, Sequence, Tuple
+
+import torch
+from transformers import GPT2LMHeadModel
+
+from src.services.engine import DecodeEngine, _Sequence
+from src.services.generation_config import GenerationConfig
+from src.services.metrics import BATCH_SIZE, SPECULATIVE_ACCEPTED_TOKENS, SPECULATIVE_DRAFT_TOKENS
+
+# History-dependent bans, seen-token mask and form mask in effect at one position
+ProcessorState = Tuple[Tuple[List[int], List[int]], torch.Tensor, Optional[torch.Tensor]]
+
+
+class SpeculativeDecodeEngine(DecodeEngine):
+    """Decode engine where a draft model proposes tokens for the main model to verify.
+
+    Every step the draft model proposes up to ``speculative_tokens`` tokens
+    per sequence and the main model scores all of them in one forward pass.
+    Draft tokens are accepted with the standard rejection rule, so poems are
+    distributed exactly as if the main model had sampled them one by one,
+    while each accepted token saves a forward pass of the main model.
+
+    The draft model keeps its own KV cache slots next to the main model's.
+    It always re-reads the last two tokens of a sequence, which keeps its
+    cache in step with however many draft tokens were accepted.
+    """
+
+    def __init__(
+        self,
+        model: GPT2LMHeadModel,
+        draft_model: GPT2LMHeadModel,
+        generation_config: GenerationConfig,
+        max_batch_size: int,
+        max_positions: int,
+        speculative_tokens: int,
+        reserved_slots: int = 0,
+    ) -> None:
+        super().__init__(
+            model, generation_config, max_batch_size, max_positions, reserved_slots
+        )
+        self._draft = draft_model
+        self._speculative_tokens = speculative_tokens
+        self._draft_keys, self._draft_values = self._allocate_cache(draft_model)
+
+    def _prefill(self, sequence: _Sequence) -> None:
+        """Fill the draft model's cache with the prompt, then prefill as usual."""
+        prompt = sequence.tokens[-(self._max_positions - 1):]
+        slot = len(self._active)
+
+        input_ids = torch.tensor([prompt], dtype=torch.long, device=self._device)
+        outputs = self._draft(input_ids=input_ids, use_cache=True)
+        for layer, (key, value) in enumerate(outputs.past_key_values):
+            self._draft_keys[layer][slot, :, :len(prompt)] = key[0]
+            self._draft_values[layer][slot, :, :len(prompt)] = value[0]
+
+        super()._prefill(sequence)
+
+    def _step(self) -> None:
+        """Draft, verify and append up to ``speculative_tokens + 1`` tokens per sequence."""
+        active = list(self._active)
+        batch_size = len(active)
+        BATCH_SIZE.observe(batch_size)
+        lengths = self._lengths[:batch_size]
+        base_lengths = lengths.tolist()
+        # Never draft past the positions the model has embeddings for
+        count = min(self._speculative_tokens, self._max_positions - 1 - max(base_lengths))
+
+        drafts, draft_probs, states = self._draft_tokens(active, lengths, count)
+
+        last_tokens = torch.tensor(
+            [[sequence.tokens[-1]] for sequence in active], dtype=torch.long, device=self._device
+        )
+        input_ids = torch.cat([last_tokens, *(draft.unsqueeze(1) for draft in drafts)], dim=1)
+        logits = self._forward(self._model, self._keys, self._values, lengths, input_ids).float()
+
+        params = self._params[:batch_size]
+        target_probs = [
+            self._processors.process(logits[:, index], seen, params, banned, forms).softmax(dim=-1)
+            for index, (banned, seen, forms) in enumerate(states)
+        ]
+        accepted, next_tokens = self._verify(drafts, draft_probs, target_probs, active)
+
+        SPECULATIVE_DRAFT_TOKENS.inc(count * batch_size)
+        SPECULATIVE_ACCEPTED_TOKENS.inc(sum(accepted))
+
+        log_probs = logits.log_softmax(dim=-1)
+        drafted = torch.stack(drafts, dim=1).tolist() if drafts else [[] for _ in active]
+        for slot in reversed(range(batch_size)):
+            for offset, token in enumerate(drafted[slot][:accepted[slot]] + [next_tokens[slot]]):
+                active[slot].log_probability += float(log_probs[slot, offset, token])
+                self._lengths[slot] = base_lengths[slot] + offset + 1
+                if self._append(slot, token):
+                    self._retire(slot)
+                    break
+
+    def _draft_tokens(
+        self, active: List[_Sequence], lengths: torch.Tensor, count: int
+    ) -> Tuple[List[torch.Tensor], List[torch.Tensor], List[ProcessorState]]:
+        """Sample ``count`` draft tokens per row from the draft model.
+
+        Returns the draft tokens and their distributions, and the bans,
+        seen-token mask and form mask in effect before each draft token and
+        after the last one, so the main model's logits can be processed
+        identically.
+        """
+        batch_size = len(active)
+        params = self._params[:batch_size]
+        rows = self._positions[:batch_size]
+        histories = [list(sequence.tokens) for sequence in active]
+        ngrams = [sequence.ngrams.fork() for sequence in active]
+        forms = [sequence.form and sequence.form.fork() for sequence in active]
+        seen = self._seen[:batch_size].clone()
+
+        input_ids = torch.tensor(
+            [sequence.tokens[-2:] for sequence in active], dtype=torch.long, device=self._device
+        )
+        logits = self._forward(
+            self._draft, self._draft_keys, self._draft_values, lengths - 1, input_ids
+        )
+        draft_lengths = lengths + 1
+
+        drafts: List[torch.Tensor] = []
+        draft_probs: List[torch.Tensor] = []
+        states: List[ProcessorState] = []
+        for index in range(count):
+            banned = self._processors.banned_indices(histories, ngrams)
+            form_mask = self._forms.mask(forms)
+            states.append((banned, seen.clone(), form_mask))
+
+            scores = self._processors.process(
+                logits[:, -1].float(), seen, params, banned, form_mask
+            )
+            probs = scores.softmax(dim=-1)
+            tokens = self._draw(probs, active)
+            drafts.append(tokens)
+            draft_probs.append(probs)
+
+            for row, token in enumerate(tokens.tolist()):
+                histories[row].append(token)
+                ngrams[row].append(token)
+                if forms[row] is not None:
+                    forms[row].append(token)
+            seen[rows, tokens] = True
+
+            if index + 1 < count:
+                logits = self._forward(
+                    self._draft,
+                    self._draft_keys,
+                    self._draft_values,
+                    draft_lengths,
+                    tokens.unsqueeze(1),
+                )
+                draft_lengths += 1
+
+        states.append(
+            (self._processors.banned_indices(histories, ngrams), seen, self._forms.mask(forms))
+        )
+        return drafts, draft_probs, states
+
+    def _verify(
+        self,
+        drafts: Sequence[torch.Tensor],
+        draft_probs: Sequence[torch.Tensor],
+        target_probs: Sequence[torch.Tensor],
+        sequences: List[_Sequence],
+    ) -> Tuple[List[int], List[int]]:
+        """Accept a prefix of each row's draft tokens and sample the token after it.
+
+        Draft token ``x`` is kept with probability ``min(1, p(x) / q(x))``. At
+        the first rejection the replacement is drawn from the normalized
+        residual ``max(0, p - q)``; if every draft token is kept, a bonus
+        token is drawn from ``p``. Returns the accepted counts and next tokens.
+        """
+        batch_size = len(sequences)
+        rows = self._positions[:batch_size]
+        count = len(drafts)
+        accepted = torch.zeros(batch_size, dtype=torch.long, device=self._device)
+
+        if count:
+            tokens = torch.stack(drafts, dim=1).unsqueeze(2)
+            p = torch.stack(target_probs[:count], dim=1).gather(2, tokens).squeeze(2)
+            q = torch.stack(draft_probs, dim=1).gather(2, tokens).squeeze(2)
+            keep = self._uniform((batch_size, count), sequences) * q < p
+            accepted = keep.long().cumprod(dim=1).sum(dim=1)
+
+        probs = torch.stack(target_probs, dim=1)[rows, accepted]
+        if count:
+            rejected_probs = torch.stack(draft_probs, dim=1)[rows, accepted.clamp(max=count - 1)]
+            residual = (probs - rejected_probs).clamp(min=0)
+            mass = residual.sum(dim=-1, keepdim=True)
+            rejected = (accepted < count).unsqueeze(1) & (mass > 0)
+            probs = torch.where(rejected, residual / mass.clamp(min=1e-12), probs)
+
+        return accepted.tolist(), self._draw(probs, sequences).tolist()
+
+    def _uniform(self, shape: Tuple[int, int], sequences: List[_Sequence]) -> torch.Tensor:
+        """Draw uniform numbers per row, from the row's own generator if it is seeded."""
+        values = torch.rand(shape, device=self._device)
+        for row, sequence in enumerate(sequences):
+            if sequence.generator is not None:
+                values[row] = torch.rand(
+                    shape[1:], generator=sequence.generator, device=self._device
+                )
+        return values
+
+    def _retire(self, slot: int) -> None:
+        """Move the draft cache of the last active sequence along with its main cache."""
+        last = len(self._active) - 1
+        if slot != last:
+            length = int(self._lengths[last])
+            for keys, values in zip(self._draft_keys, self._draft_values):
+                keys[slot, :, :length] = keys[last, :, :length]
+                values[slot, :, :length] = values[last, :, :length]
+
+        super()._retire(slot)
@@ -0,0 +1,224 @@
+"""
+Non-blocking structured logging.
+
+Log calls only put the record on a bounded queue. A background thread formats
+records as JSON lines and writes them to stdout and a size-rotated log file,
+so logging never does I/O on the event loop. Records are dropped rather than
+blocking the caller when the queue is full. Inference worker processes send
+their records to the server process, whose writer handles them like its own.
+"""
+
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+
+from src.config.settings import get_settings
+from src.services.metrics import LOG_RECORDS_DROPPED
+
+logger = logging.getLogger(__name__)
+
+# Fields of the request being handled, added to every record logged while handling it
+request_context: contextvars.ContextVar[Dict[str, Any]] = contextvars.ContextVar(
+    "request_context", default={}
+)
+
+# Loggers whose records are always subject to sampling
+SAMPLED_LOGGERS = frozenset({"uvicorn.access"})
+
+_RECORD_ATTRIBUTES = frozenset(vars(logging.makeLogRecord({}))) | {
+    "message",
+    "asctime",
+    "sampled",
+}
+
+
+def bind(**fields: Any) -> None:
+    """Add fields to the records logged for the rest of the current request."""
+    request_context.set({**request_context.get(), **fields})
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats a record as a JSON object with its extra and request context fields."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "timestamp": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update(
+            (key, value) for key, value in vars(record).items() if key not in _RECORD_ATTRIBUTES
+        )
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class ContextFilter(logging.Filter):
+    """Adds the fields of the current request to records that do not set them."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        for key, value in request_context.get().items():
+            if not hasattr(record, key):
+                setattr(record, key, value)
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps a fraction of high-volume records.
+
+    Records logged with ``extra={"sampled": True}``, and those of
+    ``SAMPLED_LOGGERS``, are sampled unless they are warnings or worse.
+    """
+
+    def __init__(self, rate: float) -> None:
+        super().__init__()
+        self._rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        sampled = getattr(record, "sampled", False) or record.name in SAMPLED_LOGGERS
+        if not sampled or record.levelno >= logging.WARNING:
+            return True
+        return random.random() < self._rate
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """Hands records to the writer thread, dropping them when its queue is full."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Arguments may change after the call returns, so the message is merged
+        # now; formatting, including tracebacks, is left to the writer thread
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_RECORDS_DROPPED.inc()
+
+
+class _WorkerQueueHandler(NonBlockingQueueHandler):
+    """Hands records of a worker process to the server process."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = super().prepare(record)
+        # Tracebacks cannot be sent to another process, so they are formatted here
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class _ReplayHandler(logging.Handler):
+    """Logs records received from worker processes as if they were logged here."""
+
+    def emit(self, record: logging.LogRecord) -> None:
+        logging.getLogger(record.name).handle(record)
+
+
+class _QueueListener(logging.handlers.QueueListener):
+    """Queue listener whose stop waits for room in a full queue instead of failing."""
+
+    def enqueue_sentinel(self) -> None:
+        self.queue.put(self._sentinel)
+
+
+class LogPipeline:
+    """Routes all logging of the process through a queue to a background writer."""
+
+    LOG_FILENAME = "poetry_generation.log"
+
+    def __init__(self) -> None:
+        self._listener: Optional[_QueueListener] = None
+        self._worker_queue: Any = None
+        self._worker_listener: Optional[_QueueListener] = None
+
+    def start(self) -> None:
+        """Replace the root and uvicorn handlers with the queue and start the writer."""
+        settings = get_settings()
+        if self._listener is not None:
+            return
+
+        handlers: List[logging.Handler] = [logging.StreamHandler(sys.stdout)]
+        file_error: Optional[OSError] = None
+        if settings.log_dir:
+            try:
+                os.makedirs(settings.log_dir, exist_ok=True)
+                handlers.append(
+                    logging.handlers.RotatingFileHandler(
+                        os.path.join(settings.log_dir, self.LOG_FILENAME),
+                        maxBytes=settings.log_max_bytes,
+                        backupCount=settings.log_backup_count,
+                        encoding="utf-8",
+                    )
+                )
+            except OSError as e:
+                file_error = e
+
+        formatter = JsonFormatter()
+        for handler in handlers:
+            handler.setFormatter(formatter)
+
+        queue_handler = NonBlockingQueueHandler(queue.Queue(settings.log_queue_size))
+        queue_handler.addFilter(SamplingFilter(settings.log_sample_rate))
+        queue_handler.addFilter(ContextFilter())
+
+        root = logging.getLogger()
+        root.handlers = [queue_handler]
+        root.setLevel(settings.log_level)
+        # Uvicorn writes its own logs synchronously unless they reach the root logger
+        for name in ("uvicorn", "uvicorn.error", "uvicorn.access"):
+            logging.getLogger(name).handlers = []
+            logging.getLogger(name).propagate = True
+
+        self._listener = _QueueListener(queue_handler.queue, *handlers)
+        self._listener.start()
+
+        if file_error is not None:
+            logger.warning(
+                "Could not create log file: %s. Continuing with console logging only.",
+                file_error,
+            )
+
+    def worker_queue(self, context: Any) -> Any:
+        """Queue that worker processes of a multiprocessing ``context`` send records on.
+
+        Records are logged in this process as they arrive, so they go
+        through the same sampling and writer as its own.
+        """
+        if self._worker_queue is None:
+            self._worker_queue = context.Queue(get_settings().log_queue_size)
+            self._worker_listener = _QueueListener(self._worker_queue, _ReplayHandler())
+            self._worker_listener.start()
+        return self._worker_queue
+
+    def start_worker(self, worker_queue: Any) -> None:
+        """Send all logging of a worker process to the server process on ``worker_queue``."""
+        root = logging.getLogger()
+        root.handlers = [_WorkerQueueHandler(worker_queue)]
+        root.setLevel(get_settings().log_level)
+
+    def stop(self) -> None:
+        """Write out the queued records and stop the writer threads."""
+        if self._worker_listener is not None:
+            self._worker_listener.stop()
+            self._worker_listener = None
+            self._worker_queue = None
+        if self._listener is not None:
+            self._listener.stop()
+            self._listener = None
+
+
+log_pipeline = LogPipeline()
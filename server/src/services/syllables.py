@@ -0,0 +1,108 @@
+"""
+Syllable counting from the CMU pronouncing dictionary with a rule-based fallback.
+"""
+
+import bisect
+import functools
+import logging
+import re
+import threading
+from array import array
+from typing import Iterable, List, Optional
+
+import cmudict
+
+logger = logging.getLogger(__name__)
+
+CACHE_SIZE = 65536
+
+_WORD_PARTS = re.compile(r"[a-z']+")
+_VOWEL_GROUPS = re.compile(r"[aeiouy]+")
+# Vowel pairs that are usually pronounced as two syllables, e.g. lion, piano, video
+_SPLIT_VOWELS = re.compile(r"(?<![tcsg])i[aou]|eo(?!p)|uo")
+
+
+def estimate_syllables(word: str) -> int:
+    """Estimate the syllables of a lowercase word missing from the dictionary.
+
+    Counts vowel groups, treating ``y`` as a vowel, drops a silent final
+    ``e``, ``es`` or ``ed`` and splits vowel pairs that are usually
+    pronounced separately.
+    """
+    count = len(_VOWEL_GROUPS.findall(word))
+    if count > 1:
+        if word.endswith("e") and not word.endswith(("le", "ee", "ye")):
+            count -= 1
+        elif word.endswith("es") and not word.endswith(("ses", "xes", "zes", "ces", "ges")):
+            count -= 1
+        elif word.endswith("ed") and not word.endswith(("ted", "ded")):
+            count -= 1
+    count += len(_SPLIT_VOWELS.findall(word))
+    return max(1, count)
+
+
+class SyllableCounter:
+    """Counts syllables of words and text, memoizing every word it has seen.
+
+    The dictionary is loaded on first use into a sorted word list with a
+    parallel byte array of syllable counts, found by binary search. Words
+    not in the dictionary are estimated with ``estimate_syllables``. Safe
+    to use from several threads.
+    """
+
+    def __init__(self, cache_size: int = CACHE_SIZE) -> None:
+        self._words: Optional[List[str]] = None
+        self._counts = array("B")
+        self._lock = threading.Lock()
+        self.count_word = functools.lru_cache(maxsize=cache_size)(self._count_word)
+
+    def load(self) -> None:
+        """Load the pronouncing dictionary unless it is already loaded."""
+        with self._lock:
+            if self._words is not None:
+                return
+
+            entries = {}
+            with cmudict.dict_stream() as stream:
+                for line in stream:
+                    word, *phones = line.decode("utf-8").split("#", 1)[0].split()
+                    # Alternative pronunciations are listed as word(2), word(3), ...
+                    if not word.endswith(")"):
+                        entries[word] = sum(phone[-1].isdigit() for phone in phones)
+
+            words = sorted(entries)
+            self._counts = array("B", (entries[word] for word in words))
+            self._words = words
+            logger.info("Loaded syllable counts for %d words", len(words))
+
+    def count_text(self, text: str) -> int:
+        """Count the syllables of whitespace-separated text."""
+        return sum(self.count_words(text.split()))
+
+    def count_words(self, words: Iterable[str]) -> List[int]:
+        """Count the syllables of each word of a stream of words."""
+        count_word = self.count_word
+        return [count_word(word) for word in words]
+
+    def _count_word(self, word: str) -> int:
+        """Count the syllables of one word, ignoring case and punctuation.
+
+        Hyphenated and otherwise joined words are counted part by part.
+        """
+        if self._words is None:
+            self.load()
+
+        return sum(self._lookup(part) for part in _WORD_PARTS.findall(word.lower()))
+
+    def _lookup(self, part: str) -> int:
+        """Syllables of a run of letters and apostrophes."""
+        for candidate in (part, part.strip("'")):
+            index = bisect.bisect_left(self._words, candidate)
+            if index < len(self._words) and self._words[index] == candidate:
+                return self._counts[index]
+
+        letters = part.replace("'", "")
+        return estimate_syllables(letters) if letters else 0
+
+
+syllable_counter = SyllableCounter()
@@ -0,0 +1,237 @@
+"""
+Worker processes that each have many calls in flight.
+
+``ProcessPoolExecutor`` gives a worker its next call only once the previous
+one has returned, so a decode engine inside the worker would never see more
+than one request. Calls to a ``WorkerPool`` may instead return a future: the
+worker keeps taking calls while it is pending and answers once it resolves,
+so every worker's engine batches the requests sent to it.
+"""
+
+import functools
+import itertools
+import logging
+import pickle
+import queue
+import threading
+from concurrent.futures import Executor, Future
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Dict, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Seconds between checks that the workers are still running
+LIVENESS_INTERVAL_SECONDS = 1.0
+
+
+def _picklable_error(error: BaseException) -> BaseException:
+    """The error itself if it can be sent to the parent, otherwise a description of it."""
+    try:
+        pickle.dumps(error)
+        return error
+    except Exception:
+        return RuntimeError(f"{type(error).__name__}: {error}")
+
+
+def _worker_main(
+    index: int,
+    calls: Any,
+    results: Any,
+    initializer: Callable[..., None],
+    initargs: Tuple[Any, ...],
+) -> None:
+    """Start the worker, then run calls until told to stop and the pending ones answer."""
+    try:
+        initializer(*initargs)
+    except Exception:
+        logger.exception("Inference worker failed to start")
+        raise
+    # An answer without a call id reports the worker started
+    results.put((None, index, None))
+
+    pending = 0
+    idle = threading.Condition()
+
+    def answer(call_id: int, future: Future) -> None:
+        nonlocal pending
+        try:
+            results.put((call_id, future.result(), None))
+        except BaseException as e:
+            results.put((call_id, None, _picklable_error(e)))
+        with idle:
+            pending -= 1
+            idle.notify_all()
+
+    while (call := calls.get()) is not None:
+        call_id, func, args = call
+        try:
+            result = func(*args)
+        except BaseException as e:
+            results.put((call_id, None, _picklable_error(e)))
+            continue
+
+        if not isinstance(result, Future):
+            results.put((call_id, result, None))
+            continue
+        with idle:
+            pending += 1
+        result.add_done_callback(functools.partial(answer, call_id))
+
+    with idle:
+        idle.wait_for(lambda: pending == 0)
+
+
+class WorkerPool(Executor):
+    """A fixed set of worker processes, each handling many calls at once.
+
+    A call returning a ``concurrent.futures.Future`` is answered with that
+    future's result without holding up the worker. Calls go to the worker
+    with the fewest unanswered ones. Like ``ProcessPoolExecutor``, the pool
+    breaks if a worker dies, failing every unanswered call, and calls that
+    were sent cannot be cancelled. ``ready`` resolves once every worker's
+    initializer has finished; calls sent before then wait in the workers.
+    """
+
+    def __init__(
+        self,
+        max_workers: int,
+        mp_context: Any,
+        initializer: Callable[..., None],
+        initargs: Tuple[Any, ...] = (),
+    ) -> None:
+        self._results = mp_context.Queue()
+        self._calls = [mp_context.SimpleQueue() for _ in range(max_workers)]
+        self._processes = [
+            mp_context.Process(
+                target=_worker_main,
+                args=(index, calls, self._results, initializer, initargs),
+                daemon=True,
+            )
+            for index, calls in enumerate(self._calls)
+        ]
+        self.ready: Future = Future()
+        self._started: Set[int] = set()
+        self._load = [0] * max_workers
+        # Unanswered calls by id, with the index of the worker handling each
+        self._pending: Dict[int, Tuple[Future, int]] = {}
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self._broken: Optional[str] = None
+        self._shutdown = False
+
+        for process in self._processes:
+            process.start()
+        self._reader = threading.Thread(
+            target=self._read_results, name="worker-pool-results", daemon=True
+        )
+        self._reader.start()
+
+    def submit(self, fn: Callable[..., Any], /, *args: Any, **kwargs: Any) -> Future:
+        """Send a call to the least loaded worker; ``fn`` and its arguments must pickle."""
+        if kwargs:
+            fn = functools.partial(fn, **kwargs)
+
+        with self._lock:
+            if self._broken is not None:
+                raise BrokenProcessPool(self._broken)
+            if self._shutdown:
+                raise RuntimeError("cannot schedule new futures after shutdown")
+
+            future: Future = Future()
+            future.set_running_or_notify_cancel()
+            call_id = next(self._ids)
+            index = min(range(len(self._load)), key=self._load.__getitem__)
+            self._load[index] += 1
+            self._pending[call_id] = (future, index)
+            self._calls[index].put((call_id, fn, args))
+        return future
+
+    def shutdown(self, wait: bool = True, *, cancel_futures: bool = False) -> None:
+        """Stop taking calls; workers exit once their unanswered calls are answered.
+
+        Every sent call is already running, so ``cancel_futures`` has nothing
+        to cancel.
+        """
+        with self._lock:
+            if self._shutdown:
+                return
+            self._shutdown = True
+            if self._broken is None:
+                for calls in self._calls:
+                    calls.put(None)
+
+        if wait:
+            for process in self._processes:
+                process.join()
+            self._reader.join()
+
+    def _read_results(self) -> None:
+        """Resolve futures as workers answer, and fail them all if a worker dies."""
+        exited: Set[int] = set()
+        while True:
+            try:
+                call_id, result, error = self._results.get(timeout=LIVENESS_INTERVAL_SECONDS)
+            except queue.Empty:
+                if self._check_workers(exited):
+                    if not self.ready.done():
+                        self.ready.set_exception(
+                            BrokenProcessPool(self._broken or "Workers exited before starting")
+                        )
+                    return
+                continue
+
+            if call_id is None:
+                self._started.add(result)
+                if len(self._started) == len(self._processes) and not self.ready.done():
+                    self.ready.set_result(None)
+                continue
+
+            with self._lock:
+                future, index = self._pending.pop(call_id)
+                self._load[index] -= 1
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    def _check_workers(self, exited: Set[int]) -> bool:
+        """Break the pool if a worker died; return whether there is nothing left to read.
+
+        ``exited`` collects the workers seen exited after a shutdown. They only
+        exit once their calls are answered, and every answer sent before the
+        previous check has been read since, so a worker in it with calls left
+        died too.
+        """
+        with self._lock:
+            if self._shutdown:
+                died = [index for index in exited if self._load[index]]
+                if not died:
+                    exited.update(
+                        index
+                        for index, process in enumerate(self._processes)
+                        if not process.is_alive()
+                    )
+                    return len(exited) == len(self._processes) and not self._pending
+            else:
+                died = [
+                    index
+                    for index, process in enumerate(self._processes)
+                    if not process.is_alive()
+                ]
+                if not died:
+                    return False
+
+            self._broken = self._broken or (
+                f"An inference worker exited with code {self._processes[died[0]].exitcode}"
+            )
+            pending = list(self._pending.values())
+            self._pending.clear()
+            self._load = [0] * len(self._load)
+
+        logger.error("%s; failing %d unanswered calls", self._broken, len(pending))
+        for process in self._processes:
+            if process.is_alive():
+                process.terminate()
+        for future, _ in pending:
+            future.set_exception(BrokenProcessPool(self._broken))
+        return True
@@ -0,0 +1,248 @@
+"""Tests for the token bucket math and the rate limit stores."""
+
+import asyncio
+import math
+import os
+import uuid
+from multiprocessing import shared_memory
+
+import pytest
+import redis
+
+from src.middleware import rate_limit
+from src.middleware.rate_limit import (
+    MemoryRateLimitStore,
+    RateLimiter,
+    RateLimitExceeded,
+    RedisRateLimitStore,
+    SharedMemoryRateLimitStore,
+    _is_full,
+    _refill,
+)
+
+CAPACITY = 10.0
+# One token per second
+RATE = 1.0
+
+
+class FakeClock:
+    """Stands in for the ``time`` module, moving only when told to."""
+
+    def __init__(self, now: float = 1000.0) -> None:
+        self.now = now
+
+    def time(self) -> float:
+        return self.now
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def advance(self, seconds: float) -> None:
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(rate_limit, "time", clock)
+    return clock
+
+
+def test_refill_takes_cost_from_full_bucket():
+    assert _refill(CAPACITY, 0.0, 0.0, 3.0, CAPACITY, RATE) == (7.0, 0.0)
+
+
+def test_refill_waits_for_missing_tokens_without_taking():
+    tokens, wait = _refill(1.0, 0.0, 0.0, 3.0, CAPACITY, RATE)
+    assert tokens == 1.0
+    assert wait == pytest.approx(2.0)
+
+
+def test_refill_adds_elapsed_time_up_to_capacity():
+    assert _refill(2.0, 0.0, 3.0, 0.0, CAPACITY, RATE) == (5.0, 0.0)
+    assert _refill(2.0, 0.0, 60.0, 0.0, CAPACITY, RATE) == (CAPACITY, 0.0)
+
+
+def test_refill_ignores_clock_going_backwards():
+    assert _refill(2.0, 5.0, 4.0, 0.0, CAPACITY, RATE) == (2.0, 0.0)
+
+
+def test_refill_lets_costly_request_into_debt_only_from_full_bucket():
+    tokens, wait = _refill(9.0, 0.0, 0.0, 25.0, CAPACITY, RATE)
+    assert tokens == 9.0
+    assert wait == pytest.approx(1.0)
+
+    tokens, wait = _refill(9.0, 0.0, 1.0, 25.0, CAPACITY, RATE)
+    assert (tokens, wait) == (-15.0, 0.0)
+
+    # The debt is paid back before anything else passes
+    tokens, wait = _refill(-15.0, 1.0, 2.0, 1.0, CAPACITY, RATE)
+    assert tokens == -14.0
+    assert wait == pytest.approx(15.0)
+
+
+def test_is_full():
+    assert _is_full(CAPACITY, 0.0, 0.0, CAPACITY, RATE)
+    assert not _is_full(4.0, 0.0, 5.0, CAPACITY, RATE)
+    assert _is_full(4.0, 0.0, 6.0, CAPACITY, RATE)
+    assert not _is_full(-20.0, 0.0, 29.0, CAPACITY, RATE)
+
+
+def test_memory_store_keeps_a_bucket_per_key(clock):
+    store = MemoryRateLimitStore()
+    assert store.take("a", CAPACITY, CAPACITY, RATE) == 0.0
+    assert store.take("a", 1.0, CAPACITY, RATE) == pytest.approx(1.0)
+    assert store.take("b", 1.0, CAPACITY, RATE) == 0.0
+
+    clock.advance(1.0)
+    assert store.take("a", 1.0, CAPACITY, RATE) == 0.0
+
+
+def test_memory_store_forgets_only_full_buckets(clock):
+    store = MemoryRateLimitStore(max_keys=2)
+    store.take("spent", 2.0, CAPACITY, RATE)
+    store.take("in debt", 30.0, CAPACITY, RATE)
+    clock.advance(5.0)
+    store.take("new", 1.0, CAPACITY, RATE)
+
+    assert set(store._buckets) == {"in debt", "new"}
+    assert store.take("in debt", 1.0, CAPACITY, RATE) == pytest.approx(16.0)
+
+
+@pytest.fixture
+def shm_name():
+    name = f"poetica-test-{uuid.uuid4().hex[:8]}"
+    yield name
+    segment = shared_memory.SharedMemory(name=name)
+    segment.close()
+    segment.unlink()
+    os.remove(os.path.join("/tmp", f"{name}.lock"))
+
+
+def test_shared_memory_store_shares_buckets_between_processes(clock, shm_name):
+    first = SharedMemoryRateLimitStore(shm_name, 64)
+    second = SharedMemoryRateLimitStore(shm_name, 64)
+    try:
+        assert first.take("a", 8.0, CAPACITY, RATE) == 0.0
+        assert second.take("a", 4.0, CAPACITY, RATE) == pytest.approx(2.0)
+        assert second.take("b", 4.0, CAPACITY, RATE) == 0.0
+
+        clock.advance(2.0)
+        assert second.take("a", 4.0, CAPACITY, RATE) == 0.0
+        assert first.take("a", 1.0, CAPACITY, RATE) == pytest.approx(1.0)
+    finally:
+        first.close()
+        second.close()
+
+
+def test_shared_memory_store_starts_new_keys_full_when_slots_run_out(clock, shm_name):
+    # Every key probes the same single slot
+    store = SharedMemoryRateLimitStore(shm_name, 1)
+    try:
+        store.take("a", 30.0, CAPACITY, RATE)
+        clock.advance(1.0)
+        # "a" is in debt, so evicting it for "b" starts "b" with a full bucket
+        assert store.take("b", CAPACITY, CAPACITY, RATE) == 0.0
+        assert store.take("b", 1.0, CAPACITY, RATE) == pytest.approx(1.0)
+
+        clock.advance(CAPACITY)
+        assert store.take("c", 3.0, CAPACITY, RATE) == 0.0
+        assert store.take("c", 8.0, CAPACITY, RATE) == pytest.approx(1.0)
+    finally:
+        store.close()
+
+
+class FakeRedis:
+    """Runs ``RedisRateLimitStore.SCRIPT`` step by step against in-memory hashes.
+
+    ``clock`` plays the server's ``TIME``, and keys vanish once their
+    ``PEXPIRE`` has passed.
+    """
+
+    def __init__(self, clock: FakeClock) -> None:
+        self.clock = clock
+        self.hashes = {}
+        self.expires_at = {}
+        self.down = False
+
+    def register_script(self, script):
+        assert script == RedisRateLimitStore.SCRIPT
+        return self._run
+
+    def close(self) -> None:
+        pass
+
+    def _run(self, keys, args):
+        if self.down:
+            raise redis.ConnectionError("Connection refused")
+        (key,) = keys
+        now = self.clock.time()
+        if key in self.expires_at and self.expires_at[key] <= now:
+            del self.hashes[key], self.expires_at[key]
+
+        capacity, rate, cost = (float(arg) for arg in args)
+        bucket = self.hashes.get(key, {})
+        tokens = float(bucket["tokens"]) if "tokens" in bucket else capacity
+        updated_at = float(bucket["updated_at"]) if "updated_at" in bucket else now
+        tokens = min(capacity, tokens + max(0, now - updated_at) * rate)
+        needed = min(cost, capacity)
+        wait = 0
+        if tokens >= needed:
+            tokens = tokens - cost
+        else:
+            wait = (needed - tokens) / rate
+        # Lua's tostring keeps 14 significant digits
+        self.hashes[key] = {"tokens": f"{tokens:.14g}", "updated_at": f"{now:.14g}"}
+        ttl_ms = max(1, math.ceil((capacity - tokens) / rate * 1000))
+        self.expires_at[key] = now + ttl_ms / 1000
+        return f"{wait:.14g}".encode()
+
+
+@pytest.fixture
+def fake_redis(monkeypatch, clock):
+    server = FakeRedis(clock)
+    monkeypatch.setattr(rate_limit.redis.Redis, "from_url", lambda url: server)
+    return server
+
+
+def test_redis_store_shares_buckets_between_replicas(clock, fake_redis):
+    first = RedisRateLimitStore("redis://fake")
+    second = RedisRateLimitStore("redis://fake")
+    assert first.take("a", 8.0, CAPACITY, RATE) == 0.0
+    assert second.take("a", 4.0, CAPACITY, RATE) == pytest.approx(2.0)
+
+    clock.advance(2.0)
+    assert second.take("a", 4.0, CAPACITY, RATE) == 0.0
+    assert set(fake_redis.hashes) == {"poetica:rate:a"}
+
+
+def test_redis_store_prefix_separates_limiters(clock, fake_redis):
+    interactive = RedisRateLimitStore("redis://fake")
+    bulk = RedisRateLimitStore("redis://fake", "poetica:rate:bulk:")
+    assert interactive.take("a", CAPACITY, CAPACITY, RATE) == 0.0
+    assert bulk.take("a", CAPACITY, CAPACITY, RATE) == 0.0
+
+
+def test_redis_store_keeps_debt_until_refilled(clock, fake_redis):
+    store = RedisRateLimitStore("redis://fake")
+    assert store.take("a", 30.0, CAPACITY, RATE) == 0.0
+    assert fake_redis.expires_at["poetica:rate:a"] == pytest.approx(clock.now + 30.0)
+
+    clock.advance(19.0)
+    assert store.take("a", 1.0, CAPACITY, RATE) == pytest.approx(2.0)
+    clock.advance(2.0)
+    assert store.take("a", 1.0, CAPACITY, RATE) == 0.0
+
+
+def test_redis_store_allows_requests_while_unreachable(clock, fake_redis):
+    store = RedisRateLimitStore("redis://fake")
+    fake_redis.down = True
+    assert store.take("a", 100.0, CAPACITY, RATE) == 0.0
+
+
+def test_rate_limiter_raises_with_retry_after(clock):
+    limiter = RateLimiter(MemoryRateLimitStore(), requests=10, window_seconds=60)
+    asyncio.run(limiter.hit("a", 10.0))
+    with pytest.raises(RateLimitExceeded) as info:
+        asyncio.run(limiter.hit("a", 1.0))
+    assert info.value.retry_after == pytest.approx(6.0)
@@ -0,0 +1,111 @@
+"""Tests that the fused logits processing matches transformers' processors."""
+
+import pytest
+import torch
+from transformers import (
+    LogitsProcessorList,
+    MinLengthLogitsProcessor,
+    NoBadWordsLogitsProcessor,
+    NoRepeatNGramLogitsProcessor,
+    RepetitionPenaltyLogitsProcessor,
+    TemperatureLogitsWarper,
+    TopKLogitsWarper,
+    TopPLogitsWarper,
+)
+
+from src.services.sampling import LogitsProcessorChain
+
+VOCAB_SIZE = 32
+EOS_TOKEN_ID = 0
+MIN_LENGTH = 6
+NO_REPEAT_NGRAM_SIZE = 3
+BAD_WORDS_IDS = [[5], [9], [3, 4], [7, 8, 2]]
+
+HISTORIES = [
+    # Shorter than the minimum length, ending in the start of a bad word
+    [1, 3],
+    # Ends in the bad word prefix (7, 8), which also began the n-gram (7, 8, 11)
+    [2, 6, 4, 7, 8, 11, 7, 8],
+    # Ends in the n-gram prefix (1, 3) and the bad word prefix (3)
+    [1, 3, 12, 12, 13, 14, 15, 1, 3],
+    # Long, with many repeated tokens
+    [10, 11, 12, 10, 11, 13, 10, 11, 14, 10, 11, 15, 16, 17],
+]
+
+# Repetition penalty, temperature, top-k and top-p of each row
+PARAMS = [
+    [1.2, 0.9, 50, 0.95],
+    [2.0, 0.5, 4, 0.8],
+    [1.0, 1.5, 10, 0.3],
+    [1.5, 1.0, VOCAB_SIZE, 0.99],
+]
+
+
+def reference_scores(logits: torch.Tensor, history: list, params: list) -> torch.Tensor:
+    """Scores of one row from transformers' processors applied in generate's order."""
+    penalty, temperature, top_k, top_p = params
+    processors = LogitsProcessorList(
+        [
+            RepetitionPenaltyLogitsProcessor(penalty),
+            NoRepeatNGramLogitsProcessor(NO_REPEAT_NGRAM_SIZE),
+            NoBadWordsLogitsProcessor(BAD_WORDS_IDS, EOS_TOKEN_ID),
+            MinLengthLogitsProcessor(MIN_LENGTH, EOS_TOKEN_ID),
+            TemperatureLogitsWarper(temperature),
+            TopKLogitsWarper(int(top_k)),
+            TopPLogitsWarper(top_p),
+        ]
+    )
+    input_ids = torch.tensor([history], dtype=torch.long)
+    return processors(input_ids, logits.unsqueeze(0).clone())[0]
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_process_matches_transformers(seed):
+    generator = torch.Generator().manual_seed(seed)
+    logits = torch.randn(len(HISTORIES), VOCAB_SIZE, generator=generator) * 3
+
+    chain = LogitsProcessorChain(
+        VOCAB_SIZE,
+        EOS_TOKEN_ID,
+        MIN_LENGTH,
+        NO_REPEAT_NGRAM_SIZE,
+        BAD_WORDS_IDS,
+        torch.device("cpu"),
+    )
+    seen = torch.zeros(len(HISTORIES), VOCAB_SIZE, dtype=torch.bool)
+    for row, history in enumerate(HISTORIES):
+        seen[row, history] = True
+    ngrams = [chain.ngram_index(history) for history in HISTORIES]
+
+    scores = chain.process(
+        logits.clone(),
+        seen,
+        torch.tensor(PARAMS),
+        chain.banned_indices(HISTORIES, ngrams),
+    )
+
+    expected = torch.stack(
+        [
+            reference_scores(row_logits, history, params)
+            for row_logits, history, params in zip(logits, HISTORIES, PARAMS)
+        ]
+    )
+    torch.testing.assert_close(scores, expected)
+
+
+def test_ngram_index_bans_like_transformers_as_tokens_arrive():
+    history = [4, 2, 6, 4, 2, 7, 4, 2, 6, 1, 4, 2]
+    chain = LogitsProcessorChain(
+        VOCAB_SIZE, EOS_TOKEN_ID, 0, NO_REPEAT_NGRAM_SIZE, [], torch.device("cpu")
+    )
+    index = chain.ngram_index(history[:1])
+    reference = NoRepeatNGramLogitsProcessor(NO_REPEAT_NGRAM_SIZE)
+
+    for length in range(1, len(history) + 1):
+        scores = reference(
+            torch.tensor([history[:length]]), torch.zeros(1, VOCAB_SIZE)
+        )
+        expected = set(torch.nonzero(scores[0] == -float("inf")).flatten().tolist())
+        assert set(index.banned()) == expected
+        if length < len(history):
+            index.append(history[length])